@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 15 14:05:19 2026
+
+@author: cosimo
+"""
+######################################################################################
+######      Benchmark of the regression pipeline on synthetic ICOS-like data    ######
+######################################################################################
+# usage: python benchmark.py --years 1 5 20 --output bench.json [--check-sklearn] [--theil-sen] [--moments]
+# each size is run in a temporary directory with the files written by synthetic_data.write_synthetic_station()
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import config as conf
+import synthetic_data as syn
+import formatting_functions as fmt
+import dataset_functions as dsf
+import selection_functions as sel
+import eval_emi_functions as evem
+import lin_reg_functions as lrf
+import moment_functions as mom
+
+def timed(results, name, func, *args, **kwargs):
+    """ run func(*args, **kwargs), store the elapsed time in results[name] and return the output of func """
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    results[name] = round(time.perf_counter() - start, 4)
+    return out
+
+IMPORT_MODULES = ['lin_reg_functions', 'selection_functions', 'eval_emi_functions', 'fit_only', 'linear_regression_deps']
+
+def import_time(module, repeat=3):
+    """
+    import time [s] of a module measured in a fresh interpreter (best of repeat runs), plus the plotting libraries it
+    loads. 'linear_regression_deps' stands for the imports of the linear_regression.py script
+    """
+    if module == 'linear_regression_deps':
+        statement = 'import matplotlib.pyplot, eval_emi_functions, parallel_functions, dataset_functions'
+    else:
+        statement = 'import ' + module
+    code = ('import sys, time; start = time.perf_counter(); ' + statement + '; elapsed = time.perf_counter() - start; '
+            'print(elapsed, *[m for m in ["matplotlib", "seaborn", "plotly", "sklearn"] if m in sys.modules])')
+    best, loaded = None, []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        if (best is None) or (float(out[0]) < best):
+            best, loaded = float(out[0]), out[1:]
+    return {'module': module, 'seconds': round(best, 4), 'heavy_modules': loaded}
+
+# max relative difference between the 'spatial_median' Theil-Sen estimator and sklearn's TheilSenRegressor: the spatial
+# median stops when its update is below lrf.THSEN_TOL, so rounding differences can stop the two iterations one (small)
+# step apart
+THSEN_CHECK_TOL = 1e-4
+
+def check_theil_sen(n_sets=50, seed=0):
+    """
+    compare the slopes and intercepts of the Theil-Sen estimators of lrf.batch_theil_sen() with sklearn's
+    TheilSenRegressor(random_state=42, max_iter=1000) (the estimator used before) on n_sets random CO/CH4-like sets
+    with 2 to 2000 points, covering both the all-pairs and the random-pairs fits. sklearn is optional: the check is
+    skipped if it is not installed
+
+    Returns
+    -------
+    check: dict
+        max relative difference of slopes and intercepts of the 'spatial_median' estimator and whether it is within
+        THSEN_CHECK_TOL (None if skipped), plus the max relative difference of the slopes of the 'median' estimator
+    """
+    try:
+        from sklearn.linear_model import TheilSenRegressor
+    except ImportError:
+        return {'max_rel_diff': None, 'passed': None, 'median_max_rel_diff': None}
+    rng = np.random.default_rng(seed)
+    x_groups, y_groups = [], []
+    for n in rng.integers(2, 2000, n_sets):
+        x = np.round(rng.normal(150, 30, n)) # rounded x to include couples with equal x
+        x_groups.append(x)
+        y_groups.append(1900 + 0.6*x + rng.normal(0, 15, n) + 5*rng.standard_t(2, n))
+    slopes, intercepts = lrf.batch_theil_sen(x_groups, y_groups, estimator='spatial_median')
+    median_slopes, _ = lrf.batch_theil_sen(x_groups, y_groups, estimator='median')
+    max_rel_diff, median_max_rel_diff = 0., 0.
+    for x, y, slope, intercept, median_slope in zip(x_groups, y_groups, slopes, intercepts, median_slopes):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # convergence warnings of the spatial median
+            model = TheilSenRegressor(random_state=42, max_iter=1000).fit(x.reshape(-1, 1), y)
+        max_rel_diff = max(max_rel_diff, abs(slope/model.coef_[0] - 1), abs(intercept/model.intercept_ - 1))
+        median_max_rel_diff = max(median_max_rel_diff, abs(median_slope/model.coef_[0] - 1))
+    return {'max_rel_diff': float(max_rel_diff), 'passed': bool(max_rel_diff < THSEN_CHECK_TOL),
+            'median_max_rel_diff': float(median_max_rel_diff)}
+
+def benchmark_theil_sen(sizes=(700, 3000), n_groups=36, seed=0):
+    """
+    time the Theil-Sen fits against sklearn's TheilSenRegressor (if installed): single fits of each size for both
+    estimators of lrf.batch_theil_sen(), n_groups fits of sizes[0] points (the monthly windows of a 3 year run) in one
+    batched call, and the robustness test of lrf.fit_and_scatter_plot() on sizes[0] points with batched subsample
+    slopes vs sequential refits (each refit includes a Theil-Sen fit)
+
+    Returns
+    -------
+    results: dict
+        elapsed times [s] and speedups over sklearn
+    """
+    try:
+        from sklearn.linear_model import TheilSenRegressor
+    except ImportError:
+        TheilSenRegressor = None
+    rng = np.random.default_rng(seed)
+    def sample(n):
+        x = np.round(rng.normal(150, 30, n))
+        return x, 1900 + 0.6*x + rng.normal(0, 15, n) + 5*rng.standard_t(2, n)
+    def sklearn_fit(x, y):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return TheilSenRegressor(random_state=42, max_iter=1000).fit(x.reshape(-1, 1), y)
+
+    results = {}
+    for n in sizes:
+        x, y = sample(n)
+        entry = {}
+        timed(entry, 'median', lrf.theil_sen, x, y, estimator='median')
+        timed(entry, 'spatial_median', lrf.theil_sen, x, y, estimator='spatial_median')
+        if TheilSenRegressor is not None:
+            timed(entry, 'sklearn', sklearn_fit, x, y)
+            entry['speedup_median'] = round(entry['sklearn'] / entry['median'], 1)
+        results['single_n' + str(n)] = entry
+
+    groups = [sample(sizes[0]) for g in range(n_groups)]
+    entry = {}
+    timed(entry, 'median', lrf.batch_theil_sen, [x for x, y in groups], [y for x, y in groups], estimator='median')
+    if TheilSenRegressor is not None:
+        start = time.perf_counter()
+        for x, y in groups:
+            sklearn_fit(x, y)
+        entry['sklearn'] = round(time.perf_counter() - start, 4)
+        entry['speedup_median'] = round(entry['sklearn'] / entry['median'], 1)
+    results['batch_' + str(n_groups) + 'x' + str(sizes[0])] = entry
+
+    x, y = sample(sizes[0])
+    df = pd.DataFrame({'co': x, 'ch4': y, 'Stdev_co': np.full(len(x), 2.), 'Stdev_ch4': np.full(len(x), 1.)})
+    entry = {}
+    for batch in [True, False]:
+        timed(entry, 'batched' if batch else 'sequential', lrf.fit_and_scatter_plot, df.copy(), 2020, 1, None, None,
+              False, None, True, batch_robustness=batch, seed=seed, write=False)
+    entry['speedup'] = round(entry['sequential'] / entry['batched'], 1)
+    results['robustness_n' + str(sizes[0])] = entry
+    return results
+
+# selections of the moment cube check: (month, season, wd, day_night, bads_no_bkg) as in sel.select_and_fit()
+MOMENT_CONFIGS = [(True, False, None, None, None), (True, False, '180-300', True, True), (True, False, '310-80', None, False),
+                  (False, True, None, False, True), (False, True, '0-0', None, False), (False, False, None, None, None)]
+
+def check_moment_cube(df, configs=MOMENT_CONFIGS, seed=0):
+    """
+    compare the OLS fits of mom.MomentCube.period_ols() with the current path of sel.select_and_fit() (iter_periods(),
+    select_daytime(), select_wd(), select_non_bkg() with the episodes of the full frame, then linregress on the finite
+    couples of each period with more than one row) for each selection in configs, and time both. The yearly periods
+    are compared with select_year() only, as select_and_fit() does not apply the other selections to them. The
+    robustness slopes of MomentCube.subsample_slopes() are compared with lrf.subsample_ols_slopes() on each monthly
+    period of the first config (same seed: with hourly data they draw the same subsamples)
+
+    Returns
+    -------
+    check: dict
+        elapsed times [s], number of compared periods and max differences of n, slope, intercept and rvalue for each
+        config, plus the subsample check
+    """
+    from scipy.stats import linregress
+    results = {}
+    cube = timed(results, 'build_cube', mom.MomentCube, df)
+    episodes = sel.bkg_episodes(df)
+    species, suff = fmt.get_species_suffix(df)
+    results['configs'] = []
+    for month, season, wd, day_night, bads_no_bkg in configs:
+        entry = {'month': month, 'season': season, 'wd': wd, 'day_night': day_night, 'bads_no_bkg': bads_no_bkg}
+        start = time.perf_counter()
+        reference = {}
+        if month | season:
+            for year, period, frame in sel.iter_periods(df, month=month, season=season):
+                frame = sel.select_daytime(frame, day=day_night)
+                frame = sel.select_wd(frame, wd=wd)
+                frame = sel.select_non_bkg(frame, bads_no_bkg, episodes=episodes)
+                frame = frame[np.isfinite(frame[species[0]]) & np.isfinite(frame[species[1]])]
+                if len(frame) > 1:
+                    reference[(year, fmt.get_month_str(period))] = (len(frame), linregress(frame[species[0]], frame[species[1]]))
+        else:
+            wd, day_night, bads_no_bkg = None, None, None
+            for year in conf.years:
+                frame = sel.select_year(df, year)
+                frame = frame[np.isfinite(frame[species[0]]) & np.isfinite(frame[species[1]])]
+                if len(frame) > 1:
+                    reference[(year, '')] = (len(frame), linregress(frame[species[0]], frame[species[1]]))
+        entry['select_and_linregress'] = round(time.perf_counter() - start, 4)
+        fits = timed(entry, 'period_ols', cube.period_ols, month, season, wd=wd, day_night=day_night, bads_no_bkg=bads_no_bkg)
+        diff = {'n': 0, 'slope': 0., 'intercept': 0., 'rvalue': 0.}
+        compared = 0
+        for fit in fits.itertuples():
+            if (fit.year, fit.month) not in reference:
+                continue
+            n, linreg = reference[(fit.year, fit.month)]
+            diff['n'] = max(diff['n'], abs(fit.n - n))
+            diff['slope'] = max(diff['slope'], abs(fit.slope/linreg.slope - 1))
+            diff['intercept'] = max(diff['intercept'], abs(fit.intercept/linreg.intercept - 1))
+            diff['rvalue'] = max(diff['rvalue'], abs(fit.rvalue - linreg.rvalue))
+            compared += 1
+        entry['periods'], entry['periods_reference'] = compared, len(reference)
+        entry['max_diff'] = {key: float(value) for key, value in diff.items()}
+        results['configs'].append(entry)
+
+    # robustness test: 100 subsamples with 20% of the data, as in lrf.fit_and_scatter_plot() with wd==None
+    n_iter, fraction = 100, 0.2
+    entry = {'subsample_ols_slopes': 0., 'subsample_slopes': 0., 'max_rel_diff': 0., 'cv_max_diff': 0.}
+    keys = sel.period_keys(cube.cells)
+    for year, period, frame in sel.iter_periods(df, month=True, season=False):
+        frame = frame[np.isfinite(frame[species[0]]) & np.isfinite(frame[species[1]])]
+        mask = (keys['year'].to_numpy() == year) & (keys['month'].to_numpy() == period)
+        start = time.perf_counter()
+        slopes = lrf.subsample_ols_slopes(frame[species[0]], frame[species[1]], n_iter, fraction, seed=seed)
+        entry['subsample_ols_slopes'] += time.perf_counter() - start
+        start = time.perf_counter()
+        cube_slopes = cube.subsample_slopes(mask, n_iter, fraction, seed=seed)
+        entry['subsample_slopes'] += time.perf_counter() - start
+        if (len(slopes) > 0) and (len(slopes) == len(cube_slopes)):
+            entry['max_rel_diff'] = max(entry['max_rel_diff'], float(np.max(np.abs(cube_slopes/slopes - 1))))
+            entry['cv_max_diff'] = max(entry['cv_max_diff'], float(abs(np.std(cube_slopes)/np.mean(cube_slopes) -
+                                                                      np.std(slopes)/np.mean(slopes))))
+    entry['subsample_ols_slopes'] = round(entry['subsample_ols_slopes'], 4)
+    entry['subsample_slopes'] = round(entry['subsample_slopes'], 4)
+    results['robustness'] = entry
+    return results
+
+def run_benchmark(n_years, freq='1h', seed=0, moments=False):
+    """
+    time the pipeline stages on n_years of synthetic data. With moments==True the OLS fits of the moment cube are
+    also checked against the selections of select_and_fit() (see check_moment_cube())
+
+    Returns
+    -------
+    results: dict
+        elapsed time [s] of each stage plus the size of the dataset
+    """
+    years = list(range(2021 - n_years, 2021)) # baselines are used only up to 2020
+    results = {'n_years': n_years, 'freq': freq}
+    cwd = os.getcwd()
+    conf_years = conf.years
+    with tempfile.TemporaryDirectory() as root:
+        try:
+            conf.years = years
+            syn.write_synthetic_station(root, years, freq=freq, seed=seed)
+            os.chdir(root)
+            ch4_file = conf.L2_name_prefix + '.CH4'
+            results['input_bytes'] = os.path.getsize(conf.L2_ICOS_path + ch4_file)
+            timed(results, 'read_L2_ICOS', fmt.read_L2_ICOS, conf.L2_ICOS_path, ch4_file)
+            timed(results, 'read_L2_ICOS_fast', fmt.read_L2_ICOS_fast, conf.L2_ICOS_path, ch4_file)
+            if freq != '1h': # the rest of the pipeline works on hourly data
+                return results
+            data_frame = timed(results, 'build_data_frame', dsf.build_data_frame)
+            results['rows'] = len(data_frame)
+            co_ch4_frame = data_frame[['co', 'ch4','Stdev_co','Stdev_ch4','DateTime', 'WD', 'bkg']]
+            timed(results, 'select_and_fit', sel.select_and_fit, co_ch4_frame, year=True, month=True, season=False, wd=None,
+                  day_night=None, plot=False, bads_no_bkg=None, robustness=False)
+            timed(results, 'select_and_fit_robustness', sel.select_and_fit, co_ch4_frame, year=True, month=True, season=False,
+                  wd=None, day_night=None, plot=False, bads_no_bkg=None, robustness=True, seed=seed)
+            timed(results, 'select_daytime', sel.select_daytime, co_ch4_frame, day=True)
+            timed(results, 'daily_ratio', evem.daily_ratio, co_ch4_frame)
+            timed(results, 'eval_ch4_emis', evem.eval_ch4_emis, co_ch4_frame, year=True, month=True, season=False, wd=None,
+                  day_night=None, region='SYN', bads_no_bkg=None, robustness=True)
+            if moments:
+                results['moment_cube'] = check_moment_cube(co_ch4_frame, seed=seed)
+        finally:
+            os.chdir(cwd)
+            conf.years = conf_years
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the regression pipeline on synthetic ICOS-like data')
+    parser.add_argument('--years',  type=int, nargs='+', default=[1, 5], help='sizes of the datasets in station-years')
+    parser.add_argument('--minute', action='store_true', help='also time the readers on minute data')
+    parser.add_argument('--output', default=None, help='output json file (default: stdout)')
+    parser.add_argument('--no-imports', action='store_true', help='do not measure the import times of the modules')
+    parser.add_argument('--check-sklearn', action='store_true', help='compare the Theil-Sen fits with sklearn (if installed)')
+    parser.add_argument('--theil-sen', action='store_true', help='time the Theil-Sen fits against sklearn (if installed)')
+    parser.add_argument('--moments', action='store_true', help='check and time the moment cube fits against select_and_fit()')
+    args = parser.parse_args()
+
+    all_results = []
+    import_results = [] if args.no_imports else [import_time(module) for module in IMPORT_MODULES]
+    with contextlib.redirect_stdout(sys.stderr): # keep the pipeline messages out of the json output
+        for n_years in args.years:
+            all_results.append(run_benchmark(n_years, moments=args.moments))
+            if args.minute:
+                all_results.append(run_benchmark(n_years, freq='1min'))
+    output = {'python': sys.version.split()[0], 'import_times': import_results, 'results': all_results}
+    if args.check_sklearn:
+        output['theil_sen_check'] = check_theil_sen()
+    if args.theil_sen:
+        output['theil_sen'] = benchmark_theil_sen()
+    out = json.dumps(output, indent=2)
+    if args.output is None:
+        print(out)
+    else:
+        file = open(args.output, 'w')
+        file.write(out + '\n')
+        file.close()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 12 09:31:05 2026
+
+@author: cosimo
+"""
+######################################################################################
+######            On-disk cache for the linear_regression.py script             ######
+######################################################################################
+
+import hashlib
+import json
+import os
+from glob import glob
+import pandas as pd
+import config as conf
+
+FIT_CACHE_VERSION = 2     # increase to invalidate the cached fit results when the fit procedure changes
+FIT_CACHE_EVICT_EVERY = 50 # check the size of the fit cache every FIT_CACHE_EVICT_EVERY writes
+_fit_cache_writes = 0
+
+try: # parquet needs pyarrow (or fastparquet). Fall back to pickle if it is not available
+    import pyarrow
+    CACHE_FORMAT = 'parquet'
+except ImportError:
+    CACHE_FORMAT = 'pkl'
+
+def file_signature(paths):
+    """
+    list with path, modification time and size of each input file. Missing files are reported with mtime and size == None
+    """
+    signature = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append([path, stat.st_mtime_ns, stat.st_size])
+        else:
+            signature.append([path, None, None])
+    return signature
+
+def cache_key(paths, params):
+    """
+    hash identifying a cached object built from the given input files and parameters
+
+    Parameters
+    ----------
+    paths: list of str
+        input files. Their path, mtime and size enter the key, so that the cache is invalidated when a file changes
+    params: dict
+        parameters (json serializable) used to build the cached object
+
+    Returns
+    -------
+    key: str
+        hexadecimal sha1 digest
+    """
+    content = json.dumps({'files': file_signature(paths), 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def cached_frame_filenm(name, key):
+    """ name of the cache file for the frame 'name' with the given key """
+    return conf.cache_path + name + '_' + key[:16] + '.' + CACHE_FORMAT
+
+def read_cached_frame(name, key):
+    """
+    read a frame from the cache. Returns None if there is no cached frame with the given name and key
+    """
+    filenm = cached_frame_filenm(name, key)
+    if not os.path.exists(filenm):
+        return None
+    if CACHE_FORMAT == 'parquet':
+        return pd.read_parquet(filenm)
+    return pd.read_pickle(filenm)
+
+def write_cached_frame(df, name, key):
+    """
+    write a frame to the cache, removing older cached versions of the same frame. The file is written to a temporary
+    file and then renamed, so that an interrupted run never leaves a corrupted cache
+    """
+    os.makedirs(conf.cache_path, exist_ok=True)
+    for old_file in glob(conf.cache_path + name + '_*.' + CACHE_FORMAT):
+        os.remove(old_file)
+    filenm = cached_frame_filenm(name, key)
+    if CACHE_FORMAT == 'parquet':
+        df.to_parquet(filenm + '.tmp')
+    else:
+        df.to_pickle(filenm + '.tmp')
+    os.replace(filenm + '.tmp', filenm)
+
+def manifest_filenm(name):
+    """ name of the json manifest file of the cached object 'name' """
+    return conf.cache_path + name + '_manifest.json'
+
+def read_manifest(name):
+    """ read the manifest of a cached object. Returns an empty dict if there is no manifest """
+    filenm = manifest_filenm(name)
+    if not os.path.exists(filenm):
+        return {}
+    file = open(filenm, 'r')
+    manifest = json.load(file)
+    file.close()
+    return manifest
+
+def write_manifest(name, manifest):
+    """ write the manifest (json serializable dict) of a cached object through a temporary file """
+    os.makedirs(conf.cache_path, exist_ok=True)
+    filenm = manifest_filenm(name)
+    file = open(filenm + '.tmp', 'w')
+    json.dump(manifest, file, indent=1, sort_keys=True)
+    file.close()
+    os.replace(filenm + '.tmp', filenm)
+
+def fit_cache_dir():
+    """ directory of the cached fit results """
+    return conf.cache_path + 'fits/'
+
+def fit_key(df, params):
+    """
+    content hash of a fit: digest of the values of the fitted columns of df plus the fit parameters
+
+    Parameters
+    ----------
+    df: DataFrame
+        selected data (only the columns used by the fit)
+    params: dict
+        fit parameters (json serializable)
+    """
+    digest = hashlib.sha1(json.dumps({'params': params, 'columns': list(df.columns), 'version': FIT_CACHE_VERSION},
+                                     sort_keys=True, default=str).encode())
+    digest.update(df.to_numpy(dtype='float64').tobytes())
+    return digest.hexdigest()
+
+def read_cached_fit(key):
+    """
+    read the cached result of a fit (list of json values). Returns None if it is not in the cache. The access time of the
+    entry is updated, so that the least recently used entries are evicted first
+    """
+    filenm = fit_cache_dir() + key + '.json'
+    try:
+        file = open(filenm, 'r')
+    except FileNotFoundError:
+        return None
+    values = json.load(file)
+    file.close()
+    os.utime(filenm)
+    return values
+
+def write_cached_fit(key, values):
+    """ write the result of a fit (list of json serializable values) to the cache """
+    global _fit_cache_writes
+    os.makedirs(fit_cache_dir(), exist_ok=True)
+    filenm = fit_cache_dir() + key + '.json'
+    file = open(filenm + '.tmp', 'w')
+    json.dump(values, file)
+    file.close()
+    os.replace(filenm + '.tmp', filenm)
+    _fit_cache_writes = _fit_cache_writes + 1
+    if _fit_cache_writes % FIT_CACHE_EVICT_EVERY == 0:
+        evict_fit_cache()
+
+def evict_fit_cache(max_mb=None):
+    """
+    remove the least recently used fit results until the size of the cache is below max_mb (default conf.fit_cache_max_mb)
+    """
+    if max_mb is None:
+        max_mb = conf.fit_cache_max_mb
+    entries = []
+    for entry in os.scandir(fit_cache_dir()) if os.path.isdir(fit_cache_dir()) else []:
+        if entry.name.endswith('.json'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    size = sum(entry[1] for entry in entries)
+    for mtime, entry_size, path in sorted(entries): # oldest first
+        if size <= max_mb * 2**20:
+            break
+        os.remove(path)
+        size = size - entry_size
@@ -10,6 +10,14 @@ Created on Tue Nov 30 10:19:48 2021
 ######                          Parameters                                      ######
 ######################################################################################
 L2_ICOS_path = './L2_ICOS_data/'
+cache_path   = './cache/' # directory for the cached merged DataFrames
+minute_store_path = './minute_store/' # directory for the memory-mapped minute data (see minute_data_handle.py)
+n_workers    = None       # number of processes used by the parallel runs (None to use all the available cores)
+fit_cache    = False      # reuse the results of fits already performed on the same data with the same parameters
+fit_cache_max_mb = 50     # max size of the fit results cache (least recently used results are removed first)
+min_bkg_duration_h = 2    # min duration of the bkg/non-bkg episodes used by the (non-)bkg selections [hours]
+instrument   = False      # record timers and counters of the pipeline stages (see instrument_functions.py)
+profile      = None       # profile each select_and_fit() call: 'cprofile', 'pyinstrument' or None
 
 ######################################################################
 ################            CIMONE              ######################
@@ -19,10 +27,12 @@ L2_met_name_prefix = 'ICOS_ATC_L2_L2-2021.1_CMN_8.0_CTS'
 L2_nrt_name_prefix     =  'ICOS_ATC_NRT_CMN_2021-02-01_2021-08-09_8.0_'
 L2_nrt_met_name_prefix =  'ICOS_ATC_NRT_CMN_2021-02-01_2021-08-09_8.0_'
 stat = 'CMN'
+stat_lat, stat_lon = 44.19433, 10.70111 # station coordinates (used for the day/night selection)
 gas_inst = '590'
 met_inst = '1156'
 years = [2018, 2019, 2020]
 non_bkg_specie = 'co2' # specie(s) to perform non-bkg selection using BaDSfit results
+bads_filenm = './BaDS_baseline/CMN_2018-2021_BaDSfit_annual_selection_n_5-2-5_mar22.csv'
 
 ######################################################################
 ################            LAMPEDUSA           ######################
@@ -33,6 +43,7 @@ non_bkg_specie = 'co2' # specie(s) to perform non-bkg selection using BaDSfit re
 #L2_nrt_met_name_prefix =  'ICOS_ATC_NRT_LMP_2021-02-01_2021-11-28_8.0_'
 
 #stat= 'LMP'
+#stat_lat, stat_lon = 35.51816, 12.63211 # station coordinates (used for the day/night selection)
 #years=[2020]
 #gas_inst = '268'
 #met_inst = '1042'
@@ -48,6 +59,7 @@ non_bkg_specie = 'co2' # specie(s) to perform non-bkg selection using BaDSfit re
 #L2_nrt_met_name_prefix =  'ICOS_ATC_NRT_PUY_2021-02-01_2022-03-09_10.0_'
 
 #stat= 'PUY'
+#stat_lat, stat_lon = 45.77126, 2.96569 # station coordinates (used for the day/night selection)
 #years=[2016,2017,2018,2019,2020,2021]
 #gas_inst = '473'
 #met_inst = '0-705'
@@ -63,6 +75,7 @@ non_bkg_specie = 'co2' # specie(s) to perform non-bkg selection using BaDSfit re
 #L2_nrt_name_prefix     =  'ICOS_ATC_NRT_JFJ_2021-02-01_2022-04-13_5.0_'
 #L2_nrt_met_name_prefix =  'ICOS_ATC_NRT_JFJ_2021-02-01_2022-04-01_10.0_'
 #stat= 'JFJ'
+#stat_lat, stat_lon = 46.54749, 7.98509 # station coordinates (used for the day/night selection)
 #years=[2017,2018,2019,2020,2021]
 #gas_inst = '226-529'
 #met_inst = '515'
@@ -78,6 +91,7 @@ non_bkg_specie = 'co2' # specie(s) to perform non-bkg selection using BaDSfit re
 # L2_nrt_name_prefix     =  'ICOS_ATC_NRT_HPB_2021-02-01_2022-05-04_131.0_'
 # L2_nrt_met_name_prefix =  'ICOS_ATC_NRT_HPB_2021-02-01_2022-05-05_131.0_'
 # stat= 'HPB'
+# stat_lat, stat_lon = 47.80108, 11.02457 # station coordinates (used for the day/night selection)
 # gas_inst = '271-499-382-1178'
 # met_inst = '750'
 # years=[2017,2018,2019,2020,2021]
@@ -91,9 +105,71 @@ non_bkg_specie = 'co2' # specie(s) to perform non-bkg selection using BaDSfit re
 #L2_nrt_name_prefix     =  'ICOS_ATC_NRT_OPE_2021-02-01_2022-05-04_120.0_'
 #L2_nrt_met_name_prefix =  'ICOS_ATC_NRT_OPE_2021-02-01_2022-05-05_120.0_'
 #stat= 'OPE'
+#stat_lat, stat_lon = 48.56249, 5.50365 # station coordinates (used for the day/night selection)
 #gas_inst = '379-506-967-728'
 #met_inst = '563'
 #years=[2017,2018,2019,2020,2021]
 #non_bkg_specie = '' # specie(s) to perform non-bkg selection using BaDSfit results
 
 
+######################################################################################
+######                      Station registry                                    ######
+######################################################################################
+# parameters of each station, used by multi_station.py to run several stations without editing this file.
+# multi_station.set_station(stat) copies the parameters of a station into the module variables above
+stations = {
+    'CMN': {'L2_name_prefix'        : 'ICOS_ATC_L2_L2-2021.1_CMN_8.0_CTS',
+            'L2_met_name_prefix'    : 'ICOS_ATC_L2_L2-2021.1_CMN_8.0_CTS',
+            'L2_nrt_name_prefix'    : 'ICOS_ATC_NRT_CMN_2021-02-01_2021-08-09_8.0_',
+            'L2_nrt_met_name_prefix': 'ICOS_ATC_NRT_CMN_2021-02-01_2021-08-09_8.0_',
+            'gas_inst': '590', 'met_inst': '1156',
+            'years': [2018, 2019, 2020],
+            'stat_lat': 44.19433, 'stat_lon': 10.70111,
+            'non_bkg_specie': 'co2',
+            'bads_filenm': './BaDS_baseline/CMN_2018-2021_BaDSfit_annual_selection_n_5-2-5_mar22.csv'},
+    'LMP': {'L2_name_prefix'        : 'ICOS_ATC_L2_L2-2021.1_LMP_8.0_CTS',
+            'L2_met_name_prefix'    : 'ICOS_ATC_L2_L2-2021.1_LMP_8.0_CTS',
+            'L2_nrt_name_prefix'    : 'ICOS_ATC_NRT_LMP_2021-02-01_2021-11-28_8.0_',
+            'L2_nrt_met_name_prefix': 'ICOS_ATC_NRT_LMP_2021-02-01_2021-11-28_8.0_',
+            'gas_inst': '268', 'met_inst': '1042',
+            'years': [2020],
+            'stat_lat': 35.51816, 'stat_lon': 12.63211,
+            'non_bkg_specie': '',
+            'bads_filenm': './BaDS_baseline/LMP_2018-2021_co2_BaDSfit_annual_selection_mar22.csv'},
+    'PUY': {'L2_name_prefix'        : 'ICOS_ATC_L2_L2-2021.1_PUY_10.0_CTS',
+            'L2_met_name_prefix'    : 'ICOS_ATC_L2_L2-2021.1_PUY_10.0_CTS',
+            'L2_nrt_name_prefix'    : 'ICOS_ATC_NRT_PUY_2021-02-01_2022-04-26_10.0_',
+            'L2_nrt_met_name_prefix': 'ICOS_ATC_NRT_PUY_2021-02-01_2022-03-09_10.0_',
+            'gas_inst': '473', 'met_inst': '0-705',
+            'years': [2016, 2017, 2018, 2019, 2020, 2021],
+            'stat_lat': 45.77126, 'stat_lon': 2.96569,
+            'non_bkg_specie': '',
+            'bads_filenm': './BaDS_baseline/LMP_2018-2021_co2_BaDSfit_annual_selection_mar22.csv'},
+    'JFJ': {'L2_name_prefix'        : 'ICOS_ATC_L2_L2-2021.1_JFJ_5.0_CTS',
+            'L2_met_name_prefix'    : 'ICOS_ATC_L2_L2-2021.1_JFJ_10.0_CTS',
+            'L2_nrt_name_prefix'    : 'ICOS_ATC_NRT_JFJ_2021-02-01_2022-04-13_5.0_',
+            'L2_nrt_met_name_prefix': 'ICOS_ATC_NRT_JFJ_2021-02-01_2022-04-01_10.0_',
+            'gas_inst': '226-529', 'met_inst': '515',
+            'years': [2017, 2018, 2019, 2020, 2021],
+            'stat_lat': 46.54749, 'stat_lon': 7.98509,
+            'non_bkg_specie': '',
+            'bads_filenm': './BaDS_baseline/LMP_2018-2021_co2_BaDSfit_annual_selection_mar22.csv'},
+    'HPB': {'L2_name_prefix'        : 'ICOS_ATC_L2_L2-2021.1_HPB_50.0_CTS',
+            'L2_met_name_prefix'    : 'ICOS_ATC_L2_L2-2021.1_HPB_50.0_CTS',
+            'L2_nrt_name_prefix'    : 'ICOS_ATC_NRT_HPB_2021-02-01_2022-05-04_131.0_',
+            'L2_nrt_met_name_prefix': 'ICOS_ATC_NRT_HPB_2021-02-01_2022-05-05_131.0_',
+            'gas_inst': '271-499-382-1178', 'met_inst': '750',
+            'years': [2017, 2018, 2019, 2020, 2021],
+            'stat_lat': 47.80108, 'stat_lon': 11.02457,
+            'non_bkg_specie': '',
+            'bads_filenm': ''},
+    'OPE': {'L2_name_prefix'        : 'ICOS_ATC_L2_L2-2021.1_OPE_120.0_CTS',
+            'L2_met_name_prefix'    : 'ICOS_ATC_L2_L2-2021.1_OPE_120.0_CTS',
+            'L2_nrt_name_prefix'    : 'ICOS_ATC_NRT_OPE_2021-02-01_2022-05-04_120.0_',
+            'L2_nrt_met_name_prefix': 'ICOS_ATC_NRT_OPE_2021-02-01_2022-05-05_120.0_',
+            'gas_inst': '379-506-967-728', 'met_inst': '563',
+            'years': [2017, 2018, 2019, 2020, 2021],
+            'stat_lat': 48.56249, 'stat_lon': 5.50365,
+            'non_bkg_specie': '',
+            'bads_filenm': ''},
+    }
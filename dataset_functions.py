@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 12 10:02:37 2026
+
+@author: cosimo
+"""
+######################################################################################
+######     Read ICOS data and build the merged DataFrame of the station         ######
+######################################################################################
+
+import glob
+import hashlib
+import json
+import re
+import pandas as pd
+import numpy as np
+import formatting_functions as fmt
+import cache_functions as cache
+import time_index_functions as tif
+import instrument_functions as instr
+import config as conf
+
+DATA_FRAME_VERSION = 2 # increase to invalidate the cached frames when build_data_frame() changes
+# config parameters that affect the merged DataFrame. The NRT prefixes are not included: they carry the date range of
+# the delivery, and the NRT files in use are identified by their signature (see get_nrt_files())
+CONFIG_PARAMS = ['stat', 'years', 'L2_name_prefix', 'L2_met_name_prefix', 'gas_inst', 'met_inst', 'non_bkg_specie', 'bads_filenm']
+NRT_DATES = re.compile(r'\d{4}-\d{2}-\d{2}_\d{4}-\d{2}-\d{2}') # date range of the NRT file names
+
+def find_nrt_file(nrt_prefix, inst, ext):
+    """
+    latest NRT delivery of the station and instrument in conf.L2_ICOS_path: the date range of nrt_prefix (e.g.
+    'ICOS_ATC_NRT_CMN_2021-02-01_2021-08-09_8.0_') is replaced by a wildcard and, among the matching files, the one with
+    the latest dates is returned. The file of nrt_prefix is returned if no file matches
+    """
+    pattern = NRT_DATES.sub('*', glob.escape(nrt_prefix), count=1) + glob.escape(inst + ext)
+    files = sorted(glob.glob(glob.escape(conf.L2_ICOS_path) + pattern)) # ISO dates: the latest delivery is the last one
+    if len(files) == 0:
+        return conf.L2_ICOS_path + nrt_prefix + inst + ext
+    return files[-1]
+
+def get_nrt_files():
+    """ list of the NRT files (latest delivery, see find_nrt_file()) of the station defined in the config file """
+    return [find_nrt_file(conf.L2_nrt_name_prefix, conf.gas_inst, '.CH4'),
+            find_nrt_file(conf.L2_nrt_name_prefix, conf.gas_inst, '.CO'),
+            find_nrt_file(conf.L2_nrt_met_name_prefix, conf.met_inst, '.MTO')]
+
+def get_input_files():
+    """ list of the files that are read to build the merged DataFrame of the station defined in the config file """
+    files = [conf.L2_ICOS_path + conf.L2_name_prefix     + '.CH4',
+             conf.L2_ICOS_path + conf.L2_name_prefix     + '.CO',
+             conf.L2_ICOS_path + conf.L2_met_name_prefix + '.MTO'] + get_nrt_files() + [fmt.BASELINE_FILE]
+    if (conf.stat=='CMN') & (conf.years[0] ==2018):
+        files = files + [fmt.CMN_2018_FILE, fmt.CMN_2018_MET_FILE]
+    if conf.stat=='CMN':
+        files = files + [fmt.get_BADS_filenm()]
+    return files
+
+def read_station_frames(nrt_only=False):
+    """
+    read the CH4, CO and MET frames of the station defined in the config file (L2 and NRT data, plus the 2018 CMN data
+    if needed) and add the DateTime column
+
+    Parameters
+    ----------
+    nrt_only: bool
+        read only the NRT files. The default is False
+
+    Returns
+    -------
+    CH4_frame, CO_frame, MET_frame: DataFrame
+    """
+    nrt_ch4, nrt_co, nrt_met = [file_nm[len(conf.L2_ICOS_path):] for file_nm in get_nrt_files()]
+    CH4_frame = fmt.read_L2_ICOS_fast(conf.L2_ICOS_path, nrt_ch4)
+    CO_frame  = fmt.read_L2_ICOS_fast(conf.L2_ICOS_path, nrt_co)
+    MET_frame = fmt.read_L2_ICOS_fast(conf.L2_ICOS_path, nrt_met)
+    if not nrt_only:
+        CH4_frame = pd.concat([fmt.read_L2_ICOS_fast(conf.L2_ICOS_path, conf.L2_name_prefix + '.CH4'), CH4_frame], ignore_index=True)
+        CO_frame  = pd.concat([fmt.read_L2_ICOS_fast(conf.L2_ICOS_path, conf.L2_name_prefix + '.CO'), CO_frame], ignore_index=True)
+        MET_frame = pd.concat([fmt.read_L2_ICOS_fast(conf.L2_ICOS_path, conf.L2_met_name_prefix + '.MTO'), MET_frame], ignore_index=True)
+
+    # conversion to datetime is needed since the MET files decimal date differs from the CO and CH4 ones
+    fmt.insert_datetime_col(CH4_frame,     3, 'Year', 'Month', 'Day', 'Hour', 'Minute')
+    fmt.insert_datetime_col(CO_frame,      3, 'Year', 'Month', 'Day', 'Hour', 'Minute')
+    fmt.insert_datetime_col(MET_frame,     3, 'Year', 'Month', 'Day', 'Hour', 'Minute')
+
+    if (not nrt_only) & (conf.stat=='CMN') & (conf.years[0] ==2018):
+        CH4_frame, CO_frame, MET_frame = fmt.append_2018(CH4_frame, CO_frame, MET_frame)
+    return CH4_frame, CO_frame, MET_frame
+
+def merge_station_frames(CH4_frame, CO_frame, MET_frame, baseline_frame=None):
+    """
+    merge CH4, CO and MET frames into a single DataFrame, add BaDS bkg flags (CMN only) and baselines and select only
+    valid data. baseline_frame is the frame of load_baseline_frame() (read from the cache if None, the default)
+    """
+    do_not_duplicate_cols = ['#Site', 'SamplingHeight'] # avoid duplicating these cols while merging dataframes
+    # ordered merges on the sorted DateTime (see time_index_functions.merge_on_time()): the merged frame stays sorted
+    with instr.stage('merge', rows_in=len(CH4_frame)) as record:
+        data_frame = tif.merge_on_time(tif.sort_by_time(CH4_frame), CO_frame[CO_frame.columns.difference(do_not_duplicate_cols)], suffixes=('_ch4','_co'))
+        data_frame = tif.merge_on_time(data_frame, MET_frame[MET_frame.columns.difference(do_not_duplicate_cols)], suffixes=('','_met'))
+        record['rows_out'] = len(data_frame)
+
+    # select only valid data
+    with instr.stage('flag_filter', rows_in=len(data_frame)) as record:
+        flags = ['Flag_ch4', 'Flag_co', 'WD-Flag'] # flags to perform the selection
+        for i in range(len(flags)):
+            data_frame = data_frame[(data_frame[flags[i]]!='N') & (data_frame[flags[i]]!='K')]
+        record['rows_out'] = len(data_frame)
+
+    ##### Baseline section
+    # add BaDS bkg flags (CMN only) and baselines for ch4 and co to data_frame with a single join
+    if baseline_frame is None:
+        baseline_frame = load_baseline_frame()
+    with instr.stage('baseline_join', rows_in=len(data_frame)) as record:
+        data_frame = tif.merge_on_time(data_frame, baseline_frame)
+        record['rows_out'] = len(data_frame)
+
+    # add cols with differences between measured values and baselines to data_frame
+    data_frame.insert(len(data_frame.columns), 'ch4_baseline_delta', data_frame['ch4'] - data_frame['ch4_baseline'])
+    data_frame.insert(len(data_frame.columns), 'co_baseline_delta',  data_frame['co']  - data_frame['co_baseline'] )
+
+    data_frame['ch4_baseline_delta'] = data_frame['ch4_baseline_delta'].replace(0., np.nan) # replace zeros with 'nan'
+    data_frame['co_baseline_delta']  = data_frame['co_baseline_delta'].replace(0., np.nan)
+
+    return data_frame
+
+def get_baseline_files():
+    """ list of the BaDS files read by build_baseline_frame() """
+    files = [fmt.BASELINE_FILE]
+    if conf.stat=='CMN':
+        files = files + [fmt.get_BADS_filenm()]
+    return files
+
+def build_baseline_frame():
+    """
+    read the ch4 and co baselines and, for CMN, the BaDS bkg flags into a single frame sorted on DateTime (inner join
+    on DateTime, as the separate merges of the merged DataFrame)
+
+    Returns
+    -------
+    baseline_frame: DataFrame
+        columns 'DateTime', 'bkg' (CMN only), 'ch4_baseline' and 'co_baseline'
+    """
+    baseline_frame = tif.sort_by_time(fmt.get_baselines(['ch4', 'co']))
+    if conf.stat=='CMN':
+        baseline_frame = tif.merge_on_time(tif.sort_by_time(fmt.read_BADS_frame()), baseline_frame)
+    return baseline_frame
+
+def load_baseline_frame(use_cache=True):
+    """
+    Get the baseline and bkg flags frame (see build_baseline_frame()). The BaDS csv files are parsed only once: the frame
+    is kept in the cache as a binary file and rebuilt only when the BaDS files or the station parameters change
+
+    Parameters
+    ----------
+    use_cache: bool
+        read and write the cache. The default is True
+
+    Returns
+    -------
+    baseline_frame: DataFrame
+    """
+    if not use_cache:
+        return build_baseline_frame()
+    params = {'stat': conf.stat, 'non_bkg_specie': conf.non_bkg_specie, 'version': DATA_FRAME_VERSION}
+    key = cache.cache_key(get_baseline_files(), params)
+    baseline_frame = cache.read_cached_frame(conf.stat + '_baseline_store', key)
+    if baseline_frame is None:
+        baseline_frame = build_baseline_frame()
+        cache.write_cached_frame(baseline_frame, conf.stat + '_baseline_store', key)
+    return tif.sort_by_time(baseline_frame)
+
+def build_data_frame():
+    """
+    Read ICOS L2 and NRT data, merge CH4, CO and MET data into a single DataFrame, add BaDS bkg flags (CMN only) and
+    baselines and select only valid data
+
+    Returns
+    -------
+    data_frame: DataFrame
+        merged DataFrame of the station defined in the config file
+    """
+    return merge_station_frames(*read_station_frames())
+
+def load_data_frame(use_cache=True):
+    """
+    Get the merged DataFrame of the station defined in the config file. The DataFrame is read from the cache if a cached
+    version exists for the current input files (path, mtime and size) and config parameters, otherwise it is built with
+    build_data_frame() and cached
+
+    Parameters
+    ----------
+    use_cache: bool
+        read and write the cache. The default is True
+
+    Returns
+    -------
+    data_frame: DataFrame
+        merged DataFrame, sorted on DateTime (see time_index_functions.sort_by_time())
+    """
+    with instr.stage('load_data_frame', cache_hit=0) as record:
+        if not use_cache:
+            data_frame = tif.sort_by_time(build_data_frame())
+            record['rows_out'] = len(data_frame)
+            return data_frame
+        params = {par: getattr(conf, par) for par in CONFIG_PARAMS}
+        params['version'] = DATA_FRAME_VERSION
+        key = cache.cache_key(get_input_files(), params)
+        data_frame = cache.read_cached_frame(conf.stat + '_data_frame', key)
+        if data_frame is None:
+            data_frame = build_data_frame()
+            cache.write_cached_frame(data_frame, conf.stat + '_data_frame', key)
+        else:
+            record['cache_hit'] = 1
+        record['rows_out'] = len(data_frame)
+    return tif.sort_by_time(data_frame)
+
+def month_digests(df):
+    """ dict 'YYYY-MM' -> digest of the rows of df in that month, used to detect the months whose data changed """
+    row_hash = pd.util.hash_pandas_object(df.astype({col: object for col in df.columns if df[col].dtype.name=='category'}),
+                                          index=False).to_numpy()
+    month_key = df['DateTime'].dt.strftime('%Y-%m').to_numpy()
+    order = np.argsort(month_key, kind='stable')
+    months, starts = np.unique(month_key[order], return_index=True)
+    digests = {}
+    for month, rows in zip(months, np.split(order, starts[1:])):
+        digests[month] = hashlib.sha1(row_hash[rows].tobytes()).hexdigest()
+    return digests
+
+def update_data_frame():
+    """
+    Incremental version of load_data_frame() for the NRT updates. The merged DataFrame and the digest of each month are
+    kept in the cache: when only the NRT files changed (a new dated delivery, see get_nrt_files(), or files overwritten in
+    place), only the NRT files are read and merged, and their rows replace the cached rows from the first NRT timestamp on. Any change of the L2, baseline or BaDS files or of the config
+    parameters triggers a full rebuild with build_data_frame()
+
+    The months whose digest changed are returned and kept as pending in the cache manifest until
+    clear_pending_periods() is called (i.e. after the fit tables have been updated), so that an interrupted update is
+    not lost
+
+    Returns
+    -------
+    data_frame: DataFrame
+        merged DataFrame of the station defined in the config file, sorted on DateTime
+    periods: list of tuples
+        (year, month) of the new or changed months, in chronological order
+    """
+    name = conf.stat + '_incr_frame'
+    params = {par: getattr(conf, par) for par in CONFIG_PARAMS}
+    params['version'] = DATA_FRAME_VERSION
+    nrt_files = get_nrt_files()
+    key = cache.cache_key([file_nm for file_nm in get_input_files() if file_nm not in nrt_files], params)
+    nrt_signature = cache.file_signature(nrt_files)
+    manifest = cache.read_manifest(name)
+    data_frame = None
+    if manifest.get('key') == key:
+        data_frame = cache.read_cached_frame(name, key)
+    if data_frame is None: # no valid cached frame
+        print('full rebuild of the '+conf.stat+' DataFrame')
+        data_frame = build_data_frame()
+        old_digests = {}
+    elif manifest['nrt_files'] == json.loads(json.dumps(nrt_signature)): # nothing new
+        return tif.sort_by_time(data_frame), [tuple(period) for period in manifest['pending']]
+    else:
+        data_frame = tif.sort_by_time(data_frame)
+        nrt_frame = merge_station_frames(*read_station_frames(nrt_only=True))
+        if len(nrt_frame) > 0:
+            nrt_start = nrt_frame['DateTime'].min()
+            data_frame = pd.concat([tif.time_slice(data_frame, end=nrt_start), nrt_frame], ignore_index=True)
+        old_digests = manifest['months']
+    data_frame = tif.sort_by_time(data_frame)
+
+    digests = month_digests(data_frame)
+    changed = set(month for month in digests if digests[month] != old_digests.get(month)) # new or changed months
+    changed |= set(month for month in old_digests if month not in digests)                # months without data anymore
+    periods = sorted(set((int(month[:4]), int(month[5:])) for month in changed) |
+                     set(tuple(period) for period in manifest.get('pending', [])))
+    cache.write_cached_frame(data_frame, name, key)
+    cache.write_manifest(name, {'key': key, 'nrt_files': nrt_signature, 'months': digests, 'pending': periods})
+    return data_frame, periods
+
+def clear_pending_periods():
+    """ mark the changed months returned by update_data_frame() as processed """
+    name = conf.stat + '_incr_frame'
+    manifest = cache.read_manifest(name)
+    if manifest:
+        manifest['pending'] = []
+        cache.write_manifest(name, manifest)
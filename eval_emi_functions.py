@@ -9,21 +9,126 @@ Created on Wed Oct 13 11:46:41 2021
 ######            Functions for the linear_regression.py script                 ######
 ######################################################################################
 
-import matplotlib.pyplot as plt
+import os
 import pandas as pd
 import formatting_functions as fmt
-from numpy import arange
 import config as conf
 import selection_functions as sel
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import seaborn
-import matplotlib.ticker as mticker
-from matplotlib import rcParams, rcParamsDefault
 import numpy as np
-from scipy.optimize import curve_fit as cf
 import lin_reg_functions as lrf
+import plot_functions as plf
 import datetime as dt
+# plotting libraries (matplotlib, seaborn) and scipy.optimize are imported inside the functions that use them (the
+# figures are drawn by plot_functions), so that importing this module for the emission estimates and the daily ratios
+# does not pay their import time
+
+GWP = 25 # Global warming potential of greenhouse gases over 100-year
+MCH4 = 16.043 # methane molecular weight
+MCO = 28.010 # CO molecular weight
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August','September','October','November','December']
+
+def read_emission_inventory(region, spec, period, IPR=False):
+    """
+    read the predicted emissions of an inventory from ./res_emission_selection/
+
+    Parameters
+    ----------
+    region: str
+        region name (e.g. 'ER'=Emilia Romagna, 'TOS'=Toscana)
+    spec: str
+        'CO' or 'CH4'
+    period: str
+        'yearly' (columns year, emi[t], emi_err[t]) or 'monthly' (columns year, month, emi[t])
+    IPR: bool
+        ISPRA (True) or EDGAR (False) inventory. The default is False
+
+    Returns
+    -------
+    emi_frame: DataFrame
+    """
+    inventory = 'ISPRA_' if IPR else ''
+    return pd.read_csv('./res_emission_selection/predicted_'+region+'_'+inventory+spec+'_'+period+'_emi.txt', sep=' ')
+
+def slope_errors(fit_frame):
+    """
+    uncertainty of the fitted slopes: slope_sd when it is available, otherwise the standard deviation of the subsample
+    slopes of the robustness test (the TheilSen fit writes slope_sd=-99.99 and the fits without robustness test
+    mean_slope_sub=-999.99). NaN if neither is available
+    """
+    slope_sd = fit_frame['slope_sd'].to_numpy(dtype=float)
+    sub_sd = np.where(fit_frame['mean_slope_sub'].to_numpy(dtype=float) > -999, fit_frame['slope_sd_sub'].to_numpy(dtype=float), np.nan)
+    return np.where(slope_sd >= 0, slope_sd, sub_sd)
+
+def estimate_ch4_emissions(fit_frame, emi_co_frame, emi_ch4_frame=None, years=None):
+    """
+    CO-based CH4 emissions of all the fitted periods at once: the fit slopes are joined with the CO inventory on
+    (year, month) ('year' only for the yearly inventories) and CH4 = slope * CO * Mch4 / Mco. The relative errors of the
+    slope (see slope_errors()) and of the CO inventory (emi_err[t], if available) are summed in quadrature
+
+    Parameters
+    ----------
+    fit_frame: DataFrame
+        fit results table (one row per period). For the yearly inventories the fit frame should hold one slope per year
+        (see yearly_slopes())
+    emi_co_frame, emi_ch4_frame: DataFrame
+        CO and CH4 inventories (see read_emission_inventory()). The CH4 inventory is optional and is only added to the
+        output for comparison
+    years: list of int
+        years to evaluate. The default is None, i.e. conf.years
+
+    Returns
+    -------
+    emi_frame: DataFrame
+        one row per period with both the fit slope and the CO emission, in time order, with columns year, (month,
+        month_number,) slope, slope_err, emi_co, emi_co_err, ch4_est, ch4_est_err and, if emi_ch4_frame is given,
+        emi_ch4 and emi_ch4_err. Missing errors are NaN
+    """
+    if years is None:
+        years = conf.years
+    keys = ['year', 'month'] if ('month' in fit_frame.columns) and ('month' in emi_co_frame.columns) else ['year']
+
+    def inventory(emi_frame, spec):
+        emi_frame = emi_frame.drop_duplicates(keys) # first value of each period, as in the legacy loops
+        out = pd.DataFrame({key: emi_frame[key].to_numpy() for key in keys})
+        out['emi_'+spec] = emi_frame['emi[t]'].to_numpy(dtype=float)
+        out['emi_'+spec+'_err'] = emi_frame['emi_err[t]'].to_numpy(dtype=float) if 'emi_err[t]' in emi_frame.columns else np.nan
+        return out
+
+    fits = fit_frame[fit_frame['year'].isin(years)].drop_duplicates(keys)
+    emi_frame = pd.DataFrame({key: fits[key].to_numpy() for key in keys})
+    emi_frame['slope'] = fits['slope'].to_numpy(dtype=float)
+    emi_frame['slope_err'] = slope_errors(fits) if 'slope_sd' in fits.columns else np.nan
+    emi_frame = emi_frame.merge(inventory(emi_co_frame, 'co'), on=keys, how='inner')
+    if emi_ch4_frame is not None:
+        emi_frame = emi_frame.merge(inventory(emi_ch4_frame, 'ch4'), on=keys, how='left')
+
+    emi_frame['ch4_est'] = emi_frame['slope'] * emi_frame['emi_co'] * MCH4 / MCO
+    rel_err = np.sqrt((emi_frame['slope_err'] / emi_frame['slope'])**2 + (emi_frame['emi_co_err'].fillna(0) / emi_frame['emi_co'])**2)
+    emi_frame['ch4_est_err'] = np.abs(emi_frame['ch4_est']) * rel_err
+
+    if 'month' in keys:
+        emi_frame.insert(2, 'month_number', emi_frame['month'].map({month: i+1 for i, month in enumerate(MONTHS)}))
+        emi_frame = emi_frame.sort_values(['year', 'month_number'], kind='stable')
+    else:
+        emi_frame = emi_frame.sort_values('year', kind='stable')
+    return emi_frame.reset_index(drop=True)
+
+def yearly_slopes(fit_frame, robustness, years=None):
+    """
+    mean slope of each year (only robust fits with r2>0.6 if robustness). Years without fits get a NaN slope
+
+    Returns
+    -------
+    slope_frame: DataFrame
+        columns year and slope, one row per year in years (default conf.years)
+    """
+    if years is None:
+        years = conf.years
+    if robustness: # use only robust months
+        fit_frame = fit_frame[(fit_frame['robust']==True) & (fit_frame['r2']>0.6)]
+    # should consider only seasonal fit with r2>0.6? In case you could loose one over 4 season each year!
+    slopes = fit_frame.groupby('year')['slope'].mean().reindex(years)
+    return pd.DataFrame({'year': list(years), 'slope': slopes.to_numpy(dtype=float)})
 
 def get_ch4_emis_list(region, fit_frame, robustness, season, custom_years='', IPR=False):
     """
@@ -37,44 +142,23 @@ def get_ch4_emis_list(region, fit_frame, robustness, season, custom_years='', IP
     -------
     None.
     """
-    if IPR:
-        co_emission_file  = './res_emission_selection/predicted_'+region+'_ISPRA_CO_yearly_emi.txt'
-    else:
-        co_emission_file  = './res_emission_selection/predicted_'+region+'_CO_yearly_emi.txt'
-    
-    GWP = 25 # Global warming potential of greenhouse gases over 100-year
-    Mch4 = 16.043 # methane molecular weight
-    Mco = 28.010 # CO molecular weight
-    emi_co_frame = pd.read_csv(co_emission_file, sep=' ')
     if custom_years!='':
         years=custom_years
     else:
         years = conf.years
-        
-    ch4_emi = []
+    emi_co_frame = read_emission_inventory(region, 'CO', 'yearly', IPR=IPR)
+    slope_frame = yearly_slopes(fit_frame, robustness, years)
+
     print('year avg_slope')
-    for year in years:
-        #avg_slope = fit_frame[(fit_frame['year']==year)]['slope'].mean()
-        #avg_slope = fit_frame[(fit_frame['year']==year) & (fit_frame['robust']==True)]['slope'].mean() # use only robust months
-        
-        if robustness:
-            if not season:
-                avg_slope = fit_frame[(fit_frame['year']==year) & (fit_frame['robust']==True) & (fit_frame['r2']>0.6)]['slope'].mean() # use only robust months
-            else:
-                avg_slope = fit_frame[(fit_frame['year']==year) & (fit_frame['robust']==True) & (fit_frame['r2']>0.6)]['slope'].mean() # use only robust months
-        else: # should consider only seasonal fit with r2>0.6? In case you could loose one over 4 season each year!
-            if not season:
-                avg_slope = fit_frame[(fit_frame['year']==year) ]['slope'].mean()
-                #avg_slope = fit_frame[(fit_frame['year']==year) & (fit_frame['r2']>0.6)]['slope'].mean()
-            else:
-                avg_slope = fit_frame[(fit_frame['year']==year) ]['slope'].mean() 
-                #avg_slope = fit_frame[(fit_frame['year']==year) & (fit_frame['r2']>0.6)]['slope'].mean() 
+    for year, avg_slope in zip(slope_frame['year'], slope_frame['slope']):
         print(year, round(avg_slope,2))
-        ch4_emi.append( avg_slope * (emi_co_frame[emi_co_frame['year']==year]['emi[t]']).iat[0] * Mch4 / Mco )
-        
-    return ch4_emi
+    if not slope_frame['year'].isin(emi_co_frame['year']).all():
+        print('ERROR: get_ch4_emis_list(): missing CO emissions for some of the years ' + str(list(years)))
+        os.sys.exit()
+    emi_frame = estimate_ch4_emissions(slope_frame, emi_co_frame, years=years)
+    return emi_frame['ch4_est'].tolist()
 
-def eval_ch4_emis(df, year, month, season, wd, day_night, region, bads_no_bkg, robustness):
+def eval_ch4_emis(df, year, month, season, wd, day_night, region, bads_no_bkg, robustness, fit_store=None, plots=None):
     """
     Evaluate CH4 emission using CO emissions and the fit results
     
@@ -88,6 +172,10 @@ def eval_ch4_emis(df, year, month, season, wd, day_night, region, bads_no_bkg, r
         daytime (day==True) or nightime selection (day==False). day==None if no selection has been performed
     region: str
         region name to evaluate emissions ('ER'=Emilia Romagna, 'TOS'=Toscana)
+    fit_store: FitResultsStore
+        store with the fit results. The default is None, i.e. the fit results are read from the fit results table file
+    plots: plf.PlotQueue
+        queue for the deferred rendering of the plots. The default is None, i.e. plots are drawn immediately
     Returns
     ----
     None
@@ -103,8 +191,11 @@ def eval_ch4_emis(df, year, month, season, wd, day_night, region, bads_no_bkg, r
     print('\nDATA AND PARAMETERS FOR CH4 ESTIMATION')
     print('fit result file = ' + fit_table_nm)
     
-    fit_res_file = './'+conf.stat+'/res_fit/' + fit_table_nm
-    fit_frame = pd.read_csv(fit_res_file, sep=' ')
+    if fit_store is not None:
+        fit_frame = fit_store.to_frame(fit_table_nm)
+    else:
+        fit_res_file = './'+conf.stat+'/res_fit/' + fit_table_nm
+        fit_frame = pd.read_csv(fit_res_file, sep=' ')
 
     plot_nm_suffix = fit_table_nm[11:(len(fit_table_nm)-4)]
     years = conf.years
@@ -115,37 +206,28 @@ def eval_ch4_emis(df, year, month, season, wd, day_night, region, bads_no_bkg, r
     emi_ch4_frame = pd.read_csv(ch4_emission_file, sep=' ')
     
     # plot
-    
-    fig, ax = plt.subplots(1,1, figsize = (9,5))
-    fig.suptitle('EDGAR measured and predicted emissions for CH$_4$ plus CO-estimated emissions for region '+region+'\nPerformed selections:' + plot_nm_suffix.replace('_',' '))
-    ax.errorbar(emi_ch4_frame['year'], emi_ch4_frame['emi[t]'], emi_ch4_frame['emi_err[t]'], fmt='.', elinewidth=1, capsize=3)
-    ax.scatter(years, ch4_emi, c='C1')
-    ax.set_xlabel('years')
-    ax.set_ylim(0,max(emi_ch4_frame['emi[t]']+emi_ch4_frame['emi_err[t]'])*1.05)
-    ax.set_ylabel('CH$_4$ total emission [t]')
-    ax.grid()
-    fig.savefig('./'+conf.stat+'/plot_estimated_emissions/CH4_CO_'+region+'_estimated_emissions'+plot_nm_suffix+'.pdf', format = 'pdf')
+    figures = []
+    figures.append(('ch4_emis', './'+conf.stat+'/plot_estimated_emissions/CH4_CO_'+region+'_estimated_emissions'+plot_nm_suffix+'.pdf',
+                    dict(title='EDGAR measured and predicted emissions for CH$_4$ plus CO-estimated emissions for region '+region+'\nPerformed selections:' + plot_nm_suffix.replace('_',' '),
+                         years=years, ch4_emi=ch4_emi, emi_years=emi_ch4_frame['year'].to_numpy(), emi=emi_ch4_frame['emi[t]'].to_numpy(), emi_err=emi_ch4_frame['emi_err[t]'].to_numpy())))
     if month:
         print('output plot: CH4_CO_estimated_emissions'+plot_nm_suffix+'.pdf')
-        fig1, ax1 = plt.subplots(1,1, figsize = (9,5))
-        fig1.suptitle('Monthly mean slope from linear fit on CH$_4$ and CO data at '+conf.stat+'\nPerformed selections:' + plot_nm_suffix.replace('_',' '))
         mean_slope=[]
         mean_slope_weak=[]
-        months = arange(1,13,1)
         for month in ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August','September','October','November','December']:
             mean_slope.append(fit_frame[(fit_frame['month']==month) & (fit_frame['robust']==True) & (fit_frame['r2']>0.6)]['slope'].mean())
             mean_slope_weak.append(fit_frame[(fit_frame['month']==month)]['slope'].mean())
-        
-        ax1.plot(months,mean_slope, marker='.', ls='-', label='robust data', markersize=15)
-        ax1.plot(months,mean_slope_weak, marker='.', ls='-',label='all data')
-        ax1.set_xticks(months)
-        ax1.set_xticklabels(['jan','feb','mar','apr','may','jun','jul','aug','sept','oct','nov','dec'])
-        ax1.grid()
-        ax1.legend()
-        fig1.savefig('./'+conf.stat+'/plot_estimated_emissions/CH4:CO_slope'+plot_nm_suffix+'.pdf', format = 'pdf')
+        figures.append(('monthly_slope', './'+conf.stat+'/plot_estimated_emissions/CH4:CO_slope'+plot_nm_suffix+'.pdf',
+                        dict(title='Monthly mean slope from linear fit on CH$_4$ and CO data at '+conf.stat+'\nPerformed selections:' + plot_nm_suffix.replace('_',' '),
+                             mean_slope=mean_slope, mean_slope_weak=mean_slope_weak)))
+    for kind, filenm, data in figures:
+        if plots is not None: # deferred plotting
+            plots.add(kind, filenm, **data)
+        else:
+            plf.render(kind, filenm, data)
         
     
-def eval_ch4_monthly_emis(df, year, month, wd, day_night, region, bads_no_bkg, robustness):
+def eval_ch4_monthly_emis(df, year, month, wd, day_night, region, bads_no_bkg, robustness, fit_store=None):
     """
     Evaluate CH4 emission on a monthly base using CO emissions and the fit results
     
@@ -159,12 +241,13 @@ def eval_ch4_monthly_emis(df, year, month, wd, day_night, region, bads_no_bkg, r
         daytime (day==True) or nightime selection (day==False). day==None if no selection has been performed
     region: str
         region name to evaluate emissions ('ER'=Emilia Romagna, 'TOS'=Toscana)
+    fit_store: FitResultsStore
+        store with the fit results. The default is None, i.e. the fit results are read from the fit results table file
     Returns
     ----
-    None
+    emi_frame: DataFrame
+        monthly estimated and inventory emissions (see estimate_ch4_emissions())
     """
-    co_emission_file  = './res_emission_selection/predicted_'+region+'_CO_monthly_emi.txt'
-    ch4_emission_file = './res_emission_selection/predicted_'+region+'_CH4_monthly_emi.txt'
     species, suff = fmt.get_species_suffix(df)
     
     _,_,fit_table_nm = fmt.format_title_filenm(year=year, month=month, season=None, wd=wd, day_night=day_night, suff=suff, non_bkg=bads_no_bkg, robust=robustness)
@@ -174,40 +257,17 @@ def eval_ch4_monthly_emis(df, year, month, wd, day_night, region, bads_no_bkg, r
     fit_res_file = './'+conf.stat+'/res_fit/' + fit_table_nm
     plot_nm_suffix = fit_table_nm[11:(len(fit_table_nm)-4)]
     
-    GWP = 25 # Global warming potential of greenhouse gases over 100-year
-    Mch4 = 16.043 # methane molecular weight
-    Mco = 28.010 # CO molecular weight
-    emi_co_frame = pd.read_csv(co_emission_file, sep=' ')
-    emi_ch4_frame = pd.read_csv(ch4_emission_file, sep=' ')
-    fit_frame    = pd.read_csv(fit_res_file, sep=' ')
-    years = conf.years
-    print('year avg_slope')
-    ch4_emi   = []
-    date_list = []
-    ch4_emi_meas = []
-    slope_list = []
-    for year in years:
-        month_number = 1
-        for month in ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August','September','October','November','December']:
-            
-            monthly_slope    = (fit_frame[(fit_frame['year']==year) & 
-                                      (fit_frame['month']==month)]['slope'].tolist()) # convert from pd.Series to list
-            monthly_emi_co   = (emi_co_frame[(emi_co_frame['year']==year) & 
-                                      (emi_co_frame['month']==month)]['emi[t]'].tolist())
-            monthly_emi_ch4  = (emi_ch4_frame[(emi_ch4_frame['year']==year) & 
-                                      (emi_ch4_frame['month']==month)]['emi[t]'].tolist())
-            
-            if (len(monthly_slope)>0) & (len(monthly_emi_co)>0): # check wether the monthly slope and emission data exist
-                monthly_slope=monthly_slope[0]
-                monthly_emi_co=monthly_emi_co[0]
-                date_list.append(str(year)+'-'+str(month_number)+'-1')
-                monthly_ch4 = monthly_slope * monthly_emi_co * Mch4 / Mco
-                ch4_emi.append( monthly_ch4 )
-                ch4_emi_meas.append(monthly_emi_ch4)
-                slope_list.append(monthly_slope)
-            month_number = month_number+1
-#    date_list = [pd.to_datetime(date) for date in date_list]
-   
+    emi_co_frame = read_emission_inventory(region, 'CO', 'monthly')
+    emi_ch4_frame = read_emission_inventory(region, 'CH4', 'monthly')
+    if fit_store is not None:
+        fit_frame = fit_store.to_frame(fit_table_nm)
+    else:
+        fit_frame = pd.read_csv(fit_res_file, sep=' ')
+    # months with both the fit slope and the CO emission, in time order
+    emi_frame = estimate_ch4_emissions(fit_frame, emi_co_frame, emi_ch4_frame)
+    date_list = (emi_frame['year'].astype(str)+'-'+emi_frame['month_number'].astype(str)+'-1').tolist()
+    ch4_emi, ch4_emi_meas, slope_list = emi_frame['ch4_est'], emi_frame['emi_ch4'], emi_frame['slope']
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots(1,1, figsize = (9,5))
     fig.suptitle('EDGAR measured and predicted emissions for CH$_4$ plus CO-estimated emissions for region '+region+'\nPerformed selections:' + plot_nm_suffix.replace('_',' '))
     #ax.errorbar(emi_ch4_frame['year'], emi_ch4_frame['emi[t]'], emi_ch4_frame['emi_err[t]'], fmt='.', elinewidth=1, capsize=3)
@@ -231,9 +291,10 @@ def eval_ch4_monthly_emis(df, year, month, wd, day_night, region, bads_no_bkg, r
     fig.savefig('./'+conf.stat+'/plot_estimated_emissions/CH4_CO_'+region+'_monthly_estimated_emissions'+plot_nm_suffix+'.pdf', format = 'pdf')
     
     print('output plot: CH4_CO_'+region+'_estimated_emissions'+plot_nm_suffix+'.pdf')
+    return emi_frame
 
     
-def boxplot(df, wd=None, bads_no_bkg=None):
+def boxplot(df, wd=None, bads_no_bkg=None, plots=None):
     """
     create boxplot of monthly CH4, CO and CH4/CO values
 
@@ -245,6 +306,8 @@ def boxplot(df, wd=None, bads_no_bkg=None):
         wind direction selection (e.g. 310-80). The default is None.
     bads_no_bkg : bool
         select between non-bkg (True), bkg (False) and all (None) conditions. The default is None.
+    plots : plf.PlotQueue
+        queue for the deferred rendering of the plot. The default is None, i.e. the plot is drawn immediately
 
     Returns
     -------
@@ -252,9 +315,10 @@ def boxplot(df, wd=None, bads_no_bkg=None):
 
     """
     # df = df[['DateTime','co','ch4','WD','bkg']]
+    episodes = sel.bkg_episodes(df) if (bads_no_bkg!=None) & (conf.stat=='CMN') else None # bkg episodes before the wd selection
     df = sel.select_wd(df, wd)
     if (bads_no_bkg!=None) & (conf.stat=='CMN'):
-       df = sel.select_non_bkg(df,bads_no_bkg) 
+       df = sel.select_non_bkg(df,bads_no_bkg,episodes=episodes) 
     df=df.set_index('DateTime')
     df = df[df['ch4']<4000]
     df.insert(3,'ch4_co', df['ch4']/df['co'])
@@ -262,29 +326,6 @@ def boxplot(df, wd=None, bads_no_bkg=None):
     df.index = df.index.date - pd.offsets.MonthBegin(1) # riporta tutto al primo giorno del mese
     df.insert(1,'month',df.index.strftime('%Y-%m')) # insert month column for the boxplot
     
-    plt.style.use('seaborn-white')
-    plt.rc('font', size=30) #controls default text size
-
-    fig,ax = plt.subplots(3,1, figsize=(20,20))
-    cols = ['ch4','co','ch4_co']
-    colors = ['#70a1c2', '#aab16b', '#a17a8d']
-    labels = ['CH$_4$ [ppb]', 'CO [ppb]', 'CH$_4$/CO [-]']
-    myLocator = mticker.MultipleLocator(3)
-    mylocator = mticker.MultipleLocator(1)
-
-    for i in range(len(cols)):
-        seaborn.boxplot(ax=ax[i],x='month', y = cols[i], data=df, color=colors[i], showfliers=True) 
-        #seaborn.swarmplot(ax=ax[i],x='month', y = cols[i], data=df, color='.25') 
-
-        ax[i].grid(which='both') 
-        ax[i].set_ylabel(labels[i])
-        ax[i].xaxis.set_major_locator(myLocator)
-        ax[i].xaxis.set_minor_locator(mylocator)
-
-    ax[2].set_xlabel('')       
-    fig.autofmt_xdate(rotation=45)
-    
-    
     title = 'Monthly CH$_4$ and CO Concentrations and CH$_4$/CO Ratio at '+conf.stat+'\n'
     filename_str=''
     if wd!=None:
@@ -298,12 +339,13 @@ def boxplot(df, wd=None, bads_no_bkg=None):
         title = title + '  during bkg conditions'
         filename_str=filename_str+'bkg'
 
-    fig.subplots_adjust(hspace=0.1)
-    fig.suptitle(title, fontsize=30)
-    plt.savefig('./'+conf.stat+'/boxplot_'+conf.stat+'_'+filename_str+'.pdf', format = 'pdf')   
-    rcParams.update(rcParamsDefault)
+    data = dict(title=title, month=df['month'].to_numpy(), ch4=df['ch4'].to_numpy(), co=df['co'].to_numpy(), ch4_co=df['ch4_co'].to_numpy())
+    if plots is not None: # deferred plotting
+        plots.add('boxplot', './'+conf.stat+'/boxplot_'+conf.stat+'_'+filename_str+'.pdf', **data)
+    else:
+        plf.render('boxplot', './'+conf.stat+'/boxplot_'+conf.stat+'_'+filename_str+'.pdf', data)
 
-def fit_season_emissions(df, wd=None, bads_no_bkg=None):
+def fit_season_emissions(df, wd=None, bads_no_bkg=None, plots=None):
     """
     Provide a plot with the mean seasonal cycle over the analyzed years plus results from a sinusoidal fit.
     Parameters
@@ -314,14 +356,17 @@ def fit_season_emissions(df, wd=None, bads_no_bkg=None):
         wind direction selection (e.g. 310-80). The default is None.
     bads_no_bkg : bool
         select between non-bkg (True), bkg (False) and all (None) conditions. The default is None.
+    plots : plf.PlotQueue
+        queue for the deferred rendering of the plot. The default is None, i.e. the plot is drawn immediately
     Returns
     -------
     None
     """
     # select WD and bkg
+    episodes = sel.bkg_episodes(df) if (bads_no_bkg!=None) & (conf.stat=='CMN') else None # bkg episodes before the wd selection
     df = sel.select_wd(df, wd)
     if (bads_no_bkg!=None) & (conf.stat=='CMN'):
-       df = sel.select_non_bkg(df,bads_no_bkg) 
+       df = sel.select_non_bkg(df,bads_no_bkg,episodes=episodes) 
     df=df.set_index('DateTime')
     df = df[df['ch4']<4000]
     df.insert(3,'ch4_co', df['ch4']/df['co'])
@@ -340,8 +385,8 @@ def fit_season_emissions(df, wd=None, bads_no_bkg=None):
     
     
     # fit
-    def sin_fun(x,a,b,c):
-        return a*np.sin(b*x)+c
+    from scipy.optimize import curve_fit as cf
+    sin_fun = plf.sin_fun
     p_opt = [[]for i in range(3)]
     p_cov = [[]for i in range(3)]
 
@@ -352,32 +397,6 @@ def fit_season_emissions(df, wd=None, bads_no_bkg=None):
         i=i+1
        
     # plot results
-    
-    fig,ax=plt.subplots(3,1, figsize=(7,7))
-    point_size=30
-    ax[0].scatter(months, mean_co, color='C0', s=point_size)
-    ax[0].set_ylim(0.8*min(mean_co), 1.2*max(mean_co))
-    ax[0].set_ylabel('CO [ppb]')
-    ax[0].plot(months,sin_fun(months,*p_opt[0]), c='C0')
-    
-    ax[1].scatter(months, mean_ch4, color='C1', s=point_size)
-    ax[1].set_ylim(0.99*min(mean_ch4), 1.01*max(mean_ch4))
-    ax[1].set_ylabel('CH$_4$ [ppb]')
-    ax[1].plot(months,sin_fun(months,*p_opt[1]), c='C1')
-
-    ax[2].scatter(months, mean_ratio, color='C2', s=point_size)
-    ax[2].set_ylim(0.8*min(mean_ratio), 1.2*max(mean_ratio))
-    ax[2].set_ylabel('CH$_4$/CO [-]')
-    ax[2].plot(months,sin_fun(months,*p_opt[2]), c='C2')
-
-    xlabels=['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug','Sep','Oct','Nov','Dec']
-    
-    for axis in ax:
-        axis.set_xticks(months)
-        axis.grid()
-    ax[2].set_xticklabels(xlabels)
-    fig.autofmt_xdate(rotation=45)
-    
     title = 'Monthly mean CH$_4$ and CO Concentrations and CH$_4$/CO Ratio at '+conf.stat+'\nover the period '+str(conf.years[0])+'-'+str(conf.years[-1])
     filename_str=''
     if wd!=None:
@@ -390,8 +409,11 @@ def fit_season_emissions(df, wd=None, bads_no_bkg=None):
     if (bads_no_bkg==False) & (conf.stat=='CMN'):
         title = title + '  during bkg conditions'
         filename_str=filename_str+'bkg'
-    fig.suptitle(title)
-    plt.savefig('./'+conf.stat+'/fit_'+conf.stat+'_'+filename_str+'.png')   
+    data = dict(title=title, mean_co=mean_co, mean_ch4=mean_ch4, mean_ratio=mean_ratio, p_opt=[list(p) for p in p_opt])
+    if plots is not None: # deferred plotting
+        plots.add('season_fit', './'+conf.stat+'/fit_'+conf.stat+'_'+filename_str+'.png', **data)
+    else:
+        plf.render('season_fit', './'+conf.stat+'/fit_'+conf.stat+'_'+filename_str+'.png', data)
         
 
 
@@ -420,6 +442,7 @@ def eval_ch4_emi_compact(stations, regions, year, month, season, wd, day_night,
             }
         }
         
+    import matplotlib.pyplot as plt
     plt.style.use('ggplot')
     fig, ax = plt.subplots(1,len(stations), figsize = (3*len(stations),5))
    
@@ -548,38 +571,45 @@ def eval_ch4_emi_compact(stations, regions, year, month, season, wd, day_night,
 
             
         
-def daily_ratio(df):
-    days = df['DateTime'].dt.date.drop_duplicates()
-    coeff_frame = pd.DataFrame({'DateTime':[],'coeff':[],'intercept':[]})
-
-    for today in days[1:-1]:
-        yesterday = today-dt.timedelta(days=1)
-        df_daily = df[(df['DateTime'].dt.date == today) | (df['DateTime'].dt.date == yesterday)].copy()
-
-        df_daytime   =  df_daily[(df_daily['DateTime'].dt.date==today) & (df_daily['DateTime'].dt.hour>=8) & (df_daily['DateTime'].dt.hour<20)] # daily time of day
-        df_nighttime =  df_daily[((df_daily['DateTime'].dt.date==yesterday) & (df_daily['DateTime'].dt.hour>=20) & (df_daily['DateTime'].dt.hour<24) )| 
-                                 ((df_daily['DateTime'].dt.date==today) &(df_daily['DateTime'].dt.hour>=0) & (df_daily['DateTime'].dt.hour<8))]
-        for frame in [df_nighttime, df_daytime]:
-            if (len(df_daytime)>10) & (len(df_nighttime)>10):
-                _, _, thsen_res = lrf.ortho_lin_regress(frame['co'], frame['ch4'], frame['Stdev_co'], frame['Stdev_ch4'])
-
-                coeff_frame.loc[len(coeff_frame.index)] = [frame['DateTime'].iat[0], 
-                                                               thsen_res.coef_[0], thsen_res.intercept_]
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+def daily_ratio(df, write=True):
+    """
+    Evaluate the daily CH4:CO ratio with Theil-Sen fits over the nighttime (20-8) and daytime (8-20) windows of each day.
+    Each row is assigned once to a 'night-of' or 'day-of' key (the night between day d-1 and day d belongs to day d), 
+    then all the windows are fitted in a single batched Theil-Sen call
 
-    
+    Parameters
+    ----------
+    df : DataFrame
+        input dataframe with 'DateTime', 'co' and 'ch4' columns, sorted by DateTime
+    write : bool
+        write the results to ./<stat>/res_fit/daily_ratio.csv. The default is True
+
+    Returns
+    -------
+    coeff_frame : DataFrame
+        frame with the 'DateTime' of the first point of each window, the Theil-Sen 'coeff' and 'intercept'. For each day
+        the nighttime window precedes the daytime one. Days where one of the windows has less than 11 points are skipped,
+        as are the first and last day of the dataset
+    """
+    hour  = df['DateTime'].dt.hour.to_numpy()
+    daytime = (hour>=8) & (hour<20)
+    days = df['DateTime'].dt.normalize()
+    day_key = np.where(daytime, days, (df['DateTime'] + pd.Timedelta(hours=4)).dt.normalize()) # moves 20-24 of day d-1 to day d
+    keys = pd.DataFrame({'day': day_key, 'window': daytime.astype(int), 'pos': np.arange(len(df))}) # window: 0=night, 1=day
+    
+    first_day, last_day = days.iat[0], days.iat[-1]
+    keys = keys[(keys['day'] > first_day) & (keys['day'] < last_day) & keys['day'].isin(days)]
+    
+    windows = keys.groupby(['day', 'window'], sort=True)['pos']
+    counts = windows.size().unstack(fill_value=0).reindex(columns=[0,1], fill_value=0)
+    valid_days = counts.index[(counts[0]>10) & (counts[1]>10)]
+    
+    rows = [pos.to_numpy() for (day, window), pos in windows if day in valid_days]
+    co, ch4 = df['co'].to_numpy(), df['ch4'].to_numpy()
+    slopes, intercepts = lrf.batch_theil_sen([co[r] for r in rows], [ch4[r] for r in rows])
+    coeff_frame = pd.DataFrame({'DateTime' : df['DateTime'].to_numpy()[[r[0] for r in rows]] if len(rows)>0 else [],
+                                'coeff'    : slopes,
+                                'intercept': intercepts})
+    if write:
+        coeff_frame.to_csv('./'+conf.stat+'/res_fit/daily_ratio.csv', index=False)
+    return coeff_frame
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:36 2026
+
+@author: cosimo
+"""
+######################################################################################
+######        Headless fit-only run of the station defined in config.py         ######
+######################################################################################
+# usage: python fit_only.py [--workers N] [--stream [--chunk-rows N]] [--trace FILE] [--profile {cprofile,pyinstrument}]
+# performs the selections of FIT_CONFIGS and writes the fit results tables to ./<stat>/res_fit/ without plotting. No
+# plotting library is imported (neither by this script nor by the modules it uses), which keeps the start-up time low
+# for scheduled runs. With --trace the timers and counters of the pipeline stages are written to FILE (JSON or CSV, see
+# instrument_functions)
+
+import argparse
+import sys
+import config as conf
+import dataset_functions as dsf
+import selection_functions as sel
+import parallel_functions as pf
+import stream_functions as sf
+import instrument_functions as instr
+from results_functions import FitResultsStore
+
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'plotly']
+
+# selections performed by the fit-only run (see parallel_functions.get_config())
+FIT_CONFIGS = [{'month': False, 'season': False, 'robustness': False},
+               {'month': True,  'season': False, 'robustness': True},
+               {'month': False, 'season': True,  'robustness': True}]
+
+def run_fits(configs=None, max_workers=1, use_cache=True, stream=False, chunk_rows=sf.STREAM_CHUNK_ROWS):
+    """
+    run the selections and fits of the station defined in the config file without plotting
+
+    Parameters
+    ----------
+    configs: list of dict
+        selection configurations. The default is None, i.e. FIT_CONFIGS. The 'plot' option is always set to False
+    max_workers: int
+        number of worker processes. With max_workers==1 (default) the fits are performed serially in this process
+    use_cache: bool
+        read and write the cached merged DataFrame. The default is True
+    stream: bool
+        out-of-core run: the input files are streamed in chunks and each month is fitted as soon as it is complete
+        (see stream_functions.stream_select_and_fit()). max_workers and use_cache are ignored. The default is False
+    chunk_rows: int
+        rows read at once from each file in the out-of-core run. The default is sf.STREAM_CHUNK_ROWS
+
+    Returns
+    -------
+    store: FitResultsStore
+        store with the fit results tables (already flushed to ./<stat>/res_fit/)
+    """
+    if configs is None:
+        configs = FIT_CONFIGS
+    configs = [dict(pf.get_config(config), plot=False) for config in configs]
+    if stream:
+        return sf.stream_select_and_fit(configs, chunk_rows=chunk_rows)
+    data_frame = dsf.load_data_frame(use_cache=use_cache)
+    bg_cols = ['bkg'] if 'bkg' in data_frame.columns else []
+    co_ch4_frame = data_frame[['co', 'ch4', 'Stdev_co', 'Stdev_ch4', 'DateTime', 'WD'] + bg_cols]
+    if max_workers != 1:
+        return pf.parallel_select_and_fit(co_ch4_frame, configs, max_workers=max_workers)
+
+    store = FitResultsStore()
+    for config in configs:
+        sel.select_and_fit(co_ch4_frame, year=True, month=config['month'], season=config['season'], wd=config['wd'],
+                           day_night=config['day_night'], plot=False, bads_no_bkg=config['bads_no_bkg'],
+                           robustness=config['robustness'], batch_robustness=config['batch_robustness'],
+                           seed=config['seed'], store=store)
+    store.flush()
+    return store
+
+def loaded_plotting_modules():
+    """ plotting libraries imported so far by the running process """
+    return [module for module in PLOTTING_MODULES if module in sys.modules]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit-only run of the station '+conf.stat+' (no plots)')
+    parser.add_argument('--workers',  type=int, default=1, help='number of worker processes (default: 1, serial run)')
+    parser.add_argument('--no-cache', action='store_true', help='rebuild the merged DataFrame without using the cache')
+    parser.add_argument('--stream',   action='store_true', help='out-of-core run: stream the input files and fit each month as soon as it is complete')
+    parser.add_argument('--chunk-rows', type=int, default=sf.STREAM_CHUNK_ROWS, help='rows read at once from each file with --stream')
+    parser.add_argument('--trace',    default=None, help='write the timers and counters of the pipeline stages to this file (.json or .csv)')
+    parser.add_argument('--profile',  default=None, choices=['cprofile', 'pyinstrument'], help='profile each select_and_fit() call (profiles in ./<stat>/profile/)')
+    args = parser.parse_args()
+    if args.trace is not None:
+        conf.instrument = True
+        instr.reset()
+    if args.profile is not None:
+        conf.profile = args.profile
+    store = run_fits(max_workers=args.workers, use_cache=not args.no_cache, stream=args.stream, chunk_rows=args.chunk_rows)
+    for table_filenm in store.tables:
+        print(table_filenm + ': ' + str(len(store.records(table_filenm))) + ' fits')
+    if args.trace is not None:
+        instr.export(args.trace)
+        print('trace written to ' + args.trace)
+    if loaded_plotting_modules():
+        print('WARNING: plotting modules imported by the fit-only run: ' + ', '.join(loaded_plotting_modules()))
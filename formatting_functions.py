@@ -10,7 +10,13 @@ Created on Wed Oct 13 11:41:45 2021
 
 import pandas as pd
 import datetime as dt
+import os
 import config as conf
+import instrument_functions as instr
+
+CMN_2018_FILE     = './L2_ICOS_data/Dati_CMN_201801-05/2018_CMN.dat'              # CMN data from jan 2018 to may 2018 (not ICOS official data)
+CMN_2018_MET_FILE = './L2_ICOS_data/Dati_CMN_201801-05/meteo/meteo_201801-05.dat'
+BASELINE_FILE     = './BaDS_baseline/2018-2021_co2_BaDSfit_annual_selection_var_intermedie_5_5_5_flag5.csv'
 
 def get_month_str(month_number):
     """ get month string from a given month number """
@@ -30,13 +36,82 @@ def read_L2_ICOS(file_path, file_name):
         line = file.readline() # read the 5th line to get the header lines number
     head_nlines = int(line.split(' ')[3]) # get the number of header lines
     file.close()
-    out_frame = pd.read_csv(file_path+file_name, sep=';', skiprows = head_nlines-1)
+    with instr.stage('read_L2_ICOS', bytes_read=os.path.getsize(file_path+file_name)) as record:
+        out_frame = pd.read_csv(file_path+file_name, sep=';', skiprows = head_nlines-1)
+        record['rows_out'] = len(out_frame)
+    return out_frame
+
+# dtypes of the ICOS L2/NRT CTS columns that are used by the pipeline
+ICOS_L2_SCHEMA = {'#Site' : 'category',
+                  'Year'  : 'int16',
+                  'Month' : 'int8',
+                  'Day'   : 'int8',
+                  'Hour'  : 'int8',
+                  'Minute': 'int8',
+                  'ch4'   : 'float64',
+                  'co'    : 'float64',
+                  'Stdev' : 'float32',
+                  'Flag'  : 'category',
+                  'WD'    : 'float32',
+                  'WD-Flag': 'category'}
+
+_header_cache = {} # (file, mtime, size) -> (number of header lines, column names)
+
+try: # the pyarrow csv engine is used when available
+    import pyarrow
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+def read_L2_header(file_nm):
+    """
+    get number of header lines and column names of an ICOS L2 file. The result is cached for each version 
+    (mtime and size) of the file so that the header is parsed only once
+    """
+    stat = os.stat(file_nm)
+    key = (file_nm, stat.st_mtime_ns, stat.st_size)
+    if key not in _header_cache:
+        file = open(file_nm, 'r')
+        for i in range(5): 
+            line = file.readline() # read the 5th line to get the header lines number
+        head_nlines = int(line.split(' ')[3]) # get the number of header lines
+        for i in range(head_nlines-5):
+            line = file.readline() # the last header line contains the column names
+        file.close()
+        _header_cache[key] = (head_nlines, line.strip().split(';'))
+    return _header_cache[key]
+
+def read_L2_ICOS_fast(file_path, file_name, engine=None):
+    """ 
+    read L2 ICOS data returning a dataframe. Faster and lighter version of read_L2_ICOS(): only the columns in 
+    ICOS_L2_SCHEMA are read, with the dtypes defined in ICOS_L2_SCHEMA
+    
+    Parameters
+    ---------
+    file_path, file_name: str
+        path and name of the ICOS L2 file
+    engine: str
+        pandas csv engine. The default is None, i.e. CSV_ENGINE ('pyarrow' if available, 'c' otherwise)
+
+    Returns
+    ---------
+    out_frame: DataFrame
+    """
+    if engine is None:
+        engine = CSV_ENGINE
+    head_nlines, columns = read_L2_header(file_path+file_name)
+    usecols = [i for i in range(len(columns)) if columns[i] in ICOS_L2_SCHEMA]
+    # the header line is skipped and the column names are set from the cached header (needed by the pyarrow engine)
+    with instr.stage('read_L2_ICOS_fast', bytes_read=os.path.getsize(file_path+file_name)) as record:
+        out_frame = pd.read_csv(file_path+file_name, sep=';', skiprows = head_nlines, header=None, usecols=usecols, engine=engine)
+        out_frame.columns = [columns[i] for i in usecols]
+        out_frame = out_frame.astype({col: ICOS_L2_SCHEMA[col] for col in out_frame.columns})
+        record['rows_out'] = len(out_frame)
     return out_frame
 
 def append_2018(frame_CH4, frame_CO, MET_frame):
     """ add data from jan 2018 to may 2018 (not ICOS official data) """
-    data_path = './L2_ICOS_data/Dati_CMN_201801-05/2018_CMN.dat'
-    df = pd.read_csv(data_path, sep =' ', parse_dates={'DateTime':['DATE','TIME']}, usecols=['DATE','TIME','CO', 'CH4_cal'])
+    df = pd.read_csv(CMN_2018_FILE, sep =' ', parse_dates={'DateTime':['DATE','TIME']}, usecols=['DATE','TIME','CO', 'CH4_cal'])
     df['DateTime']=pd.to_datetime(df['DateTime'], format="%Y-%m-%d %H:%M:%S")
     df = df.rename(columns={'CH4_cal':'ch4','CO':'co' })
     df['co']=1000*df['co'] # convert to ppb
@@ -51,7 +126,7 @@ def append_2018(frame_CH4, frame_CO, MET_frame):
     df_ch4['#Site']='CMN'
     df_co['#Site']='CMN'
     
-    df_met = pd.read_csv('./L2_ICOS_data/Dati_CMN_201801-05/meteo/meteo_201801-05.dat', sep=' ', parse_dates={'DateTime':['YYYY','MM','DD','HH','MIN']}, usecols=['YYYY','MM','DD','HH','MIN','wd(deg)'])
+    df_met = pd.read_csv(CMN_2018_MET_FILE, sep=' ', parse_dates={'DateTime':['YYYY','MM','DD','HH','MIN']}, usecols=['YYYY','MM','DD','HH','MIN','wd(deg)'])
     df_met = df_met.rename(columns={'wd(deg)':'WD'})
     df_met['DateTime'] = pd.to_datetime(df_met['DateTime'], format = '%Y %m %d %H %M')
     df_met = df_met.resample('1H', on='DateTime').mean()
@@ -79,15 +154,37 @@ def get_baseline(spec):
         frame containing the datetime and the baseline columns
     ---------
     """    
-    bsl_col_name = spec+'_cmn_mm' # name of the baseline column
-    df = pd.read_csv('./BaDS_baseline/2018-2021_co2_BaDSfit_annual_selection_var_intermedie_5_5_5_flag5.csv', sep = ',', usecols = ['date', bsl_col_name])
-    df.insert(1,'DateTime', pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S')) # add datetime column
+    return get_baselines([spec])
+
+def get_baselines(specs=['ch4', 'co']):
+    """
+    read the baselines of several species from the baseline file with a single read_csv and datetime parsing
+
+    Parameters
+    ---------
+    specs: list of str
+        chem species to extract the baselines. The default is ['ch4', 'co']
+
+    Returns
+    out_frame: DataFrame
+        frame containing the datetime and the <spec>_baseline columns
+    ---------
+    """
+    bsl_col_names = [spec+'_cmn_mm' for spec in specs] # name of the baseline columns
+    with instr.stage('read_baselines', bytes_read=os.path.getsize(BASELINE_FILE)):
+        df = pd.read_csv(BASELINE_FILE, sep = ',', usecols = ['date'] + bsl_col_names)
+        df.insert(1,'DateTime', pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S')) # add datetime column
     del df['date']  # remove old date column
     df = df[df['DateTime'] < dt.datetime(2021,1,1,0,0,0)] # remove data from 2021
-    df = df.rename(columns={bsl_col_name:spec+'_baseline'}) # rename baseline column
+    df = df.rename(columns={spec+'_cmn_mm':spec+'_baseline' for spec in specs}) # rename baseline columns
+
+    return df[['DateTime'] + [spec+'_baseline' for spec in specs]]
 
-    return df
+def get_BADS_filenm():
+    """ name of the BaDS results file of the station defined in the config file """
+    return conf.bads_filenm
 
+@instr.timed('read_BADS')
 def read_BADS_frame():
     """
     read the BaDS results frame and add a bkg column
@@ -99,7 +196,7 @@ def read_BADS_frame():
     specie = conf.non_bkg_specie # define wether to perform selection on co2, co or ch4. Can be either 'co2' or 'co+ch4'
     if specie == 'co2':
         bkg_cols = ['co2_bg2'] # name of the background column
-        df = pd.read_csv('./BaDS_baseline/'+conf.stat+'_2018-2021_BaDSfit_annual_selection_n_5-2-5_mar22.csv', sep = ',', usecols = ['date'] + bkg_cols, parse_dates = {'DateTime' : ['date']}, na_values='NA')    
+        df = pd.read_csv(get_BADS_filenm(), sep = ',', usecols = ['date'] + bkg_cols, parse_dates = {'DateTime' : ['date']}, na_values='NA')    
         df.insert(len(df.columns), 'bkg', False)
         df.loc[ df['co2_bg2'] > 0 , 'bkg'] = True
     
@@ -108,7 +205,7 @@ def read_BADS_frame():
             print('ERROR: no CO or CH4 bads results at LMP')
             os.sys.exit()
         bkg_cols = ['co_bg2', 'ch4_bg2'] # name of the background column
-        df = pd.read_csv('./BaDS_baseline/'+conf.stat+'_2018-2021_BaDSfit_annual_selection_n_5-2-5_mar22.csv', sep = ',', usecols = ['date'] + bkg_cols, parse_dates = {'DateTime' : ['date']}, na_values='NA')    
+        df = pd.read_csv(get_BADS_filenm(), sep = ',', usecols = ['date'] + bkg_cols, parse_dates = {'DateTime' : ['date']}, na_values='NA')    
         #df = df[df['DateTime'] < dt.datetime(2021,1,1,0,0,0)] # remove data from 2021
         df.insert(len(df.columns), 'bkg', False)
         df.loc[ (df['co_bg2'] >0) & (df['ch4_bg2']>0) , 'bkg'] = True
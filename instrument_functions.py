@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 11:05:37 2026
+
+@author: cosimo
+"""
+######################################################################################
+######        Timers, counters and profiling hooks of the pipeline stages       ######
+######################################################################################
+# With conf.instrument = True each pipeline stage (file reading, merges, selections, fits, robustness test, table
+# writing, plotting) is timed with a named timer and records counters such as rows in and out, bytes read, number of
+# fits and robustness iterations. Events are kept in memory and exported as a JSON or CSV trace of the run:
+#
+#   conf.instrument = True
+#   instr.reset()
+#   ... run the pipeline ...
+#   instr.export('./CMN/trace.json')   # or trace.csv
+#
+# With conf.instrument = False (default) stage() returns a shared no-op context and count() returns at once, so the
+# overhead is one attribute lookup per call.
+# With conf.profile = 'cprofile' or 'pyinstrument' each select_and_fit() call runs under the profiler and the profile is
+# written to ./<stat>/profile/ (pyinstrument is optional: cProfile is used if it is not installed)
+
+import contextlib
+import csv
+import functools
+import json
+import os
+import time
+import config as conf
+
+class _NullRecord(dict):
+    """ counters record of the disabled stages: writes are ignored """
+    def __setitem__(self, key, value):
+        pass
+
+_NULL_STAGE = contextlib.nullcontext(_NullRecord())
+
+class Trace:
+    """
+    Events and counters of a run. Each event is a dict with the stage 'name', its 'start' time [s from the beginning of
+    the trace], its duration 'seconds', the nesting 'depth' and the counters recorded by the stage
+    """
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.events = []
+        self.counters = {} # global counters (see count())
+        self.depth = 0
+
+    def summary(self):
+        """ dict name -> {'calls', 'seconds' and the sum of each counter} of the events with the same name """
+        out = {}
+        for event in self.events:
+            entry = out.setdefault(event['name'], {'calls': 0, 'seconds': 0.})
+            entry['calls'] = entry['calls'] + 1
+            for key, value in event.items():
+                if key in ['name', 'start', 'depth']:
+                    continue
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    entry[key] = entry.get(key, 0) + value
+        for entry in out.values():
+            entry['seconds'] = round(entry['seconds'], 6)
+        return out
+
+_trace = Trace()
+
+def reset():
+    """ start a new trace """
+    global _trace
+    _trace = Trace()
+
+def get_trace():
+    """ current Trace """
+    return _trace
+
+@contextlib.contextmanager
+def _timed_stage(name, counters):
+    record = dict(counters)
+    _trace.depth = _trace.depth + 1
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        end = time.perf_counter()
+        _trace.depth = _trace.depth - 1
+        event = {'name': name, 'start': round(start - _trace.t0, 6), 'seconds': round(end - start, 6), 'depth': _trace.depth}
+        event.update(record)
+        _trace.events.append(event)
+
+def stage(name, **counters):
+    """
+    context manager that times a pipeline stage. It yields a dict where the stage can add its counters (e.g.
+    record['rows_out'] = len(df)); initial counters can be given as keyword arguments (e.g. rows_in=len(df))
+
+    usage:
+        with instr.stage('merge', rows_in=len(df)) as record:
+            ...
+            record['rows_out'] = len(out_df)
+    """
+    if not conf.instrument:
+        return _NULL_STAGE
+    return _timed_stage(name, counters)
+
+def count(name, value=1):
+    """ increase a global counter of the trace (e.g. count('fits')) """
+    if conf.instrument:
+        _trace.counters[name] = _trace.counters.get(name, 0) + value
+
+def timed(name=None):
+    """ decorator that runs a function inside stage(name) (name defaults to the function name) """
+    def decorator(func):
+        stage_name = name if name is not None else func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not conf.instrument:
+                return func(*args, **kwargs)
+            with _timed_stage(stage_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def export(filenm):
+    """
+    write the trace of the run to filenm: JSON (events, summary and global counters) if filenm ends with .json, CSV
+    (one row per event, counters as columns) otherwise
+    """
+    os.makedirs(os.path.dirname(filenm) or '.', exist_ok=True)
+    if filenm.endswith('.json'):
+        file = open(filenm, 'w')
+        json.dump({'stat': conf.stat, 'total_seconds': round(time.perf_counter() - _trace.t0, 6), 'counters': _trace.counters,
+                   'summary': _trace.summary(), 'events': _trace.events}, file, indent=1, default=str)
+        file.close()
+    else:
+        columns = ['name', 'start', 'seconds', 'depth']
+        for event in _trace.events:
+            columns = columns + [key for key in event if key not in columns]
+        file = open(filenm, 'w', newline='')
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        for event in _trace.events:
+            writer.writerow(event)
+        file.close()
+
+_profile_calls = {} # number of profiled calls of each function (used in the profile file names)
+
+def profiled(func):
+    """
+    decorator that runs a function under the profiler selected by conf.profile ('cprofile' or 'pyinstrument', None to
+    disable) and writes the profile of each call to ./<stat>/profile/<function>_<n>.prof (cProfile, readable with
+    pstats or snakeviz) or .html (pyinstrument)
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not conf.profile:
+            return func(*args, **kwargs)
+        n = _profile_calls.get(func.__name__, 0) + 1
+        _profile_calls[func.__name__] = n
+        out_dir = './'+conf.stat+'/profile/'
+        os.makedirs(out_dir, exist_ok=True)
+        pyinstrument = None
+        if conf.profile == 'pyinstrument':
+            try: # optional sampling profiler
+                import pyinstrument
+            except ImportError:
+                print('WARNING: pyinstrument is not installed, cProfile is used')
+        if pyinstrument is not None:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.stop()
+                file = open(out_dir + func.__name__ + '_' + str(n) + '.html', 'w')
+                file.write(profiler.output_html())
+                file.close()
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                profiler.dump_stats(out_dir + func.__name__ + '_' + str(n) + '.prof')
+    return wrapper
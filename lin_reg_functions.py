@@ -9,27 +9,373 @@ Created on Tue Oct 12 15:11:39 2021
 ######            Functions for the linear_regression.py script                 ######
 ######################################################################################
 
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.odr as odr
-from scipy.stats import linregress
 from os import path
 import formatting_functions as fmt
 import config as conf
 from math import isnan
+from results_functions import FitRecord, format_fit_line
+import plot_functions as plf
+import cache_functions as cache
+import instrument_functions as instr
+# matplotlib is imported only when a plot is drawn (see plot_functions) and scipy.stats and scipy.odr (slow to import) only when
+# they are used, so that headless runs and modules that only use the Theil-Sen helpers do not pay their import time
 
+THSEN_ESTIMATOR  = 'median' # Theil-Sen estimator: 'median' (median of the pairwise slopes) or 'spatial_median' (same results of sklearn's TheilSenRegressor, slower)
+THSEN_EXACT_MAX  = 1500    # 'median': windows up to this length use all the n(n-1)/2 pairwise slopes
+THSEN_N_RANDOM   = 200000  # 'median': number of random pairs used to estimate the median slope on larger windows
+THSEN_N_PAIRS    = 10000   # 'spatial_median': max number of pairs (max_subpopulation of sklearn): larger windows use this many random pairs
+THSEN_MAX_ITER   = 1000    # 'spatial_median': max number of iterations of the spatial median
+THSEN_TOL        = 1e-3    # 'spatial_median': tolerance of the spatial median
+THSEN_CHUNK_SIZE = 2e6     # max number of pairwise solutions held in memory at once in the batched fits
+YORK_TOL         = 1e-12   # relative tolerance on the slope of the iterative York fit
+YORK_MAX_ITER    = 100     # max number of iterations of the York fit
+ODR_SOLVER       = 'york'  # errors-in-variables solver of ortho_lin_regress(): 'york' (batch_york_fit()) or 'odrpack' (scipy.odr)
 
+class TheilSenResult:
+    """
+    Result of a 1-D Theil-Sen fit. Exposes the coef_, intercept_ and predict() attributes of the fitted
+    sklearn TheilSenRegressor so that it can be used in place of it
+    """
+    def __init__(self, slope, intercept):
+        self.coef_ = np.array([slope])
+        self.intercept_ = intercept
+
+    def predict(self, x):
+        return self.coef_[0] * np.asarray(x).reshape(len(x), -1)[:, 0] + self.intercept_
+
+def _clean_xy(x, y):
+    """ return x and y as float arrays without the non finite couples """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.isfinite(x) & np.isfinite(y)
+    return x[valid], y[valid]
+
+_EPSILON = np.finfo(np.double).eps
+
+def _pair_indices(n, n_pairs, seed):
+    """
+    couples of points of a Theil-Sen fit on n points, as in sklearn's TheilSenRegressor: all the n(n-1)/2 couples if
+    they are no more than n_pairs, otherwise n_pairs random couples drawn with the same random sequence of
+    TheilSenRegressor(random_state=seed)
+    """
+    if n*(n-1)//2 <= n_pairs:
+        return np.triu_indices(n, 1)
+    random_state = np.random.RandomState(seed)
+    pairs = np.array([random_state.choice(n, size=2, replace=False) for k in range(n_pairs)])
+    return pairs[:, 0], pairs[:, 1]
 
-from sklearn.linear_model import (
-    LinearRegression,
-    TheilSenRegressor,
-    RANSACRegressor,
-    HuberRegressor,
-)
-from sklearn.metrics import mean_squared_error
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.pipeline import make_pipeline
+def _pair_solutions(x, y, i, j):
+    """
+    (intercept, slope) of the lines through the couples (i, j). Couples with equal x get the minimum norm least squares
+    solution of a + b*x = mean(y), as returned by lstsq in sklearn
+    """
+    dx = x[j] - x[i]
+    same = dx == 0
+    slopes = (y[j] - y[i]) / np.where(same, 1., dx)
+    intercepts = y[i] - slopes * x[i]
+    y_mean = 0.5 * (y[i] + y[j])
+    norm = 1. + x[i]**2
+    return np.where(same, y_mean / norm, intercepts), np.where(same, y_mean * x[i] / norm, slopes)
+
+def _batch_spatial_median(points, valid, max_iter=THSEN_MAX_ITER, tol=THSEN_TOL):
+    """
+    spatial median of each group of 2-D points with the modified Weiszfeld iterations of sklearn (_spatial_median()).
+    points is a (n_groups, n_points, 2) array padded with the valid mask; all the groups are iterated together and each
+    group stops as soon as its update is smaller than tol
+    """
+    n_valid = valid.sum(axis=1)
+    old = (points * valid[:, :, np.newaxis]).sum(axis=1) / n_valid[:, np.newaxis] # start from the mean
+    out = old.copy()
+    active = np.arange(len(points))
+    for n_iter in range(max_iter):
+        p, v, x_old = points[active], valid[active], old[active]
+        diff = p - x_old[:, np.newaxis, :]
+        diff_norm = np.sqrt((diff**2).sum(axis=2))
+        mask = v & (diff_norm >= _EPSILON)
+        is_x_old_in_x = (mask.sum(axis=1) < n_valid[active]).astype(float) # x_old equals one of the points
+        inv_norm = np.where(mask, 1. / np.where(mask, diff_norm, 1.), 0.)
+        quotient_norm = np.sqrt(((diff * inv_norm[:, :, np.newaxis]).sum(axis=1)**2).sum(axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_direction = (p * inv_norm[:, :, np.newaxis]).sum(axis=1) / inv_norm.sum(axis=1)[:, np.newaxis]
+        degenerate = ~(quotient_norm > _EPSILON) # avoid division by zero
+        new_direction[degenerate] = 1.
+        quotient_norm[degenerate] = 1.
+        ratio = (is_x_old_in_x / quotient_norm)[:, np.newaxis]
+        x_new = np.maximum(0., 1. - ratio) * new_direction + np.minimum(1., ratio) * x_old
+        converged = ((x_old - x_new)**2).sum(axis=1) < tol**2
+        out[active] = x_new
+        old[active] = x_new
+        active = active[~converged]
+        if len(active) == 0:
+            break
+    return out
 
+def batch_spatial_median_theil_sen(x_groups, y_groups, n_pairs=THSEN_N_PAIRS, seed=42, max_iter=THSEN_MAX_ITER, tol=THSEN_TOL):
+    """
+    Perform a 1-D Theil-Sen regression over many (x, y) groups in one call, with the same estimator of sklearn's
+    TheilSenRegressor(random_state=seed, max_iter=max_iter): (intercept, slope) is the spatial median of the
+    solutions of the lines through the couples of points of the group (see _pair_indices() and _pair_solutions()).
+    The pairwise solutions of the groups are padded and their spatial medians are computed together. NB: the random
+    couples of the windows with more than n_pairs couples are drawn one by one as in sklearn, which takes most of the
+    time: use it only to reproduce the sklearn results (THSEN_ESTIMATOR = 'spatial_median')
+    
+    Parameters
+    ---------
+    x_groups, y_groups: lists of array-like
+        x,y data of each group. Non finite couples are removed
+    n_pairs: int
+        groups with more than n_pairs couples of points use n_pairs random couples
+    seed: int
+        seed of the random couples (random_state of sklearn)
+    max_iter, tol: int, float
+        max number of iterations and tolerance of the spatial median
+    
+    Returns
+    ---------
+    slopes, intercepts: np.array
+        slope and intercept of each group (nan if the group has less than two points)
+    """
+    groups = [_clean_xy(x, y) for x, y in zip(x_groups, y_groups)]
+    slopes     = np.full(len(groups), np.nan)
+    intercepts = np.full(len(groups), np.nan)
+    
+    solutions = {} # (intercepts, slopes) of the couples of points of each group
+    for g, (x, y) in enumerate(groups):
+        if len(x) >= 2:
+            solutions[g] = _pair_solutions(x, y, *_pair_indices(len(x), n_pairs, seed))
+    
+    # sort the groups by number of couples to reduce padding, then fit them in chunks of padded (n_groups, m, 2) arrays
+    order = sorted(solutions, key=lambda g: len(solutions[g][0]))
+    start = 0
+    while start < len(order):
+        stop = start + 1
+        while (stop < len(order)) and ((stop - start + 1) * len(solutions[order[stop]][0]) <= THSEN_CHUNK_SIZE):
+            stop = stop + 1
+        chunk = order[start:stop]
+        m = len(solutions[chunk[-1]][0])
+        points = np.zeros((len(chunk), m, 2))
+        valid = np.zeros((len(chunk), m), dtype=bool)
+        for k, g in enumerate(chunk):
+            n = len(solutions[g][0])
+            points[k, :n, 0], points[k, :n, 1] = solutions[g]
+            valid[k, :n] = True
+        medians = _batch_spatial_median(points, valid, max_iter=max_iter, tol=tol)
+        intercepts[chunk] = medians[:, 0]
+        slopes[chunk] = medians[:, 1]
+        start = stop
+    
+    return slopes, intercepts
+
+def _random_pairs(n, n_pairs, rng):
+    """ n_pairs random couples (i, j) of different points out of n, drawn at once """
+    i = rng.integers(0, n, n_pairs)
+    j = rng.integers(0, n - 1, n_pairs)
+    j = j + (j >= i) # skip i: j is uniform over the other n-1 points
+    return i, j
+
+def _nanmedian_rows(a):
+    """ row-wise median ignoring nan. Rows that contain only nan return nan without warnings """
+    out = np.full(a.shape[0], np.nan)
+    valid = np.isfinite(a).any(axis=1)
+    if valid.any():
+        out[valid] = np.nanmedian(a[valid], axis=1)
+    return out
+
+def batch_median_theil_sen(x_groups, y_groups, exact_max=THSEN_EXACT_MAX, n_random=THSEN_N_RANDOM, seed=42):
+    """
+    Perform a 1-D Theil-Sen regression over many (x, y) groups in one call. The slope is the median of the slopes
+    of the lines through every couple of points with different x, the intercept is the median of y - slope*x.
+    NB: sklearn's TheilSenRegressor takes the spatial median of the (intercept, slope) couples instead, so the slopes
+    differ from it by ~1-2% (see batch_spatial_median_theil_sen())
+
+    Parameters
+    ---------
+    x_groups, y_groups: lists of array-like
+        x,y data of each group. Non finite couples are removed
+    exact_max: int
+        groups with length <= exact_max are fitted exactly using all the pairwise slopes. The exact fits of these groups
+        are padded and computed together. Larger groups use the median of n_random random pairwise slopes
+    n_random: int
+        number of random couples used for groups longer than exact_max (drawn at once, see _random_pairs())
+    seed: int
+        seed of the random generator used for the large groups
+
+    Returns
+    ---------
+    slopes, intercepts: np.array
+        slope and intercept of each group (nan if the group has less than two points with different x)
+    """
+    groups = [_clean_xy(x, y) for x, y in zip(x_groups, y_groups)]
+    slopes     = np.full(len(groups), np.nan)
+    intercepts = np.full(len(groups), np.nan)
+    rng = np.random.default_rng(seed)
+
+    small = [] # index of the groups to be fitted exactly
+    for g, (x, y) in enumerate(groups):
+        if len(x) < 2:
+            continue
+        if len(x) <= exact_max:
+            small.append(g)
+            continue
+        i, j = _random_pairs(len(x), n_random, rng)
+        dx = x[j] - x[i]
+        valid = dx != 0 # vertical couples have no slope
+        if valid.any():
+            slopes[g] = np.median((y[j] - y[i])[valid] / dx[valid])
+            intercepts[g] = np.median(y - slopes[g] * x)
+
+    # sort the small groups by length to reduce padding, then fit them in chunks of padded (n_groups, m(m-1)/2) arrays
+    small.sort(key=lambda g: len(groups[g][0]))
+    start = 0
+    while start < len(small):
+        stop = start + 1
+        while (stop < len(small)) and ((stop - start + 1) * len(groups[small[stop]][0])**2 / 2 <= THSEN_CHUNK_SIZE):
+            stop = stop + 1
+        chunk = small[start:stop]
+        m = len(groups[chunk[-1]][0])
+        x_pad = np.full((len(chunk), m), np.nan)
+        y_pad = np.full((len(chunk), m), np.nan)
+        for k, g in enumerate(chunk):
+            x_pad[k, :len(groups[g][0])] = groups[g][0]
+            y_pad[k, :len(groups[g][1])] = groups[g][1]
+        i, j = np.triu_indices(m, 1)
+        dx = x_pad[:, j] - x_pad[:, i]
+        dx[dx == 0] = np.nan # vertical couples have no slope
+        with np.errstate(invalid='ignore'):
+            pair_slopes = (y_pad[:, j] - y_pad[:, i]) / dx
+        chunk_slopes = _nanmedian_rows(pair_slopes)
+        slopes[chunk] = chunk_slopes
+        intercepts[chunk] = _nanmedian_rows(y_pad - chunk_slopes[:, np.newaxis] * x_pad)
+        start = stop
+
+    return slopes, intercepts
+
+def batch_theil_sen(x_groups, y_groups, estimator=None, seed=42):
+    """
+    Perform a 1-D Theil-Sen regression over many (x, y) groups in one call with the estimator selected by
+    THSEN_ESTIMATOR (or estimator): 'median' (batch_median_theil_sen(), default) or 'spatial_median'
+    (batch_spatial_median_theil_sen(), same results of sklearn's TheilSenRegressor)
+
+    Returns
+    ---------
+    slopes, intercepts: np.array
+        slope and intercept of each group (nan if it cannot be fitted)
+    """
+    if estimator is None:
+        estimator = THSEN_ESTIMATOR
+    if estimator == 'spatial_median':
+        return batch_spatial_median_theil_sen(x_groups, y_groups, seed=seed)
+    return batch_median_theil_sen(x_groups, y_groups, seed=seed)
+
+def theil_sen(x, y, estimator=None, seed=42):
+    """
+    Perform a 1-D Theil-Sen regression on the given data (see batch_theil_sen())
+    
+    Returns
+    ---------
+    TheilSenResult with the coef_, intercept_ and predict() attributes of the sklearn TheilSenRegressor
+    """
+    slopes, intercepts = batch_theil_sen([x], [y], estimator=estimator, seed=seed)
+    return TheilSenResult(slopes[0], intercepts[0])
+
+
+class EivFitResult:
+    """
+    Result of a straight line errors-in-variables fit. Exposes the beta, sd_beta and res_var attributes of the
+    scipy.odr Output so that it can be used in place of it
+    """
+    def __init__(self, slope, intercept, sd_slope, sd_intercept, res_var):
+        self.beta = np.array([slope, intercept])
+        self.sd_beta = np.array([sd_slope, sd_intercept])
+        self.res_var = res_var
+
+def batch_york_fit(x_groups, y_groups, sx_groups, sy_groups, tol=YORK_TOL, max_iter=YORK_MAX_ITER):
+    """
+    Fit a straight line y = a + b*x with errors on both variables over many (x, y) groups in one call (York et al.,
+    2004, Am. J. Phys. 72, 367, with uncorrelated errors). The fit minimizes the same weighted sum of squared orthogonal
+    distances of ODR, sum((y - a - b*x)^2 / (sy^2 + b^2*sx^2)), so it gives the ODRPACK solution of ortho_lin_regress()
+    without building the scipy.odr objects. All the groups are iterated together with bincount sums over the
+    concatenated data, starting from the OLS slope. Couples with non finite values or non positive errors are skipped.
+    NB: this differs from ODRPACK, which fails on NaN errors (e.g. the Stdev of the CMN 2018 data added by
+    fmt.append_2018()) and returned red_chi2 = 0.0: here the other couples of the group are still fitted
+
+    Parameters
+    ----------
+    x_groups, y_groups: list of array-like
+        x, y data of each group
+    sx_groups, sy_groups: list of array-like
+        standard deviations of x and y of each group
+    tol: float
+        relative tolerance on the slopes. The default is YORK_TOL
+    max_iter: int
+        max number of iterations. The default is YORK_MAX_ITER
+
+    Returns
+    -------
+    slopes, intercepts, sd_slopes, sd_intercepts, res_vars: np.array
+        best fit parameters, their standard errors and the residual variance (weighted sum of squared residuals over
+        the n-2 degrees of freedom) of each group. The standard errors are scaled by the residual variance as the
+        sd_beta of scipy.odr. Groups with less than three valid couples return nan
+    """
+    n_groups = len(x_groups)
+    lengths = [len(group) for group in x_groups]
+    codes = np.repeat(np.arange(n_groups), lengths)
+    x  = np.concatenate([np.asarray(group, dtype=float) for group in x_groups])  if n_groups > 0 else np.empty(0)
+    y  = np.concatenate([np.asarray(group, dtype=float) for group in y_groups])  if n_groups > 0 else np.empty(0)
+    sx = np.concatenate([np.asarray(group, dtype=float) for group in sx_groups]) if n_groups > 0 else np.empty(0)
+    sy = np.concatenate([np.asarray(group, dtype=float) for group in sy_groups]) if n_groups > 0 else np.empty(0)
+    valid = np.isfinite(x) & np.isfinite(y) & (sx > 0) & (sy > 0) & np.isfinite(sx) & np.isfinite(sy)
+    x, y, codes, var_x, var_y = x[valid], y[valid], codes[valid], sx[valid]**2, sy[valid]**2
+    n = np.bincount(codes, minlength=n_groups)
+
+    def wsum(values): # sum of values over each group
+        return np.bincount(codes, weights=values, minlength=n_groups)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # shift the data by the group means to limit the cancellation errors
+        x0, y0 = wsum(x) / n, wsum(y) / n
+        x, y = x - x0[codes], y - y0[codes]
+        slopes, _, _ = ols_from_moments(group_moments(x, y, codes, n_groups))
+        slopes = np.where(n > 2, slopes, np.nan)
+        for i in range(max_iter):
+            b = slopes[codes]
+            w = 1 / (var_y + b*b*var_x)
+            sum_w = wsum(w)
+            x_mean, y_mean = wsum(w*x) / sum_w, wsum(w*y) / sum_w
+            u, v = x - x_mean[codes], y - y_mean[codes]
+            beta = w * (u*var_y + b*v*var_x)
+            new_slopes = wsum(w*beta*v) / wsum(w*beta*u)
+            converged = np.all(~(np.abs(new_slopes - slopes) > tol*np.abs(new_slopes))) # nan groups are ignored
+            slopes = new_slopes
+            if converged:
+                break
+        b = slopes[codes]
+        w = 1 / (var_y + b*b*var_x)
+        sum_w = wsum(w)
+        x_mean, y_mean = wsum(w*x) / sum_w, wsum(w*y) / sum_w
+        intercepts = y_mean - slopes*x_mean
+        beta = w * ((x - x_mean[codes])*var_y + b*(y - y_mean[codes])*var_x)
+        x_adj = x_mean[codes] + beta                     # adjusted x values
+        x_adj_mean = wsum(w*x_adj) / sum_w
+        var_slopes = 1 / wsum(w*(x_adj - x_adj_mean[codes])**2)
+        var_intercepts = 1/sum_w + (x_adj_mean + x0)**2 * var_slopes # intercept of the unshifted data
+        res_vars = wsum(w*(y - intercepts[codes] - b*x)**2) / (n - 2)
+        intercepts = intercepts + y0 - slopes*x0         # back to the unshifted data
+        sd_slopes, sd_intercepts = np.sqrt(var_slopes*res_vars), np.sqrt(var_intercepts*res_vars)
+    enough = n > 2 # groups with less than three valid couples (e.g. res_vars would be -0.0 without valid couples)
+    return (np.where(enough, slopes, np.nan), np.where(enough, intercepts, np.nan), np.where(enough, sd_slopes, np.nan),
+            np.where(enough, sd_intercepts, np.nan), np.where(enough, res_vars, np.nan))
+
+def york_fit(x, y, err_x, err_y):
+    """
+    Straight line errors-in-variables fit of the given data (see batch_york_fit())
+
+    Returns
+    ---------
+    EivFitResult with the beta, sd_beta and res_var attributes of the scipy.odr Output
+    """
+    return EivFitResult(*[float(value[0]) for value in batch_york_fit([x], [y], [err_x], [err_y])])
 
 def ortho_lin_regress(x, y, err_x, err_y):
     """
@@ -45,8 +391,9 @@ def ortho_lin_regress(x, y, err_x, err_y):
     out_odr, linreg: 
         results and statistical parameters of the orthogonal and linear regressions
         
-    Uses standard ordinary least squares to estimate the starting parameters
-    then uses the scipy.odr interface to the ODRPACK Fortran code to do the
+    With ODR_SOLVER=='york' the orthogonal regression is the closed form iterative York fit (york_fit()), with
+    ODR_SOLVER=='odrpack' standard ordinary least squares are used to estimate the starting parameters
+    then the scipy.odr interface to the ODRPACK Fortran code is used to do the
     orthogonal distance calculations.
     """
     
@@ -54,23 +401,121 @@ def ortho_lin_regress(x, y, err_x, err_y):
         """Basic linear regression 'model' for use with ODR"""
         return (p[0] * x) + p[1]
 
+    from scipy.stats import linregress
     linreg = linregress(x,y)
-    mod = odr.Model(f)
-    dat = odr.RealData(x, y, sx=err_x, sy=err_y)
-    od  = odr.ODR(dat, mod, beta0=linreg[0:2])
-    out_odr = od.run()
+    if ODR_SOLVER == 'york':
+        out_odr = york_fit(x, y, err_x, err_y)
+    else:
+        import scipy.odr as odr
+        mod = odr.Model(f)
+        dat = odr.RealData(x, y, sx=err_x, sy=err_y)
+        od  = odr.ODR(dat, mod, beta0=linreg[0:2])
+        out_odr = od.run()
     
     #thsen_model = make_pipeline(PolynomialFeatures(1), TheilSenRegressor(random_state=42))
-    thsen_model = TheilSenRegressor(random_state=42, max_iter = 1000)
-    x = np.array(x)[:, np.newaxis]
-    y = np.array(y)
-    thsen_model.fit(x, y)
+    thsen_model = theil_sen(x, y)
     #mse = mean_squared_error(thsen_model.predict(x), y)
 
     return out_odr, linreg, thsen_model
 
 
-def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustness):
+def subsample_ols_slopes(x, y, n_iter, fraction, seed=None):
+    """
+    Evaluate the OLS slopes over n_iter random subsamples (without replacement) of the data. The subsample indices are
+    drawn as a single (n_iter, n_sub) integer matrix and all the slopes are computed at once from vectorized sums.
+    
+    Parameters
+    ---------
+    x, y: array-like
+        x,y data to perform the fit
+    n_iter: int
+        number of subsamples
+    fraction: float
+        fraction of data in each subsample (same rounding as DataFrame.sample(frac=fraction))
+    seed: int
+        seed of the random generator. seed==None for non reproducible subsamples
+    
+    Returns
+    ---------
+    slopes: np.array
+        slopes of the n_iter subsamples. Empty array if the subsamples contain less than two points
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_sub = int(round(fraction * len(x)))
+    if n_sub < 2:
+        return np.empty(0)
+    rng = np.random.default_rng(seed)
+    idx = rng.random((n_iter, len(x))).argsort(axis=1)[:, :n_sub] # each row is a random subsample without replacement
+    x_sub, y_sub = x[idx], y[idx]
+    dx = x_sub - x_sub.mean(axis=1, keepdims=True)
+    dy = y_sub - y_sub.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slopes = (dx*dy).sum(axis=1) / (dx*dx).sum(axis=1)
+    return slopes
+
+MOMENTS = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy'] # sufficient statistics of an OLS fit (last axis of the moments arrays)
+
+def group_moments(x, y, codes, n_groups, x0=0., y0=0.):
+    """
+    OLS sufficient statistics (n, sum x, sum y, sum x^2, sum y^2, sum xy) of the (x, y) couples of each group. Couples
+    with non finite values or negative code are skipped
+
+    Parameters
+    ----------
+    x, y: array-like
+        data
+    codes: array of int
+        group index of each couple (0 <= code < n_groups)
+    n_groups: int
+        number of groups
+    x0, y0: float
+        shift subtracted from x and y before summing, to limit the cancellation errors in ols_from_moments() (e.g. the
+        mean values). The default is 0.
+
+    Returns
+    -------
+    moments: np.array
+        (n_groups, 6) array with the MOMENTS of each group
+    """
+    x = np.asarray(x, dtype=float) - x0
+    y = np.asarray(y, dtype=float) - y0
+    codes = np.asarray(codes)
+    valid = np.isfinite(x) & np.isfinite(y) & (codes >= 0)
+    x, y, codes = x[valid], y[valid], codes[valid]
+    moments = np.empty((n_groups, len(MOMENTS)))
+    for i, values in enumerate([None, x, y, x*x, y*y, x*y]):
+        moments[:, i] = np.bincount(codes, weights=values, minlength=n_groups)
+    return moments
+
+def ols_from_moments(moments, x0=0., y0=0.):
+    """
+    OLS slope, intercept and correlation coefficient (same as linregress slope, intercept and rvalue) from summed
+    sufficient statistics. Selections with less than two points or without x variance return nan
+
+    Parameters
+    ----------
+    moments: np.array
+        (..., 6) array of MOMENTS, e.g. the sum of the group_moments() of the selected groups
+    x0, y0: float
+        shift used to compute the moments. The default is 0.
+
+    Returns
+    -------
+    slope, intercept, rvalue: np.array
+    """
+    n, sx, sy, sxx, syy, sxy = np.moveaxis(np.asarray(moments, dtype=float), -1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov  = sxy - sx*sy/n
+        varx = sxx - sx*sx/n
+        vary = syy - sy*sy/n
+        slope = np.where(n > 1, cov / varx, np.nan)
+        intercept = (sy - slope*sx)/n + y0 - slope*x0
+        rvalue = np.clip(cov / np.sqrt(varx*vary), -1, 1)
+    return slope, intercept, rvalue
+
+@instr.timed('fit')
+def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustness, batch_robustness=True, seed=None, write=True, store=None, plots=None):
     """
     Perform orthogonal and linear fit on the FIRST and SECOND columns of df and returns scatter plot and best fit line
 
@@ -86,8 +531,24 @@ def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustne
         describes the day/night selection. True = daily selected data, False = nightime selected, None = no day/night selection
     non_bkg: bool
         wether to use all data (False) or only non-bkg data (True)
+    batch_robustness: bool
+        evaluate the subsample slopes of the robustness test all at once (True) or with sequential df.sample refits (False). The default is True
+    seed: int
+        seed for the robustness subsamples. The default is None (non reproducible subsamples)
+    write: bool
+        append the fit results to the fit results table file. Ignored if store is given. The default is True
+    store: FitResultsStore
+        store where to add the fit results instead of appending them to the table file. The default is None
+    plots: plf.PlotQueue
+        if given (and plot==True) the scatter plot is queued for deferred rendering instead of being drawn. The default is None
+    
+    If conf.fit_cache==True and no plot is requested, the fit results are read from the on-disk fit cache when the same
+    data (fitted columns) have already been fitted with the same parameters. NB: with seed==None the cached robustness
+    test result is the one of the first (random) run
     Returns
     -------
+    record: FitRecord
+        fit results (one row of the fit results table)
     """
 
     # define columns and format titles and filenames
@@ -98,13 +559,30 @@ def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustne
     df.loc[ df[errors[0]]==0, errors[0]] = np.nan
     df.loc[ df[errors[1]]==0, errors[1]] = np.nan
 
+    if conf.fit_cache and not plot: # reuse the results of a fit already performed on the same data and parameters
+        fit_key = cache.fit_key(df[[species[0], species[1]] + errors],
+                                {'year': int(year), 'month': fmt.get_month_str(month), 'wd': wd, 'robustness': robustness,
+                                 'batch_robustness': batch_robustness, 'seed': seed,
+                                 # solver settings: results cached with other solvers or settings are not reused
+                                 'odr_solver': ODR_SOLVER, 'york_tol': YORK_TOL, 'york_max_iter': YORK_MAX_ITER,
+                                 'thsen_estimator': THSEN_ESTIMATOR, 'thsen_exact_max': THSEN_EXACT_MAX, 'thsen_n_random': THSEN_N_RANDOM,
+                                 'thsen_n_pairs': THSEN_N_PAIRS, 'thsen_max_iter': THSEN_MAX_ITER, 'thsen_tol': THSEN_TOL})
+        cached = cache.read_cached_fit(fit_key)
+        if cached is not None:
+            instr.count('fit_cache_hits')
+            record = FitRecord(*cached)
+            if store is not None:
+                store.add(table_filenm, record)
+            elif write:
+                write_fit_line(table_filenm, format_fit_line(record))
+            return record
+
     ################ FIT #################
-    ort_res, lin_res, thsen_res = ortho_lin_regress(df[species[0]], df[species[1]], df[errors[0]], df[errors[1]]) # perform orthogonal and linear regression
-    poly = np.poly1d(ort_res.beta) # define fist order polynomials with the regression coefficients
-    poly_lin = np.poly1d(lin_res[0:2])
+    with instr.stage('regressions', rows_in=len(df)):
+        ort_res, lin_res, thsen_res = ortho_lin_regress(df[species[0]], df[species[1]], df[errors[0]], df[errors[1]]) # perform orthogonal and linear regression
+    instr.count('fits')
     min_x, max_x = min( df[ df[species[0]].notna() ][species[0]] ), max( df[ df[species[0]].notna() ][species[0]] )
     xvals = np.arange(min_x, max_x, 1) # x array to plot the polynomials
-    poly_thsen = thsen_res.predict(xvals[:, np.newaxis])
 
 
     ############## TEST FIT ROBUSTNESS THROUGH SUBSAMPLING ###################
@@ -118,13 +596,19 @@ def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustne
             fraction = 0.2
     
         threshold = 0.3
-        monthly_check_array = np.empty(0)
-        for i in range(n_iter):
-            df_sub=df.sample(frac = fraction)
-            if len(df_sub)>1: # check on dataframe length to avoid fit over empty columns
-	            ort_res_sub, lin_res_sub, thsen_res_sub = ortho_lin_regress(df_sub[species[0]], df_sub[species[1]], df_sub[errors[0]], df_sub[errors[1]])
-        	    #monthly_check_array = np.append(monthly_check_array, ort_res_sub.beta[0]) # usa fit ortogonale
-        	    monthly_check_array = np.append(monthly_check_array, lin_res_sub[0])
+        with instr.stage('robustness', rows_in=len(df), iterations=n_iter):
+            if batch_robustness: # evaluate all the subsample OLS slopes at once
+                monthly_check_array = subsample_ols_slopes(df[species[0]], df[species[1]], n_iter, fraction, seed=seed)
+            else:
+                monthly_check_array = np.empty(0)
+                rng = np.random.default_rng(seed)
+                for i in range(n_iter):
+                    df_sub=df.sample(frac = fraction, random_state = rng)
+                    if len(df_sub)>1: # check on dataframe length to avoid fit over empty columns
+                        ort_res_sub, lin_res_sub, thsen_res_sub = ortho_lin_regress(df_sub[species[0]], df_sub[species[1]], df_sub[errors[0]], df_sub[errors[1]])
+                        #monthly_check_array = np.append(monthly_check_array, ort_res_sub.beta[0]) # usa fit ortogonale
+                        monthly_check_array = np.append(monthly_check_array, lin_res_sub[0])
+        instr.count('robustness_iterations', n_iter)
         if np.std(monthly_check_array)/np.mean(monthly_check_array) < threshold:
             robust = True
         else:
@@ -136,6 +620,52 @@ def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustne
     ############## ############## ############## ############## ##############
 
     # write results on table
+    ## information about orthogonal fit (commented)
+    # record = FitRecord(int(year), fmt.get_month_str(month),
+    #                    float(ort_res.beta[0]), float(ort_res.sd_beta[0]), float(ort_res.res_var),
+    #                    float(np.mean(monthly_check_array)), float(np.std(monthly_check_array)),
+    #                    float(lin_res[2]), robust)
+    ## information about linear fit (commented)
+    # record = FitRecord(int(year), fmt.get_month_str(month),
+    #                    float(lin_res[0]), float(lin_res[4]), float(ort_res.res_var),
+    #                    float(np.mean(monthly_check_array)), float(np.std(monthly_check_array)),
+    #                    float(lin_res[2]), robust)
+    # write TheilSen fit results
+    record = FitRecord(int(year), fmt.get_month_str(month),
+                       float(np.mean(thsen_res.coef_)), -99.99, float(ort_res.res_var),
+                       float(np.mean(monthly_check_array)), float(np.std(monthly_check_array)),
+                       float(lin_res[2]), robust)
+    if conf.fit_cache and not plot:
+        cache.write_cached_fit(fit_key, list(record))
+    if store is not None:
+        store.add(table_filenm, record)
+    elif write:
+        write_fit_line(table_filenm, format_fit_line(record))
+
+    ############## plotting ##############
+    if plot:
+        if not isnan(ort_res.beta[0] + ort_res.beta[1]  + lin_res[0] + lin_res[1]):
+            f_string = '$f_{orth}(x)$ = ' +str(round(ort_res.beta[0],2))+ ' x + ' +str(round(ort_res.beta[1]))+ '\n' + '$f_{lin}(x)$ = ' +str(round(lin_res[0],2))+ ' x + ' +str(round(lin_res[1])) + '\n' + '$f_{TS}(x)$ = ' +str(round(np.mean(thsen_res.coef_),2))+ ' x + ' +str(round(np.mean(thsen_res.intercept_)))  
+        else:
+            f_string = None
+        plot_data = dict(title=species[1].upper()+':'+species[0].upper()+' orthogonal and linear regression\n'+selection_string,
+                         x=df[species[0]].to_numpy(), y=df[species[1]].to_numpy(), color='C'+str(year-conf.years[0]), xvals=xvals,
+                         ort_coef=ort_res.beta[0:2], lin_coef=np.array(lin_res[0:2]), thsen_coef=np.array([thsen_res.coef_[0], thsen_res.intercept_]),
+                         xlabel=species[0].upper()+' [ppb]', ylabel=species[1].upper()+' [ppb]', fit_text=f_string)
+        if plots is not None: # deferred plotting
+            plots.add('fit_scatter', plot_filenm, **plot_data)
+        else:
+            with instr.stage('plot'):
+                plf.render_fit_scatter(plot_filenm, **plot_data)
+
+    return record
+
+@instr.timed('write_fit_line')
+def write_fit_line(table_filenm, fit_line):
+    """
+    append a line with the fit results to the fit results table ./<stat>/res_fit/<table_filenm>. The header is written
+    if the table does not exist yet
+    """
     if not path.exists('./'+conf.stat+'/res_fit/'+table_filenm): # write header only if the file does not already exist
         file = open('./'+conf.stat+'/res_fit/'+table_filenm, 'w')
         file.write('year month slope slope_sd red_chi2 mean_slope_sub slope_sd_sub r2 robust\n')
@@ -147,54 +677,5 @@ def fit_and_scatter_plot(df, year, month, wd, day_night, plot, non_bkg, robustne
         file.close()
         if (last_line[0:13] != str(conf.years[-1])+' December') | (last_line[0:8] != str(conf.years[-1])+' SON'): # append new data only if last line is different from 2020 December  WARNING: does not work for yearly data
             file = open('./'+conf.stat+'/res_fit/'+table_filenm, 'a')
-            ## information about orthogonal fit (commented)
-            # file.write(str(year) +' '+ fmt.get_month_str(month) +
-            #             ' ' + str(round(ort_res.beta[0],2)) +  ' ' +
-            #             str(round(ort_res.sd_beta[0],2)) +  ' ' +
-            #             str(round(ort_res.res_var,3) ) + ' ' +
-            #             str(round(np.mean(monthly_check_array),3) ) + ' ' +
-            #             str(round(np.std(monthly_check_array),3) ) + ' ' +
-            #             str(round(lin_res[2],3) ) + ' ' +
-            #             str(robust) + '\n')
-            # write linear fit results
-            ## information about linear fit
-            # file.write(str(year) +' '+ fmt.get_month_str(month) +
-            #             ' ' + str(round(lin_res[0],2)) +  ' ' +
-            #             str(round(lin_res[4],2)) +  ' ' +
-            #             str(round(ort_res.res_var,3) ) + ' ' +
-            #             str(round(np.mean(monthly_check_array),3) ) + ' ' +
-            #             str(round(np.std(monthly_check_array),3) ) + ' ' +
-            #             str(round(lin_res[2],3) ) + ' ' +
-            #             str(robust) + '\n')
-            # write TheilSen fit results
-            file.write(str(year) +' '+ fmt.get_month_str(month) + ' ' + 
-                        str(round(np.mean(thsen_res.coef_),2)) +  ' ' +
-                        str(-99.99) +  ' ' +
-                        str(round(ort_res.res_var,3) ) + ' ' +
-                        str(round(np.mean(monthly_check_array),3) ) + ' ' +
-                        str(round(np.std(monthly_check_array),3) ) + ' ' +
-                        str(round(lin_res[2],3) ) + ' ' +
-                        str(robust) + '\n')
-
+            file.write(fit_line)
             file.close()
-
-    ############## plotting ##############
-    if plot:
-        fig, ax=plt.subplots(1,1, figsize=(5,5))
-        fig.suptitle(species[1].upper()+':'+species[0].upper()+' orthogonal and linear regression\n'+selection_string)
-        ax.scatter(df[species[0]], df[species[1]], marker='o', facecolors='none', edgecolors='C'+str(year-conf.years[0]))
-        ax.plot(xvals, poly(xvals), color ='r',label='orthogonal regression')
-        ax.plot(xvals, poly_lin(xvals), color ='purple', label='linear regression')
-        ax.plot(xvals, poly_thsen, color ='blue', label='Theil-Sen regression')
-        ax.set_xlabel(species[0].upper()+' [ppb]')
-        ax.set_ylabel(species[1].upper()+' [ppb]')
-        ax.legend(loc='upper left')
-        ax.grid()
-        # add fit information:
-        props = dict(boxstyle='round', facecolor='wheat', alpha=0.7)           
-        if not isnan(ort_res.beta[0] + ort_res.beta[1]  + lin_res[0] + lin_res[1]):
-            f_string = '$f_{orth}(x)$ = ' +str(round(ort_res.beta[0],2))+ ' x + ' +str(round(ort_res.beta[1]))+ '\n' + '$f_{lin}(x)$ = ' +str(round(lin_res[0],2))+ ' x + ' +str(round(lin_res[1])) + '\n' + '$f_{TS}(x)$ = ' +str(round(np.mean(thsen_res.coef_),2))+ ' x + ' +str(round(np.mean(thsen_res.intercept_)))  
-            ax.text(0.55, 0.05, f_string, transform=ax.transAxes, bbox=props) 
-        
-        plt.savefig(plot_filenm, format='pdf')
-        plt.close(fig)
@@ -5,3 +5,278 @@ Created on Mon Oct 25 17:11:17 2021
 
 @author: cosimo
 """
+######################################################################################
+######        Memory-mapped columnar store for minute ICOS data                 ######
+######################################################################################
+# Minute data are ~60 times the hourly data and several years do not fit comfortably in a DataFrame. Each ICOS L2
+# minute file is converted once (in chunks) into a store directory with one .npy array per column and a sorted
+# DateTime index (datetime64[ns]). The arrays are opened as memory maps: time-range slices are found with a binary
+# search on the index and only the selected rows are read. Hourly means and standard deviations are computed chunk by
+# chunk, so RAM usage is bounded by the chunk size and not by the number of years.
+#
+# usage:
+#   ch4 = build_minute_store(conf.L2_ICOS_path, 'ICOS_ATC_L2_..._MIN.CH4')   # once per file
+#   co  = build_minute_store(conf.L2_ICOS_path, 'ICOS_ATC_L2_..._MIN.CO')
+#   hourly_frame = get_hourly_frame(ch4, co)   # DateTime, ch4, Stdev_ch4, co, Stdev_co (+ WD with a MTO store)
+
+import json
+import os
+import numpy as np
+import pandas as pd
+import formatting_functions as fmt
+import cache_functions as cache
+import config as conf
+
+CHUNK_ROWS = 1000000               # rows read or aggregated at once
+FLAG_COLUMNS = ['Flag', 'WD-Flag'] # flag columns (stored as 1 byte strings)
+
+def store_dir_nm(file_name):
+    """ directory of the minute store of an ICOS L2 file """
+    return conf.minute_store_path + file_name.replace('.', '_') + '/'
+
+def count_data_lines(file_nm, head_nlines):
+    """
+    number of data lines of an ICOS L2 file (read in binary blocks, without parsing). NB: blank lines are counted too,
+    so this is an upper bound of the rows read by read_csv()
+    """
+    n_lines = 0
+    file = open(file_nm, 'rb')
+    block = file.read(2**24)
+    last = b'\n'
+    while block:
+        n_lines = n_lines + block.count(b'\n')
+        last = block[-1:]
+        block = file.read(2**24)
+    file.close()
+    if last != b'\n': # last line without newline
+        n_lines = n_lines + 1
+    return n_lines - head_nlines
+
+def build_minute_store(file_path, file_name, chunk_rows=CHUNK_ROWS, rebuild=False):
+    """
+    convert an ICOS L2 minute file into a memory-mapped columnar store. The file is read in chunks of chunk_rows rows
+    and the store is rebuilt only if the file changed (mtime and size) since the store was written
+
+    Parameters
+    ----------
+    file_path, file_name: str
+        path and name of the ICOS L2 file
+    chunk_rows: int
+        rows read at once. The default is CHUNK_ROWS
+    rebuild: bool
+        rebuild the store even if the file did not change. The default is False
+
+    Returns
+    -------
+    store: MinuteStore
+    """
+    store_dir = store_dir_nm(file_name)
+    signature = cache.file_signature([file_path + file_name])
+    meta_filenm = store_dir + 'meta.json'
+    if (not rebuild) and os.path.exists(meta_filenm):
+        file = open(meta_filenm, 'r')
+        meta = json.load(file)
+        file.close()
+        if meta['source'] == signature:
+            return MinuteStore(store_dir)
+
+    head_nlines, columns = fmt.read_L2_header(file_path + file_name)
+    usecols = [i for i in range(len(columns)) if columns[i] in fmt.ICOS_L2_SCHEMA]
+    names = [columns[i] for i in usecols]
+    value_cols = [col for col in names if col not in ['#Site', 'Year', 'Month', 'Day', 'Hour', 'Minute']]
+    n_rows = count_data_lines(file_path + file_name, head_nlines)
+
+    os.makedirs(store_dir, exist_ok=True)
+    arrays = {'DateTime': np.lib.format.open_memmap(store_dir + 'DateTime.npy', mode='w+', dtype='datetime64[ns]', shape=(n_rows,))}
+    for col in value_cols:
+        dtype = 'S1' if col in FLAG_COLUMNS else fmt.ICOS_L2_SCHEMA[col]
+        arrays[col] = np.lib.format.open_memmap(store_dir + col + '.npy', mode='w+', dtype=dtype, shape=(n_rows,))
+    start = 0
+    for chunk in pd.read_csv(file_path + file_name, sep=';', skiprows=head_nlines, header=None, usecols=usecols,
+                             chunksize=chunk_rows, engine='c'):
+        chunk.columns = names
+        stop = start + len(chunk)
+        if stop > n_rows:
+            print('ERROR: build_minute_store(): more rows than lines in ' + file_path + file_name)
+            os.sys.exit()
+        arrays['DateTime'][start:stop] = pd.to_datetime(chunk[['Year', 'Month', 'Day', 'Hour', 'Minute']].rename(
+            columns={'Year': 'year', 'Month': 'month', 'Day': 'day', 'Hour': 'hour', 'Minute': 'minute'})).to_numpy()
+        for col in value_cols:
+            if col in FLAG_COLUMNS:
+                arrays[col][start:stop] = chunk[col].astype(str).str[:1].to_numpy(dtype='S1')
+            else:
+                arrays[col][start:stop] = chunk[col].to_numpy()
+        start = stop
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    if start < n_rows: # blank lines skipped by read_csv(): drop the unfilled rows at the end of the columns
+        truncate_store(store_dir, ['DateTime'] + value_cols, start, chunk_rows)
+        n_rows = start
+
+    sort_store(store_dir, ['DateTime'] + value_cols, chunk_rows)
+    file = open(meta_filenm + '.tmp', 'w')
+    json.dump({'source': signature, 'columns': ['DateTime'] + value_cols, 'rows': n_rows}, file)
+    file.close()
+    os.replace(meta_filenm + '.tmp', meta_filenm) # the store is valid only once meta.json is written
+    return MinuteStore(store_dir)
+
+def truncate_store(store_dir, columns, n_rows, chunk_rows=CHUNK_ROWS):
+    """ keep only the first n_rows rows of the columns of a store """
+    for col in columns:
+        array = np.load(store_dir + col + '.npy', mmap_mode='r')
+        out = np.lib.format.open_memmap(store_dir + col + '.npy.tmp', mode='w+', dtype=array.dtype, shape=(n_rows,))
+        for start in range(0, n_rows, chunk_rows):
+            out[start:start+chunk_rows] = array[start:min(start+chunk_rows, n_rows)]
+        out.flush()
+        del out, array
+        os.replace(store_dir + col + '.npy.tmp', store_dir + col + '.npy')
+
+def sort_store(store_dir, columns, chunk_rows=CHUNK_ROWS):
+    """ sort the columns of a store by DateTime (nothing is done if the index is already sorted) """
+    times = np.load(store_dir + 'DateTime.npy', mmap_mode='r')
+    sorted_index = True
+    for start in range(0, len(times), chunk_rows): # chunk boundaries overlap by one element
+        if np.any(np.diff(times[start:start+chunk_rows+1]) < np.timedelta64(0)):
+            sorted_index = False
+            break
+    if sorted_index:
+        return
+    order = np.argsort(times, kind='stable') # only the permutation is held in memory
+    del times
+    for col in columns:
+        array = np.load(store_dir + col + '.npy', mmap_mode='r')
+        out = np.lib.format.open_memmap(store_dir + col + '.npy.tmp', mode='w+', dtype=array.dtype, shape=array.shape)
+        for start in range(0, len(order), chunk_rows):
+            out[start:start+chunk_rows] = array[order[start:start+chunk_rows]]
+        out.flush()
+        del out, array
+        os.replace(store_dir + col + '.npy.tmp', store_dir + col + '.npy')
+
+class MinuteStore:
+    """
+    Memory-mapped columnar store of one ICOS L2 minute file (see build_minute_store()). Columns are opened as
+    read-only memory maps on first use
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        file = open(store_dir + 'meta.json', 'r')
+        self.meta = json.load(file)
+        file.close()
+        self.columns = self.meta['columns']
+        self._arrays = {}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def column(self, col):
+        """ memory map of a column """
+        if col not in self._arrays:
+            self._arrays[col] = np.load(self.store_dir + col + '.npy', mmap_mode='r')
+        return self._arrays[col]
+
+    def time_slice(self, start=None, end=None):
+        """ positions [i0, i1) of the rows with start <= DateTime < end (binary search on the sorted index) """
+        times = self.column('DateTime')
+        i0 = 0 if start is None else int(np.searchsorted(times, np.datetime64(pd.Timestamp(start)), side='left'))
+        i1 = len(times) if end is None else int(np.searchsorted(times, np.datetime64(pd.Timestamp(end)), side='left'))
+        return i0, i1
+
+    def read(self, start=None, end=None, columns=None):
+        """ DataFrame with the rows with start <= DateTime < end. Only the selected rows are read from disk """
+        i0, i1 = self.time_slice(start, end)
+        if columns is None:
+            columns = self.columns
+        frame = pd.DataFrame({col: np.array(self.column(col)[i0:i1]) for col in columns})
+        for col in FLAG_COLUMNS:
+            if col in frame.columns:
+                frame[col] = frame[col].str.decode('ascii')
+        return frame
+
+    def iter_hour_chunks(self, start=None, end=None, chunk_rows=CHUNK_ROWS):
+        """
+        positions (i0, i1) of consecutive chunks of about chunk_rows rows between start and end. Chunk boundaries are
+        moved to the beginning of an hour, so that no hour is split between two chunks
+        """
+        times = self.column('DateTime')
+        i0, i_end = self.time_slice(start, end)
+        while i0 < i_end:
+            i1 = min(i0 + chunk_rows, i_end)
+            if i1 < i_end:
+                hour = times[i1].astype('datetime64[h]')
+                i1 = int(np.searchsorted(times, hour, side='left'))
+                if i1 <= i0: # chunk shorter than one hour
+                    i1 = int(np.searchsorted(times, hour + np.timedelta64(1, 'h'), side='left'))
+                i1 = min(i1, i_end)
+            yield i0, i1
+            i0 = i1
+
+def hourly_stats(store, col, start=None, end=None, flag_col='Flag', circular=False, chunk_rows=CHUNK_ROWS):
+    """
+    hourly mean, standard deviation (ddof=1, as pandas) and number of valid minute values of a column, computed chunk
+    by chunk. Values flagged 'N' or 'K' and missing values are skipped
+
+    Parameters
+    ----------
+    store: MinuteStore
+    col: str
+        column to aggregate (e.g. 'ch4', 'co' or 'WD')
+    start, end: str or datetime
+        time interval [start, end). The default is None (all data)
+    flag_col: str
+        flag column of col. The default is 'Flag' (use 'WD-Flag' for WD)
+    circular: bool
+        circular mean of angles in degrees (for WD). The standard deviation is not computed. The default is False
+
+    Returns
+    -------
+    hourly: DataFrame
+        columns 'DateTime' (beginning of the hour), col, 'Stdev_'+col and 'n_'+col. Hours without valid data are not
+        included
+    """
+    times_all = store.column('DateTime')
+    frames = []
+    for i0, i1 in store.iter_hour_chunks(start, end, chunk_rows):
+        values = np.asarray(store.column(col)[i0:i1], dtype=float)
+        valid = np.isfinite(values)
+        if flag_col in store.columns:
+            flags = np.asarray(store.column(flag_col)[i0:i1])
+            valid &= (flags != b'N') & (flags != b'K')
+        hours = np.asarray(times_all[i0:i1]).astype('datetime64[h]')[valid]
+        values = values[valid]
+        if len(values) == 0:
+            continue
+        codes, uniques = pd.factorize(hours, sort=True)
+        n = np.bincount(codes, minlength=len(uniques))
+        if circular:
+            rad = np.deg2rad(values)
+            mean = np.mod(np.rad2deg(np.arctan2(np.bincount(codes, np.sin(rad)), np.bincount(codes, np.cos(rad)))), 360)
+            std = np.full(len(uniques), np.nan)
+        else:
+            mean = np.bincount(codes, values) / n
+            dev = values - mean[codes]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                std = np.sqrt(np.bincount(codes, dev*dev) / (n - 1))
+        frames.append(pd.DataFrame({'DateTime': np.asarray(uniques).astype('datetime64[ns]'), col: mean,
+                                    'Stdev_'+col: std, 'n_'+col: n}))
+    if len(frames) == 0:
+        return pd.DataFrame({'DateTime': np.array([], dtype='datetime64[ns]'), col: [], 'Stdev_'+col: [], 'n_'+col: []})
+    return pd.concat(frames, ignore_index=True)
+
+def get_hourly_frame(ch4_store, co_store, met_store=None, start=None, end=None, chunk_rows=CHUNK_ROWS):
+    """
+    hourly frame for the regressions from the minute stores of CH4, CO and (optionally) MET data: hourly means of ch4
+    and co with their minute standard deviations (Stdev_ch4, Stdev_co) and the circular mean of WD
+
+    Returns
+    -------
+    hourly_frame: DataFrame
+        columns 'DateTime', 'ch4', 'Stdev_ch4', 'co', 'Stdev_co' (+ 'WD') for the hours with valid data of all the species
+    """
+    ch4 = hourly_stats(ch4_store, 'ch4', start, end, chunk_rows=chunk_rows)
+    co  = hourly_stats(co_store,  'co',  start, end, chunk_rows=chunk_rows)
+    hourly_frame = pd.merge(ch4[['DateTime', 'ch4', 'Stdev_ch4']], co[['DateTime', 'co', 'Stdev_co']], on='DateTime')
+    if met_store is not None:
+        wd = hourly_stats(met_store, 'WD', start, end, flag_col='WD-Flag', circular=True, chunk_rows=chunk_rows)
+        hourly_frame = pd.merge(hourly_frame, wd[['DateTime', 'WD']], on='DateTime')
+    return hourly_frame
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:48:13 2026
+
+@author: cosimo
+"""
+######################################################################################
+######     Hourly sufficient statistics for constant-time OLS selections        ######
+######################################################################################
+# The OLS slope, intercept and correlation of any selection only need the sums n, Σx, Σy, Σx², Σy², Σxy of its data
+# (see lrf.ols_from_moments()). MomentCube computes these sums once from the merged frame for each
+# (hour, WD bin, bkg flag, day/night) cell; monthly, seasonal, yearly and combined selections are then answered by
+# summing the cells, independently of the number of rows. The wind sector sweeps of sector_functions are built on it.
+# NB: the WD selection uses bins of bin_width degrees (sector edges must be multiples of bin_width). The bkg flag of
+# each cell follows select_non_bkg(): rows of bkg/non-bkg episodes shorter than min_duration_h get the flag -1, so the
+# bkg and non-bkg selections match select_and_fit() (episodes computed on the full frame)
+
+import os
+import numpy as np
+import pandas as pd
+import lin_reg_functions as lrf
+import selection_functions as sel
+import formatting_functions as fmt
+import config as conf
+
+WD_BIN_WIDTH = 10 # default width of the WD bins [deg]
+
+def wd_bin(wd, bin_width=WD_BIN_WIDTH):
+    """ WD bin of each value (bin i covers [i*bin_width, (i+1)*bin_width) degrees). Missing values get bin -1 """
+    wd = np.asarray(wd, dtype=float)
+    bins = np.floor(np.mod(wd, 360) / bin_width)
+    return np.where(np.isfinite(bins), bins, -1).astype(int)
+
+def sector_bins(wd, bin_width=WD_BIN_WIDTH):
+    """
+    first bin and number of bins of the sector wd ('wd_min-wd_max', going clockwise from wd_min to wd_max as in
+    select_wd()). A sector with wd_min == wd_max covers the whole circle
+    """
+    wd_min = int(wd.split('-')[0])
+    wd_max = int(wd.split('-')[1])
+    if (wd_min % bin_width != 0) | (wd_max % bin_width != 0):
+        print('ERROR: sector '+wd+' edges are not multiples of the bin width ('+str(bin_width)+' deg)\n')
+        os.sys.exit()
+    n_bins = 360 // bin_width
+    length = ((wd_max - wd_min) % 360) // bin_width
+    if length == 0:
+        length = n_bins
+    return (wd_min // bin_width) % n_bins, length
+
+class MomentCube:
+    """
+    OLS sufficient statistics (lrf.MOMENTS) of the CH4 vs CO data for each (hour, WD bin, bkg flag, day/night) cell
+
+    Parameters
+    ----------
+    df: DataFrame
+        merged frame with DateTime, WD, the co and ch4 columns and optionally bkg
+    bin_width: int
+        width of the WD bins [deg]. 360 must be a multiple of bin_width. The default is WD_BIN_WIDTH
+    lat, lon: float
+        station coordinates for the day/night flag. The default is None, i.e. conf.stat_lat and conf.stat_lon
+    episodes: tuple
+        bkg episodes of df (see sel.bkg_episodes()). The default is None, i.e. they are computed on df
+    min_duration_h: float
+        min duration of the bkg/non-bkg episodes (see sel.select_non_bkg()). The default is None, i.e.
+        conf.min_bkg_duration_h
+
+    Attributes
+    ----------
+    cells: DataFrame
+        one row per cell with columns 'DateTime' (hour), 'wd_bin' (-1 for missing WD), 'bkg' (1 bkg, 0 non-bkg, -1
+        missing flag or episode shorter than min_duration_h) and 'day' (True for daytime)
+    moments: np.array
+        (n_cells, 6) array with the moments of each cell, computed on data shifted by x0, y0
+    """
+    def __init__(self, df, bin_width=WD_BIN_WIDTH, lat=None, lon=None, episodes=None, min_duration_h=None):
+        if 360 % bin_width != 0:
+            print('ERROR: 360 is not a multiple of the WD bin width '+str(bin_width)+'\n')
+            os.sys.exit()
+        if lat is None:
+            lat, lon = conf.stat_lat, conf.stat_lon
+        if min_duration_h is None:
+            min_duration_h = conf.min_bkg_duration_h
+        species, suff = fmt.get_species_suffix(df)
+        self.bin_width = bin_width
+        self.species = species
+        self.min_duration_h = min_duration_h
+        hour = df['DateTime'].dt.floor('h').to_numpy()
+        if 'bkg' in df.columns:
+            if episodes is None:
+                episodes = sel.bkg_episodes(df)
+            table, row_episode = episodes
+            # flag of the episodes kept by select_non_bkg(), -1 for the shorter ones
+            state = np.where(table['duration_h'].to_numpy() >= min_duration_h, table['bkg'].to_numpy(), -1).astype(np.int8)
+            bkg = state[row_episode.reindex(df.index).to_numpy()]
+        else:
+            bkg = np.full(len(df), -1, dtype=np.int8)
+        day = sel.is_daytime(df['DateTime'], lat, lon)
+        keys = pd.DataFrame({'DateTime': hour, 'wd_bin': wd_bin(df['WD'], bin_width), 'bkg': bkg, 'day': day})
+        groups = keys.groupby(list(keys.columns), sort=True)
+        codes = groups.ngroup().to_numpy()
+        self.cells = groups.size().reset_index()[list(keys.columns)]
+        x, y = df[species[0]].to_numpy(dtype=float), df[species[1]].to_numpy(dtype=float)
+        self.x0, self.y0 = (float(np.nanmean(x)), float(np.nanmean(y))) if len(df) > 0 else (0., 0.)
+        self.moments = lrf.group_moments(x, y, codes, len(self.cells), x0=self.x0, y0=self.y0)
+
+    def select(self, wd=None, day_night=None, bads_no_bkg=None, start=None, end=None):
+        """
+        bool mask of the cells of a selection
+
+        Parameters
+        ----------
+        wd: str
+            wind sector 'wd_min-wd_max' (see sel.select_wd()). The default is None (no selection)
+        day_night: bool
+            daytime (True) or nighttime (False) selection. The default is None (no selection)
+        bads_no_bkg: bool
+            non-bkg (True) or bkg (False) selection, with the episodes rule of sel.select_non_bkg(). The default is None
+            (no selection)
+        start, end: str or datetime
+            time interval [start, end) of the selection. The default is None (no selection)
+        """
+        mask = np.ones(len(self.cells), dtype=bool)
+        if wd != None:
+            first, length = sector_bins(wd, self.bin_width)
+            n_bins = 360 // self.bin_width
+            mask &= np.isin(self.cells['wd_bin'].to_numpy(), (first + np.arange(length)) % n_bins)
+        if day_night != None:
+            mask &= self.cells['day'].to_numpy() == day_night
+        if bads_no_bkg != None:
+            mask &= self.cells['bkg'].to_numpy() == int(not bads_no_bkg)
+        if start is not None:
+            mask &= self.cells['DateTime'].to_numpy() >= np.datetime64(pd.Timestamp(start))
+        if end is not None:
+            mask &= self.cells['DateTime'].to_numpy() < np.datetime64(pd.Timestamp(end))
+        return mask
+
+    def ols(self, mask=None, **selection):
+        """
+        OLS fit of a selection from the summed moments of its cells
+
+        Parameters
+        ----------
+        mask: np.array of bool
+            cells of the selection. The default is None, i.e. select(**selection)
+        selection:
+            keyword arguments of select()
+
+        Returns
+        -------
+        n, slope, intercept, rvalue
+        """
+        if mask is None:
+            mask = self.select(**selection)
+        moments = self.moments[mask].sum(axis=0)
+        slope, intercept, rvalue = lrf.ols_from_moments(moments, x0=self.x0, y0=self.y0)
+        return int(moments[0]), float(slope), float(intercept), float(rvalue)
+
+    def period_codes(self, month, season, mask=None):
+        """
+        monthly, seasonal or yearly period of each cell (same grid of sel.select_and_fit()), for the periods of
+        conf.years that contain cells of mask
+
+        Returns
+        -------
+        codes: np.array
+            position in periods of the period of each cell. -1 for the cells out of mask or of conf.years
+        periods: list of tuples
+            (year, period) of each period in chronological order. period is the month name, the season or '' (yearly)
+        """
+        if month & season:
+            print('ERROR: both month and season selected\n')
+            os.sys.exit()
+        keys = sel.period_keys(self.cells)
+        if month:
+            year, period = keys['year'].to_numpy(), keys['month'].to_numpy()
+        elif season:
+            year, period = keys['season_year'].to_numpy(), keys['season'].to_numpy()
+        else:
+            year, period = keys['year'].to_numpy(), np.zeros(len(keys), dtype=int)
+        used = np.isin(year, conf.years)
+        if mask is not None:
+            used &= mask
+        period_codes, uniques = pd.factorize(year[used]*100 + period[used], sort=True)
+        codes = np.full(len(self.cells), -1)
+        codes[used] = period_codes
+        if month:
+            periods = [(int(key//100), fmt.get_month_str(int(key % 100))) for key in uniques]
+        elif season:
+            periods = [(int(key//100), sel.SEASONS[int(key % 100)]) for key in uniques]
+        else:
+            periods = [(int(key//100), '') for key in uniques]
+        return codes, periods
+
+    def period_ols(self, month, season, wd=None, day_night=None, bads_no_bkg=None):
+        """
+        OLS fits of all the monthly, seasonal or yearly periods of conf.years for one selection (same grid of
+        sel.select_and_fit())
+
+        Returns
+        -------
+        fits: DataFrame
+            columns 'year', 'month' (month name, season or '' for yearly periods), 'n', 'slope', 'intercept' and 'rvalue'
+        """
+        codes, periods = self.period_codes(month, season, self.select(wd=wd, day_night=day_night, bads_no_bkg=bads_no_bkg))
+        used = codes >= 0
+        moments = np.empty((len(periods), len(lrf.MOMENTS)))
+        for i in range(len(lrf.MOMENTS)):
+            moments[:, i] = np.bincount(codes[used], weights=self.moments[used, i], minlength=len(periods))
+        slope, intercept, rvalue = lrf.ols_from_moments(moments, x0=self.x0, y0=self.y0)
+        return pd.DataFrame({'year': [period[0] for period in periods], 'month': [period[1] for period in periods],
+                             'n': moments[:, 0].astype(int), 'slope': slope, 'intercept': intercept, 'rvalue': rvalue})
+
+    def period_bin_moments(self, month, season, day_night=None, bads_no_bkg=None):
+        """
+        moments of each (period, WD bin) of a selection (see period_codes()). Cells with missing WD are not included
+
+        Returns
+        -------
+        periods: list of tuples
+            see period_codes()
+        moments: np.array
+            (n_periods, n_bins, 6) array with the lrf.MOMENTS of each period and bin, computed on data shifted by x0, y0
+        """
+        codes, periods = self.period_codes(month, season, self.select(day_night=day_night, bads_no_bkg=bads_no_bkg))
+        n_bins = 360 // self.bin_width
+        bins = self.cells['wd_bin'].to_numpy()
+        used = (codes >= 0) & (bins >= 0)
+        codes = codes[used]*n_bins + bins[used]
+        moments = np.empty((len(periods)*n_bins, len(lrf.MOMENTS)))
+        for i in range(len(lrf.MOMENTS)):
+            moments[:, i] = np.bincount(codes, weights=self.moments[used, i], minlength=len(periods)*n_bins)
+        return periods, moments.reshape(len(periods), n_bins, len(lrf.MOMENTS))
+
+    def subsample_slopes(self, mask, n_iter, fraction, seed=None):
+        """
+        OLS slopes of n_iter random subsamples (without replacement) of the cells of a selection, as in the robustness
+        test of lrf.fit_and_scatter_plot(). With hourly data each cell holds one row, so this is the same as
+        subsampling the rows (lrf.subsample_ols_slopes())
+
+        Returns
+        -------
+        slopes: np.array
+            slopes of the n_iter subsamples. Empty array if the subsamples contain less than two cells
+        """
+        moments = self.moments[mask & (self.moments[:, 0] > 0)]
+        n_sub = int(round(fraction * len(moments)))
+        if n_sub < 2:
+            return np.empty(0)
+        rng = np.random.default_rng(seed)
+        idx = rng.random((n_iter, len(moments))).argsort(axis=1)[:, :n_sub]
+        slopes, _, _ = lrf.ols_from_moments(moments[idx].sum(axis=1), x0=self.x0, y0=self.y0)
+        return slopes
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 09:31:44 2026
+
+@author: cosimo
+"""
+######################################################################################
+######      Batch runner of the regression pipeline over several stations       ######
+######################################################################################
+# usage: python multi_station.py --stations CMN PUY JFJ --workers 3
+# each station is processed in its own process: the station parameters of conf.stations are copied into the config
+# module of the process, so that all the pipeline functions work unchanged and write their results under ./<stat>/
+# with --incremental only the months changed by new NRT files are read and fitted again (see dsf.update_data_frame())
+
+import argparse
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import config as conf
+import dataset_functions as dsf
+import selection_functions as sel
+import parallel_functions as pf
+from results_functions import FitResultsStore
+
+# default selections performed for each station (see parallel_functions.get_config())
+DEFAULT_CONFIGS = [{'month': True,  'season': False, 'robustness': True},
+                   {'month': False, 'season': True,  'robustness': True}]
+
+def set_station(stat):
+    """ copy the parameters of the station stat from conf.stations into the config module variables """
+    if stat not in conf.stations:
+        print('ERROR: station '+stat+' not defined in conf.stations\n')
+        os.sys.exit()
+    conf.stat = stat
+    for par, value in conf.stations[stat].items():
+        setattr(conf, par, value)
+
+def run_station(stat, configs=None, use_cache=True, incremental=False):
+    """
+    run the selections and fits of a single station. Fit results tables are written to ./<stat>/res_fit/
+
+    Parameters
+    ----------
+    stat: str
+        station name (key of conf.stations)
+    configs: list of dict
+        selection configurations (see parallel_functions.get_config()). The default is None, i.e. DEFAULT_CONFIGS
+    use_cache: bool
+        read and write the cached merged DataFrame of the station. The default is True
+    incremental: bool
+        update the cached DataFrame with the new NRT data and fit again only the periods that contain new or changed
+        months, updating the fit results tables in place. The default is False
+
+    Returns
+    -------
+    stat: str
+    tables: dict
+        table_filenm -> number of fit results of the station
+    """
+    set_station(stat)
+    if configs is None:
+        configs = DEFAULT_CONFIGS
+    for dir_nm in ['res_fit'] + [str(year) for year in conf.years]:
+        os.makedirs('./'+stat+'/'+dir_nm, exist_ok=True)
+
+    if incremental:
+        data_frame, periods = dsf.update_data_frame()
+        print(stat+': '+str(len(periods))+' new or changed months')
+    else:
+        data_frame, periods = dsf.load_data_frame(use_cache=use_cache), None
+    bg_cols = ['bkg'] if 'bkg' in data_frame.columns else [] # bkg flags are available only for the stations with BaDS data
+    co_ch4_frame = data_frame[['co', 'ch4', 'Stdev_co', 'Stdev_ch4', 'DateTime', 'WD'] + bg_cols]
+
+    store = FitResultsStore() # created after set_station(), so that it writes under ./<stat>/
+    for config in configs:
+        config = pf.get_config(config)
+        store = sel.select_and_fit(co_ch4_frame, year=True, month=config['month'], season=config['season'], wd=config['wd'],
+                                   day_night=config['day_night'], plot=config['plot'], bads_no_bkg=config['bads_no_bkg'],
+                                   robustness=config['robustness'], batch_robustness=config['batch_robustness'],
+                                   seed=config['seed'], store=store, periods=periods)
+    store.flush()
+    if incremental:
+        dsf.clear_pending_periods()
+    return stat, {table_filenm: len(store.records(table_filenm)) for table_filenm in store.tables}
+
+def run_stations(stations, configs=None, max_workers=None, use_cache=True, incremental=False):
+    """
+    run the selections and fits of several stations concurrently, one process per station
+
+    Parameters
+    ----------
+    stations: list of str
+        station names (keys of conf.stations)
+    configs: list of dict
+        selection configurations used for all the stations. The default is None, i.e. DEFAULT_CONFIGS
+    max_workers: int
+        number of processes. The default is None, i.e. conf.n_workers (one per station if conf.n_workers==None)
+    use_cache: bool
+        read and write the cached merged DataFrames. The default is True
+    incremental: bool
+        incremental update of the stations (see run_station()). The default is False
+
+    Returns
+    -------
+    results: dict
+        stat -> {table_filenm: number of fit results}
+    """
+    if max_workers is None:
+        max_workers = conf.n_workers or len(stations)
+    max_workers = min(max_workers, len(stations))
+    # a new process for each station: the config variables set by set_station() are not carried over to the next station
+    context = mp.get_context('spawn')
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, max_tasks_per_child=1) as executor:
+        futures = [executor.submit(run_station, stat, configs, use_cache, incremental) for stat in stations]
+        for future in futures:
+            stat, tables = future.result()
+            results[stat] = tables
+            print('station '+stat+' done: '+', '.join(table+' ('+str(n)+' fits)' for table, n in tables.items()))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the regression pipeline over several stations')
+    parser.add_argument('--stations', nargs='+', default=list(conf.stations), help='stations to process (keys of conf.stations)')
+    parser.add_argument('--workers',  type=int, default=None, help='number of processes (default: one per station)')
+    parser.add_argument('--no-cache', action='store_true', help='rebuild the merged DataFrames without using the cache')
+    parser.add_argument('--incremental', action='store_true', help='fit again only the months changed by new NRT data')
+    args = parser.parse_args()
+    run_stations(args.stations, max_workers=args.workers, use_cache=not args.no_cache, incremental=args.incremental)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 13 15:20:11 2026
+
+@author: cosimo
+"""
+######################################################################################
+######      Parallel execution of the selections of select_and_fit()            ######
+######################################################################################
+
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import selection_functions as sel
+import lin_reg_functions as lrf
+import formatting_functions as fmt
+import config as conf
+import instrument_functions as instr
+from results_functions import FitResultsStore
+
+_shared_frame = None    # input frame of the worker processes (inherited read-only when the fork start method is available)
+_shared_episodes = None # bkg episodes of the input frame (see sel.bkg_episodes())
+
+def _init_worker(df, episodes=None):
+    global _shared_frame, _shared_episodes
+    _shared_frame = df
+    _shared_episodes = episodes
+
+def get_config(config):
+    """
+    complete a selection configuration with the default values of the optional parameters
+
+    Parameters
+    ----------
+    config: dict
+        selection configuration with the select_and_fit() parameters: 'month', 'season', 'wd', 'day_night', 'bads_no_bkg',
+        'robustness' and optionally 'plot' (default False), 'batch_robustness' (default True) and 'seed' (default None)
+    """
+    out_config = {'month': False, 'season': False, 'wd': None, 'day_night': None, 'bads_no_bkg': None, 'robustness': False,
+                  'plot': False, 'batch_robustness': True, 'seed': None}
+    out_config.update(config)
+    return out_config
+
+def get_fit_tasks(df, configs):
+    """
+    list the independent (config, period) fit tasks of the given selection configurations
+
+    Returns
+    -------
+    tasks: list of tuples
+        (config index, config, year, period, rows) for each task in the same order used by select_and_fit(). rows are
+        the positions of the period rows in df
+    """
+    tasks = []
+    positions = np.arange(len(df))
+    pos_frame = pd.DataFrame({'DateTime': df['DateTime'].to_numpy(), 'pos': positions}) # light frame used to group the row positions
+    years = df['DateTime'].dt.year.to_numpy()
+    for i, config in enumerate(configs):
+        if config['month'] | config['season']:
+            for year, period, frame in sel.iter_periods(pos_frame, month=config['month'], season=config['season']):
+                tasks.append((i, config, year, period, frame['pos'].to_numpy()))
+        else:
+            for year in conf.years:
+                tasks.append((i, config, year, config['month'], positions[years==year]))
+    return tasks
+
+def _run_fit_task(task):
+    """ perform the selection and the fit of a single task on the shared frame. Returns None if there are not enough data """
+    i, config, year, period, rows = task
+    frame = _shared_frame.iloc[rows]
+    if config['month'] | config['season']:
+        frame = sel.select_daytime(frame, day=config['day_night'])
+        frame = sel.select_wd(frame, wd=config['wd'])
+        frame = sel.select_non_bkg(frame, config['bads_no_bkg'], episodes=_shared_episodes)
+        if len(frame) <= 1:
+            return None
+    return lrf.fit_and_scatter_plot(frame, year=year, month=period, wd=config['wd'], day_night=config['day_night'],
+                                    plot=config['plot'], non_bkg=config['bads_no_bkg'], robustness=config['robustness'],
+                                    batch_robustness=config['batch_robustness'], seed=config['seed'], write=False)
+
+def parallel_select_and_fit(df, configs, max_workers=None):
+    """
+    Run select_and_fit() over several selection configurations, distributing the independent (config, period) fits over
+    a pool of processes. Results are gathered in the task order, so the fit results tables are identical to the ones
+    written by serial select_and_fit() runs
+
+    Parameters
+    ----------
+    df : DataFrame
+        dataframe to perform selection (shared read-only with the worker processes)
+    configs : list of dict
+        selection configurations (see get_config())
+    max_workers : int
+        number of worker processes. The default is None, i.e. conf.n_workers (all the available cores if conf.n_workers==None)
+
+    Returns
+    -------
+    store : FitResultsStore
+        store with the fit results tables of all the configurations (already flushed to ./<stat>/res_fit/)
+    """
+    if max_workers is None:
+        max_workers = conf.n_workers or os.cpu_count()
+    configs = [get_config(config) for config in configs]
+    species, suff = fmt.get_species_suffix(df)
+    table_filenms = []
+    for config in configs:
+        if config['month'] & config['season']:
+            print('ERROR: both month and season selected\n')
+            os.sys.exit()
+        _, _, table_filenm = fmt.format_title_filenm(True, config['month'], config['season'], config['wd'], config['day_night'],
+                                                     suff, config['bads_no_bkg'], config['robustness'])
+        table_filenms.append(table_filenm)
+
+    tasks = get_fit_tasks(df, configs)
+    episodes = sel.bkg_episodes(df) if any(config['bads_no_bkg'] != None for config in configs) else None
+    if 'fork' in mp.get_all_start_methods():
+        context = mp.get_context('fork') # workers inherit the frame without pickling it
+    else:
+        context = mp.get_context()
+    # NB: the stages timed inside the worker processes are not collected, only the total time of the pool
+    with instr.stage('parallel_select_and_fit', rows_in=len(df), tasks=len(tasks)):
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker, initargs=(df, episodes)) as executor:
+            records = list(executor.map(_run_fit_task, tasks, chunksize=max(1, len(tasks)//(4*max_workers))))
+
+    # gather the results in the task order
+    store = FitResultsStore()
+    for table_filenm in table_filenms:
+        store.clear(table_filenm) # remove older fit results
+    for task, record in zip(tasks, records):
+        if record is not None:
+            store.add(table_filenms[task[0]], record)
+    store.flush(table_filenms)
+    return store
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:20:51 2026
+
+@author: cosimo
+"""
+######################################################################################
+######        Deferred rendering of the figures of the regression pipeline      ######
+######################################################################################
+# The fit and emission functions can queue their figures in a PlotQueue instead of drawing them inline: only the data
+# needed to draw each figure is stored (arrays, fit coefficients, titles) and all the figures are rendered afterwards
+# by PlotQueue.render() in a pool of processes with the non-interactive Agg backend.
+# Each render_*() function draws one kind of figure and is also used by the inline (plot=True, no queue) mode, so that
+# deferred and inline figures are identical. matplotlib is imported only inside the render functions
+
+import hashlib
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cache_functions as cache
+import config as conf
+import instrument_functions as instr
+
+def render_fit_scatter(filenm, title, x, y, color, xvals, ort_coef, lin_coef, thsen_coef, xlabel, ylabel, fit_text):
+    """ scatter plot of the data and orthogonal, linear and Theil-Sen best fit lines (see lrf.fit_and_scatter_plot()) """
+    import matplotlib.pyplot as plt
+    fig, ax=plt.subplots(1,1, figsize=(5,5))
+    fig.suptitle(title)
+    ax.scatter(x, y, marker='o', facecolors='none', edgecolors=color)
+    ax.plot(xvals, np.poly1d(ort_coef)(xvals), color ='r',label='orthogonal regression')
+    ax.plot(xvals, np.poly1d(lin_coef)(xvals), color ='purple', label='linear regression')
+    ax.plot(xvals, thsen_coef[0]*xvals + thsen_coef[1], color ='blue', label='Theil-Sen regression')
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.legend(loc='upper left')
+    ax.grid()
+    # add fit information:
+    props = dict(boxstyle='round', facecolor='wheat', alpha=0.7)
+    if fit_text is not None:
+        ax.text(0.55, 0.05, fit_text, transform=ax.transAxes, bbox=props)
+    plt.savefig(filenm, format='pdf')
+    plt.close(fig)
+
+def render_ch4_emis(filenm, title, years, ch4_emi, emi_years, emi, emi_err):
+    """ EDGAR and CO-estimated yearly CH4 emissions (see evem.eval_ch4_emis()) """
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(1,1, figsize = (9,5))
+    fig.suptitle(title)
+    ax.errorbar(emi_years, emi, emi_err, fmt='.', elinewidth=1, capsize=3)
+    ax.scatter(years, ch4_emi, c='C1')
+    ax.set_xlabel('years')
+    ax.set_ylim(0,max(np.asarray(emi)+np.asarray(emi_err))*1.05)
+    ax.set_ylabel('CH$_4$ total emission [t]')
+    ax.grid()
+    fig.savefig(filenm, format = 'pdf')
+    plt.close(fig)
+
+def render_monthly_slope(filenm, title, mean_slope, mean_slope_weak):
+    """ mean monthly slopes of the robust and of all the fits (see evem.eval_ch4_emis()) """
+    import matplotlib.pyplot as plt
+    fig1, ax1 = plt.subplots(1,1, figsize = (9,5))
+    fig1.suptitle(title)
+    months = np.arange(1,13,1)
+    ax1.plot(months,mean_slope, marker='.', ls='-', label='robust data', markersize=15)
+    ax1.plot(months,mean_slope_weak, marker='.', ls='-',label='all data')
+    ax1.set_xticks(months)
+    ax1.set_xticklabels(['jan','feb','mar','apr','may','jun','jul','aug','sept','oct','nov','dec'])
+    ax1.grid()
+    ax1.legend()
+    fig1.savefig(filenm, format = 'pdf')
+    plt.close(fig1)
+
+def render_boxplot(filenm, title, month, ch4, co, ch4_co):
+    """ boxplot of the daily CH4, CO and CH4/CO values of each month (see evem.boxplot()) """
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mticker
+    import seaborn
+    from matplotlib import rcParams, rcParamsDefault
+    df = pd.DataFrame({'month': month, 'ch4': ch4, 'co': co, 'ch4_co': ch4_co})
+    plt.style.use('seaborn-v0_8-white' if 'seaborn-v0_8-white' in plt.style.available else 'seaborn-white') # renamed in matplotlib 3.6
+    plt.rc('font', size=30) #controls default text size
+
+    fig,ax = plt.subplots(3,1, figsize=(20,20))
+    cols = ['ch4','co','ch4_co']
+    colors = ['#70a1c2', '#aab16b', '#a17a8d']
+    labels = ['CH$_4$ [ppb]', 'CO [ppb]', 'CH$_4$/CO [-]']
+    myLocator = mticker.MultipleLocator(3)
+    mylocator = mticker.MultipleLocator(1)
+
+    for i in range(len(cols)):
+        seaborn.boxplot(ax=ax[i],x='month', y = cols[i], data=df, color=colors[i], showfliers=True)
+        ax[i].grid(which='both')
+        ax[i].set_ylabel(labels[i])
+        ax[i].xaxis.set_major_locator(myLocator)
+        ax[i].xaxis.set_minor_locator(mylocator)
+
+    ax[2].set_xlabel('')
+    fig.autofmt_xdate(rotation=45)
+    fig.subplots_adjust(hspace=0.1)
+    fig.suptitle(title, fontsize=30)
+    plt.savefig(filenm, format = 'pdf')
+    plt.close(fig)
+    rcParams.update(rcParamsDefault)
+
+def sin_fun(x,a,b,c):
+    """ sinusoidal function used to fit the mean seasonal cycles """
+    return a*np.sin(b*x)+c
+
+def render_season_fit(filenm, title, mean_co, mean_ch4, mean_ratio, p_opt):
+    """ mean seasonal cycles and their sinusoidal fits (see evem.fit_season_emissions()) """
+    import matplotlib.pyplot as plt
+    months = np.arange(1,13)
+    fig,ax=plt.subplots(3,1, figsize=(7,7))
+    point_size=30
+    ax[0].scatter(months, mean_co, color='C0', s=point_size)
+    ax[0].set_ylim(0.8*min(mean_co), 1.2*max(mean_co))
+    ax[0].set_ylabel('CO [ppb]')
+    ax[0].plot(months,sin_fun(months,*p_opt[0]), c='C0')
+
+    ax[1].scatter(months, mean_ch4, color='C1', s=point_size)
+    ax[1].set_ylim(0.99*min(mean_ch4), 1.01*max(mean_ch4))
+    ax[1].set_ylabel('CH$_4$ [ppb]')
+    ax[1].plot(months,sin_fun(months,*p_opt[1]), c='C1')
+
+    ax[2].scatter(months, mean_ratio, color='C2', s=point_size)
+    ax[2].set_ylim(0.8*min(mean_ratio), 1.2*max(mean_ratio))
+    ax[2].set_ylabel('CH$_4$/CO [-]')
+    ax[2].plot(months,sin_fun(months,*p_opt[2]), c='C2')
+
+    xlabels=['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug','Sep','Oct','Nov','Dec']
+
+    for axis in ax:
+        axis.set_xticks(months)
+        axis.grid()
+    ax[2].set_xticklabels(xlabels)
+    fig.autofmt_xdate(rotation=45)
+    fig.suptitle(title)
+    plt.savefig(filenm)
+    plt.close(fig)
+
+RENDERERS = {'fit_scatter'  : render_fit_scatter,
+             'ch4_emis'     : render_ch4_emis,
+             'monthly_slope': render_monthly_slope,
+             'boxplot'      : render_boxplot,
+             'season_fit'   : render_season_fit}
+
+def render(kind, filenm, data):
+    """ draw and save a figure of the given kind """
+    with instr.stage('plot_'+kind):
+        RENDERERS[kind](filenm, **data)
+
+def payload_hash(kind, data):
+    """ digest of the inputs of a figure: arrays enter with their dtype, shape and content, the other values with repr() """
+    digest = hashlib.sha1(kind.encode())
+    for name in sorted(data):
+        value = data[name]
+        digest.update(name.encode())
+        if isinstance(value, np.ndarray):
+            digest.update((str(value.dtype) + str(value.shape)).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+def _render_job(job):
+    """ render a queued figure in a worker process with the Agg backend """
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    kind, filenm, data = job
+    render(kind, filenm, data)
+    return filenm
+
+class PlotQueue:
+    """
+    Figures queued for deferred rendering. Each figure is stored as (kind, filenm, data), where kind is a key of
+    RENDERERS and data holds the keyword arguments of the render function
+    """
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, kind, filenm, **data):
+        """ queue a figure. Array-like data are stored as numpy arrays """
+        data = {name: np.asarray(value) if hasattr(value, '__array__') else value for name, value in data.items()}
+        self.jobs.append((kind, filenm, data))
+
+    @instr.timed('render_queue')
+    def render(self, max_workers=None, skip_unchanged=True):
+        """
+        render all the queued figures in a pool of processes and empty the queue
+
+        Parameters
+        ----------
+        max_workers : int
+            number of worker processes. The default is None, i.e. conf.n_workers (all the available cores if
+            conf.n_workers==None). With max_workers==1 the figures are rendered in this process
+        skip_unchanged : bool
+            do not render the figures whose file exists and whose inputs are the same of the last rendering. The
+            digests of the inputs are kept in the cache directory. The default is True
+
+        Returns
+        -------
+        rendered : list of str
+            file names of the rendered figures
+        """
+        manifest_nm = conf.stat + '_plots'
+        digests = cache.read_manifest(manifest_nm)
+        jobs, new_digests = [], {}
+        for kind, filenm, data in self.jobs:
+            digest = payload_hash(kind, data)
+            if skip_unchanged and (digests.get(filenm) == digest) and os.path.exists(filenm):
+                continue
+            jobs.append((kind, filenm, data))
+            new_digests[filenm] = digest
+        self.jobs = []
+
+        if max_workers is None:
+            max_workers = conf.n_workers or os.cpu_count()
+        if (max_workers == 1) or (len(jobs) <= 1): # render in this process with the current backend
+            rendered = []
+            for kind, filenm, data in jobs:
+                render(kind, filenm, data)
+                rendered.append(filenm)
+        else:
+            if 'fork' in mp.get_all_start_methods():
+                context = mp.get_context('fork') # workers do not need to import again the calling script
+            else:
+                context = mp.get_context()
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs)), mp_context=context) as executor:
+                rendered = list(executor.map(_render_job, jobs))
+
+        digests.update(new_digests)
+        cache.write_manifest(manifest_nm, digests)
+        return rendered
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 14 09:12:48 2026
+
+@author: cosimo
+"""
+######################################################################################
+######            In-memory store of the fit results tables                     ######
+######################################################################################
+
+import os
+from collections import namedtuple
+import pandas as pd
+import config as conf
+import instrument_functions as instr
+
+try: # the columnar copy of the tables is written in parquet when pyarrow is available, pickle otherwise
+    import pyarrow
+    COLUMNAR_FORMAT = 'parquet'
+except ImportError:
+    COLUMNAR_FORMAT = 'pkl'
+
+# one row of a fit results table
+FitRecord = namedtuple('FitRecord', ['year', 'month', 'slope', 'slope_sd', 'red_chi2', 'mean_slope_sub', 'slope_sd_sub', 'r2', 'robust'])
+
+def format_fit_line(record):
+    """ format a FitRecord as a line of the legacy space-separated fit results table """
+    return (str(record.year) +' '+ record.month + ' ' +
+            str(round(record.slope,2)) +  ' ' +
+            str(round(record.slope_sd,2)) +  ' ' +
+            str(round(record.red_chi2,3) ) + ' ' +
+            str(round(record.mean_slope_sub,3) ) + ' ' +
+            str(round(record.slope_sd_sub,3) ) + ' ' +
+            str(round(record.r2,3) ) + ' ' +
+            str(record.robust) + '\n')
+
+class FitResultsStore:
+    """
+    Fit results tables accumulated in memory as FitRecord rows. Each table holds one record for each (year, month) key:
+    adding a record for an existing key replaces it in place. The tables are written to disk only by flush(), both in the
+    legacy space-separated format (./<stat>/res_fit/<table>.txt) and in a columnar format (same name, .parquet or .pkl)
+    """
+    def __init__(self, stat=None):
+        self.stat = stat if stat is not None else conf.stat
+        self.tables = {} # table_filenm -> {(year, month): FitRecord}
+
+    def add(self, table_filenm, record):
+        """ add a FitRecord to the table table_filenm (e.g. 'fit_results_monthly_robust.txt') """
+        self.tables.setdefault(table_filenm, {})[(record.year, record.month)] = record
+
+    def discard(self, table_filenm, year, month):
+        """ remove the record of the (year, month) key from a table, if any """
+        self.tables.get(table_filenm, {}).pop((year, month), None)
+
+    def clear(self, table_filenm):
+        """ remove all the records of a table """
+        self.tables[table_filenm] = {}
+
+    def records(self, table_filenm):
+        """ list of the records of a table in insertion order """
+        return list(self.tables.get(table_filenm, {}).values())
+
+    def to_frame(self, table_filenm):
+        """ table as a DataFrame with the same columns of the legacy text table """
+        return pd.DataFrame(self.records(table_filenm), columns=FitRecord._fields)
+
+    def get_path(self, table_filenm):
+        return './'+self.stat+'/res_fit/'+table_filenm
+
+    def flush(self, table_filenms=None):
+        """
+        write the tables to disk in the legacy and columnar formats. Each file is written to a temporary file and then
+        renamed, so that readers never see a partially written table
+
+        Parameters
+        ----------
+        table_filenms : list of str
+            tables to write. The default is None, i.e. all the tables in the store
+        """
+        if table_filenms is None:
+            table_filenms = list(self.tables)
+        with instr.stage('flush_tables', tables=len(table_filenms)):
+            self._flush(table_filenms)
+
+    def _flush(self, table_filenms):
+        for table_filenm in table_filenms:
+            txt_filenm = self.get_path(table_filenm)
+            os.makedirs(os.path.dirname(txt_filenm), exist_ok=True)
+            file = open(txt_filenm + '.tmp', 'w')
+            file.write(' '.join(FitRecord._fields) + '\n')
+            for record in self.records(table_filenm):
+                file.write(format_fit_line(record))
+            file.close()
+            os.replace(txt_filenm + '.tmp', txt_filenm)
+
+            col_filenm = txt_filenm[:-4] + '.' + COLUMNAR_FORMAT
+            frame = self.to_frame(table_filenm)
+            frame['robust'] = frame['robust'].astype(str) # True/False/None as in the text table
+            if COLUMNAR_FORMAT == 'parquet':
+                frame.to_parquet(col_filenm + '.tmp')
+            else:
+                frame.to_pickle(col_filenm + '.tmp')
+            os.replace(col_filenm + '.tmp', col_filenm)
+
+    def load(self, table_filenm):
+        """
+        read a table from disk (columnar format if available, legacy text otherwise) replacing the records in the store.
+        Nothing is done if the table does not exist
+        """
+        txt_filenm = self.get_path(table_filenm)
+        col_filenm = txt_filenm[:-4] + '.' + COLUMNAR_FORMAT
+        if os.path.exists(col_filenm):
+            frame = pd.read_parquet(col_filenm) if COLUMNAR_FORMAT == 'parquet' else pd.read_pickle(col_filenm)
+        elif os.path.exists(txt_filenm):
+            frame = pd.read_csv(txt_filenm, sep=' ', dtype={'month': str, 'robust': str})
+            frame['month'] = frame['month'].fillna('') # empty month field of the yearly tables
+        else:
+            return
+        self.clear(table_filenm)
+        for row in frame.itertuples(index=False):
+            robust = {'True': True, 'False': False}.get(row.robust, None)
+            self.add(table_filenm, FitRecord(int(row.year), row.month, *row[2:8], robust))
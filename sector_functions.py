@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:27 2026
+
+@author: cosimo
+"""
+######################################################################################
+######          Wind sector sweeps of the CH4:CO OLS regressions                ######
+######################################################################################
+# The OLS sufficient statistics of each (period, WD bin) are summed from the cells of a moment_functions.MomentCube,
+# built with a single pass over the rows. The OLS slope and correlation of any sector made of contiguous bins
+# (wraparound through North included) are then assembled from the bin statistics, without touching the rows again.
+# NB: sector edges must be multiples of bin_width and each bin covers [i*bin_width, (i+1)*bin_width), while select_wd()
+# excludes both edges: results differ from select_wd() + linregress only for WD values that fall exactly on the edges.
+# Couples with missing values are skipped (linregress would return nan). The bkg/non-bkg selections use the episodes
+# of select_non_bkg() (minimum duration conf.min_bkg_duration_h), as select_and_fit() does
+
+import numpy as np
+import pandas as pd
+import lin_reg_functions as lrf
+import moment_functions as mom
+from moment_functions import WD_BIN_WIDTH, wd_bin, sector_bins # WD bins shared with the moment cube
+
+def get_sectors(width=30, step=10):
+    """ list of the wd strings ('wd_min-wd_max') of the sectors of the given width [deg] starting every step degrees """
+    return [str(start)+'-'+str((start+width) % 360) for start in range(0, 360, step)]
+
+def period_moments(df, month, season, bin_width=WD_BIN_WIDTH, day_night=None, bads_no_bkg=None, episodes=None, cube=None):
+    """
+    OLS sufficient statistics of each (period, WD bin) of the CH4 vs CO data of df
+
+    Parameters
+    ----------
+    df: DataFrame
+        input data with DateTime, WD and the co and ch4 columns (see fmt.get_species_suffix())
+    month, season: bool
+        monthly (month==True), seasonal (season==True) or yearly periods (both False). Only the conf.years are used
+    bin_width: int
+        width of the WD bins [deg]. 360 must be a multiple of bin_width. The default is WD_BIN_WIDTH
+    day_night: bool
+        daytime (True) or nighttime (False) selection. The default is None (no selection)
+    bads_no_bkg: bool
+        select only non-bkg (True) or bkg (False) data as sel.select_non_bkg(). The default is None (no selection)
+    episodes: tuple
+        bkg episodes of df (see sel.bkg_episodes()). The default is None, i.e. they are computed on df if needed
+    cube: mom.MomentCube
+        moment cube of df, to reuse it over many sweeps. The default is None, i.e. it is built from df (bin_width and
+        episodes are then ignored)
+
+    Returns
+    -------
+    periods: list of tuples
+        (year, period) of each period in chronological order. period is the month name, the season or '' (yearly)
+    moments: np.array
+        (n_periods, n_bins, 6) array with the lrf.MOMENTS of each period and bin
+    x0, y0: float
+        shifts used to compute the moments (see lrf.group_moments())
+    """
+    if cube is None:
+        cube = mom.MomentCube(df, bin_width=bin_width, episodes=episodes)
+    periods, moments = cube.period_bin_moments(month, season, day_night=day_night, bads_no_bkg=bads_no_bkg)
+    return periods, moments, cube.x0, cube.y0
+
+def wd_sweep(df, sectors=None, month=True, season=False, day_night=None, bads_no_bkg=None, bin_width=WD_BIN_WIDTH, episodes=None, cube=None):
+    """
+    OLS fits of CH4 vs CO for many wind sectors and periods with a single pass over the data
+
+    Parameters
+    ----------
+    df: DataFrame
+        input data (see period_moments())
+    sectors: list of str
+        sectors as 'wd_min-wd_max' strings (see select_wd()). The default is None, i.e. get_sectors()
+    month, season, day_night, bads_no_bkg, bin_width, episodes, cube:
+        see period_moments()
+
+    Returns
+    -------
+    sweep: DataFrame
+        one row for each (sector, period), sector-major, with columns 'sector', 'year', 'month', 'n', 'slope',
+        'intercept', 'rvalue' (as the r2 column of the fit results tables) and 'r2' (squared rvalue)
+    """
+    if sectors is None:
+        sectors = get_sectors()
+    periods, moments, x0, y0 = period_moments(df, month, season, bin_width=bin_width, day_night=day_night, bads_no_bkg=bads_no_bkg,
+                                              episodes=episodes, cube=cube)
+    n_bins = moments.shape[1] # bins of the cube (bin_width is ignored when cube is given)
+    # circular cumulative sums over the bins: the sum of the bins [first, first+length) is cum[first+length]-cum[first]
+    cum = np.concatenate([np.zeros((len(periods), 1, moments.shape[2])), np.cumsum(np.concatenate([moments, moments], axis=1), axis=1)], axis=1)
+    first, length = np.array([sector_bins(sector, 360 // n_bins) for sector in sectors]).reshape(-1, 2).T
+    sector_moments = cum[:, first + length, :] - cum[:, first, :] # (n_periods, n_sectors, 6)
+    sector_moments = np.swapaxes(sector_moments, 0, 1)            # (n_sectors, n_periods, 6)
+    slope, intercept, rvalue = lrf.ols_from_moments(sector_moments, x0=x0, y0=y0)
+    return pd.DataFrame({'sector'   : np.repeat(sectors, len(periods)),
+                         'year'     : np.tile([period[0] for period in periods], len(sectors)),
+                         'month'    : np.tile([period[1] for period in periods], len(sectors)),
+                         'n'        : sector_moments[:, :, 0].ravel().astype(int),
+                         'slope'    : slope.ravel(),
+                         'intercept': intercept.ravel(),
+                         'rvalue'   : rvalue.ravel(),
+                         'r2'       : rvalue.ravel()**2})
+
+def sweep_table(sweep, value='slope'):
+    """ sector x period table of one of the wd_sweep() columns (e.g. 'slope', 'r2' or 'n') """
+    sectors = pd.unique(sweep['sector'])
+    periods = list(zip(sweep['year'], sweep['month']))[:len(sweep)//len(sectors)]
+    return pd.DataFrame(sweep[value].to_numpy().reshape(len(sectors), len(periods)), index=pd.Index(sectors, name='sector'),
+                        columns=pd.MultiIndex.from_tuples(periods, names=['year', 'month']))
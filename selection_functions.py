@@ -10,13 +10,17 @@ Created on Wed Oct 13 11:39:17 2021
 ######################################################################################
 
 import datetime as dt
-from suntime import Sun
 import numpy as np 
 import lin_reg_functions as lrf
 import formatting_functions as fmt
+import time_index_functions as tif
+import instrument_functions as instr
 import os
 import config as conf
-from pandas import concat
+from results_functions import FitResultsStore
+from pandas import concat, DataFrame, Series, factorize
+
+SEASONS = ['DJF','MAM','JJA','SON']
 
 def select_year(df, year):
     """ select one year of data
@@ -31,6 +35,8 @@ def select_year(df, year):
     out_df:
         output dataframe
     """
+    if tif.is_time_sorted(df): # binary search on the sorted DateTime
+        return tif.time_slice(df, dt.datetime(year,1,1), dt.datetime(year+1,1,1))
     out_df = df[(df['DateTime'].dt.year==year)]
     return out_df
     
@@ -46,7 +52,8 @@ def select_month(df, year, month):
     -------
     out_df
     """
-    
+    if tif.is_time_sorted(df): # binary search on the sorted DateTime
+        return tif.time_slice(df, dt.datetime(year,month,1), dt.datetime(year+month//12,month%12+1,1))
     out_df = df[(df['DateTime'].dt.year==year) & (df['DateTime'].dt.month==month)]
     return out_df
 
@@ -62,7 +69,11 @@ def select_season(df, year, seas):
     -------
     out_df
     """
-
+    if tif.is_time_sorted(df): # each season is a contiguous time range (DJF: from December to February of year+1)
+        first_month = {'DJF': 12, 'MAM': 3, 'JJA': 6, 'SON': 9}[seas]
+        start = dt.datetime(year, first_month, 1)
+        end = dt.datetime(year+1, 3, 1) if seas == 'DJF' else dt.datetime(year, first_month+3, 1)
+        return tif.time_slice(df, start, end)
     if seas == 'MAM':
         out_df = df[(df['DateTime'].dt.year==year) & ((df['DateTime'].dt.month==3)|(df['DateTime'].dt.month==4)|(df['DateTime'].dt.month==5))]
     if seas == 'JJA':
@@ -76,6 +87,85 @@ def select_season(df, year, seas):
     return out_df
 
 
+def period_keys(df):
+    """ 
+    compute once the year, month and season keys of each row of the dataframe
+
+    Parameters
+    ----------
+    df: dataframe with DateTime column
+
+    Returns
+    -------
+    keys: DataFrame
+        frame with the same index of df and columns 'year', 'month', 'season' (index of the season in SEASONS) and 
+        'season_year'. As in select_season(), December is assigned to the DJF season of its own year while January 
+        and February are assigned to the DJF season of the previous year
+    """
+    year  = df['DateTime'].dt.year.to_numpy()
+    month = df['DateTime'].dt.month.to_numpy()
+    return DataFrame({'year'       : year,
+                      'month'      : month,
+                      'season'     : (month % 12) // 3,  # 0=DJF, 1=MAM, 2=JJA, 3=SON
+                      'season_year': year - (month < 3)}, # Jan and Feb belong to the previous year DJF
+                     index=df.index)
+
+def iter_periods(df, month, season, years=None):
+    """
+    iterate over the monthly or seasonal selections of df with a single groupby. Selection cost is O(n) in total
+    instead of O(n) per period as with select_month() and select_season()
+
+    Parameters
+    ----------
+    df: dataframe 
+    month, season: bool
+        iterate over (year, month) if month==True or over (year, season) if season==True
+    years: list
+        years to iterate over. The default is None, i.e. conf.years
+
+    Yields
+    -------
+    year, period, frame: 
+        year, period (month number or season string) and selected frame, in chronological order
+    """
+    if years is None:
+        years = conf.years
+    if tif.is_time_sorted(df): # periods are contiguous blocks of rows: no groupby needed
+        year = df['DateTime'].dt.year.to_numpy().astype(int)
+        month_key = year*12 + df['DateTime'].dt.month.to_numpy() - 1 # months since year 0, non-decreasing
+        if month:
+            starts, stops = tif.period_runs(month_key)
+            runs = [(month_key[i]//12, month_key[i]%12 + 1, i, j) for i, j in zip(starts, stops)]
+        elif season:
+            season_key = (month_key - 2)//3 # 4*season_year + 0 (MAM), 1 (JJA), 2 (SON), 3 (DJF)
+            starts, stops = tif.period_runs(season_key)
+            runs = sorted((season_key[i]//4, (season_key[i]%4 + 1)%4, i, j) for i, j in zip(starts, stops)) # as groupby
+        for year, period, i, j in runs:
+            if year in years:
+                period = SEASONS[period] if season else int(period)
+                yield int(year), period, df.iloc[i:j]
+        return
+    keys = period_keys(df)
+    if month:
+        by = [keys['year'], keys['month']]
+    elif season:
+        by = [keys['season_year'], keys['season']]
+    for (year, period), frame in df.groupby(by, sort=True):
+        if year in years:
+            period = SEASONS[period] if season else int(period)
+            yield int(year), period, frame
+
+def changed_periods(periods, month, season):
+    """
+    set of the monthly (year, month), seasonal (year, season) or yearly (year) selections that contain the given
+    (year, month) couples. Seasons follow the same convention of period_keys()
+    """
+    if month:
+        return set((year, m) for year, m in periods)
+    elif season:
+        return set((year - (m < 3), SEASONS[(m % 12) // 3]) for year, m in periods)
+    return set(year for year, m in periods)
+
 def select_wd(df, wd):
     """ select data for wind from a given wind direction
     
@@ -102,58 +192,175 @@ def select_wd(df, wd):
     else:
         return df
 
-def select_daytime(df, day):
+def sun_times(dates, lat, lon, zenith=90.8):
     """
-    add a bool column ('day?') to the input dataframe. Values are set to True if correspond to daytime, False otherwise
+    evaluate sunrise and sunset UTC times for an array of dates. Vectorized version of the algorithm used by 
+    suntime.Sun.get_sunrise_time() and get_sunset_time()
+
+    Parameters
+    ----------
+    dates : array-like of datetime64
+        dates (i.e. datetimes at 00:00) to evaluate sunrise and sunset times
+    lat, lon : float
+        coordinates of the station
+    zenith : float
+        sun reference zenith. The default is 90.8 (same as suntime)
+    Returns
+    -------
+    sunrise, sunset : np.array of datetime64[ns]
+        sunrise and sunset UTC times. NaT if the sun is always up or always down in that date
+    always_up : np.array of bool
+        True for the dates where the sun never sets (midnight sun)
+    """
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    lng_hour = lon / 15
+    day_of_year = (dates - dates.astype('datetime64[Y]')).astype(int) + 1
+    to_rad = np.pi/180.
+    
+    out = []
+    for rise, t0 in [(True, 6), (False, 18)]:
+        t = day_of_year + ((t0 - lng_hour) / 24)
+        M = (0.9856 * t) - 3.289                     # sun's mean anomaly
+        L = M + (1.916 * np.sin(to_rad*M)) + (0.020 * np.sin(to_rad * 2 * M)) + 282.634
+        L = np.mod(L, 360)                           # sun's true longitude
+        sin_dec = 0.39782 * np.sin(to_rad*L)         # sun's declination
+        cos_dec = np.cos(np.arcsin(sin_dec))
+        cos_H = (np.cos(to_rad*zenith) - (sin_dec * np.sin(to_rad*lat))) / (cos_dec * np.cos(to_rad*lat))
+        always_up = cos_H < -1
+        with np.errstate(invalid='ignore'):
+            H = np.arccos(cos_H) / to_rad            # sun's local hour angle
+        if rise:
+            H = 360 - H
+        H = H / 15
+        RA = np.mod(np.arctan(0.91764 * np.tan(to_rad*L)) / to_rad, 360) # right ascension in the same quadrant as L
+        RA = RA + (np.floor(L/90) - np.floor(RA/90)) * 90
+        RA = RA / 15
+        T  = H + RA - (0.06571 * t) - 6.622          # local mean time of rising/setting
+        UT = np.mod(np.round(T - lng_hour, 2), 24)   # back to UTC
+        day_offset = -np.floor((UT + lng_hour) / 24) # rising/setting may fall in the previous/next UTC day
+        seconds = np.round((day_offset*24 + UT) * 3600)
+        times = dates.astype('datetime64[ns]') + np.where(np.isfinite(seconds), seconds, 0).astype('timedelta64[s]')
+        times[~np.isfinite(seconds)] = np.datetime64('NaT')
+        out.append(times)
+    return out[0], out[1], always_up
+
+def is_daytime(datetimes, lat, lon):
+    """
+    Bool array set to True for the UTC datetimes that fall between sunrise and sunset. Sunrise and sunset are 
+    evaluated only once per unique date and broadcast to the rows
+    """
+    datetimes = np.asarray(datetimes, dtype='datetime64[ns]')
+    codes, dates = factorize(datetimes.astype('datetime64[D]'))
+    sunrise, sunset, always_up = sun_times(dates, lat, lon)
+    sunrise, sunset, always_up = sunrise[codes], sunset[codes], always_up[codes]
+    return ((datetimes > sunrise) & (datetimes < sunset)) | always_up
+
+def select_daytime(df, day, lat=None, lon=None):
+    """
+    select daytime or nighttime data. The input dataframe is not modified
 
     Parameters
     ----------
     df : input dataframe
     day: select daytime (day==True) or nighttime (day==False) data. day==None to avoid data selection
+    lat, lon: station coordinates. The default is None, i.e. conf.stat_lat and conf.stat_lon
     Returns
     -------
     out_frame: selected frame
     """
     if day!=None:
-        lon_CMN, lat_CMN   = 10.70111, 44.19433 # coordinates of the station
-        sun = Sun(lat_CMN, lon_CMN) # use suntime module to get sunrise and sustet times for each day
-        day_list = [] # bool list that contains the values of the new 'day?' column 
-        for datetime in df['DateTime']:
-            date    = dt.date(datetime.year, datetime.month, datetime.day)
-            sunrise = sun.get_sunrise_time(date).timestamp() # convert to timestamp in order to compare to datetime.timestamp(). This is done to avoid problems with the time offset that is provided by get_sunrise_time() but is not present in datetime
-            sunset  = sun.get_sunset_time(date).timestamp()
-            if (datetime.timestamp() > sunrise) & (datetime.timestamp() < sunset):
-                day_list.append(True)
-            else:
-                day_list.append(False)
-        df.insert(3,'day?', day_list) # insert new column in the dataframe
-        if day==True:
-            out_frame = df[ df['day?']==True ]
-        elif day ==False:
-            out_frame = df[ df['day?']==False ]
-        else: # print erro message
-            print('ERROR: select_daytime(df, day): wrong day value')
-        del out_frame['day?'], df['day?'] # remove inserted columns
+        if lat is None:
+            lat, lon = conf.stat_lat, conf.stat_lon
+        with instr.stage('select_daytime', rows_in=len(df)) as record:
+            daytime = is_daytime(df['DateTime'], lat, lon)
+            if day==True:
+                out_frame = df[ daytime ]
+            elif day ==False:
+                out_frame = df[ ~daytime ]
+            else: # print erro message
+                print('ERROR: select_daytime(df, day): wrong day value')
+            record['rows_out'] = len(out_frame)
         return out_frame
     else:
         return df
 
-def select_non_bkg(df, non_bkg):
-    if non_bkg: # NON-background case
-        #df = df[(df['co_bg']==False) & (df['ch4_bg']==False)]
-        df = df[(df['bkg']==False)]
-    elif non_bkg == False: # background case
-        df = df[(df['bkg']==True)]
-    
-    if (non_bkg==True) | (non_bkg==False) :
-        #select only _(non-)bkg conditions that last for at least 2 hours
-        df.insert(3, 'diff_p1', df['DateTime'].diff(periods=1))
-        df.insert(4, 'diff_m1', df['DateTime'].diff(periods=-1))
-        df = df[ (df['diff_p1']>dt.timedelta(hours=1)) | (df['diff_m1']<dt.timedelta(hours=-1)) ]
-    
-    return df
+def bkg_episodes(df, max_gap_h=1):
+    """
+    run-length encoding of the bkg flag: contiguous runs of rows with the same bkg value (bkg or non-bkg episodes).
+    A run ends when the flag changes or when two consecutive rows are more than max_gap_h hours apart. Computed once
+    on the full frame, the episodes can be used by select_non_bkg() on any selection of its rows. The frame is not modified
+
+    Parameters
+    ----------
+    df: DataFrame
+        frame with DateTime and bkg columns
+    max_gap_h: float
+        max time step between consecutive rows of the same run [hours]. The default is 1 (hourly data)
+
+    Returns
+    -------
+    episodes: DataFrame
+        one row per run with columns 'start', 'end' (DateTime of the first and last row), 'length' (number of rows),
+        'duration_h' (end - start + max_gap_h, i.e. the hours covered by the hourly means of the run) and 'bkg'
+        (1 bkg, 0 non-bkg, -1 missing flag)
+    row_episode: Series
+        run of each row of df (position in episodes), with the same index of df
+    """
+    times = df['DateTime'].to_numpy()
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    state = np.where(df['bkg'].isna(), -1, df['bkg'].fillna(False).astype(int)).astype(np.int8)[order]
+    new_run = np.ones(len(times), dtype=bool)
+    new_run[1:] = (state[1:] != state[:-1]) | ((times[1:] - times[:-1]) > np.timedelta64(int(max_gap_h*3600), 's'))
+    run = np.cumsum(new_run) - 1
+    starts = np.flatnonzero(new_run)
+    stops = np.append(starts[1:], len(times))[:len(starts)]
+    row_run = np.empty(len(times), dtype=int)
+    row_run[order] = run
+    episodes = DataFrame({'start'     : times[starts],
+                          'end'       : times[stops-1],
+                          'length'    : stops - starts,
+                          'duration_h': (times[stops-1] - times[starts]) / np.timedelta64(1, 'h') + max_gap_h,
+                          'bkg'       : state[starts]})
+    return episodes, Series(row_run, index=df.index)
+
+def select_non_bkg(df, non_bkg, episodes=None, min_duration_h=None):
+    """
+    select non-bkg or bkg data that belong to bkg/non-bkg episodes lasting at least min_duration_h hours. The input
+    dataframe is not modified
+
+    Parameters
+    ----------
+    df: DataFrame
+        input dataframe with DateTime and bkg columns
+    non_bkg: bool
+        select non-bkg (True) or bkg (False) data. non_bkg==None to avoid data selection
+    episodes: tuple
+        (episodes, row_episode) returned by bkg_episodes() for a frame that contains the rows of df (e.g. the full
+        frame before the period, daytime and wd selections). The default is None, i.e. episodes are computed on df
+    min_duration_h: float
+        min duration of the episodes [hours]. The default is None, i.e. conf.min_bkg_duration_h
+
+    Returns
+    -------
+    out_df: selected dataframe
+    """
+    if non_bkg == None:
+        return df
+    if min_duration_h is None:
+        min_duration_h = conf.min_bkg_duration_h
+    if episodes is None:
+        episodes = bkg_episodes(df)
+    table, row_episode = episodes
+    with instr.stage('select_non_bkg', rows_in=len(df)) as record:
+        keep = (table['bkg'].to_numpy() == int(not non_bkg)) & (table['duration_h'].to_numpy() >= min_duration_h) # mask lookup table of the episodes
+        out_df = df[keep[row_episode.reindex(df.index).to_numpy()]]
+        record['rows_out'] = len(out_df)
+    return out_df
 
-def select_and_fit(df, year, month, season, wd, day_night, plot, bads_no_bkg, robustness):
+@instr.profiled
+@instr.timed('select_and_fit')
+def select_and_fit(df, year, month, season, wd, day_night, plot, bads_no_bkg, robustness, batch_robustness=True, seed=None, store=None, periods=None, plots=None):
     """
     Select data in dataframe and run the fit_and_scatter_plot() function according to the input parameters
     
@@ -171,53 +378,67 @@ def select_and_fit(df, year, month, season, wd, day_night, plot, bads_no_bkg, ro
         plot or not the scatterplot and fit results
     bads_bkg: bool
         wether to select only non-bkg data (True), bkg data (False) or all data (None)
+    batch_robustness, seed:
+        robustness test options (see lrf.fit_and_scatter_plot())
+    store: FitResultsStore
+        store where to add the fit results. If None (default) the results are accumulated in a new store that is 
+        flushed to ./<stat>/res_fit/ at the end of the run. If given, the caller is responsible for flushing the store
+    periods: list of tuples
+        (year, month) of the months whose data changed (e.g. from dsf.update_data_frame()). If given, only the 
+        months, seasons or years that contain those months are fitted again and their rows are updated in place in the 
+        existing fit results table, which is read from disk if it is not in the store. The default is None, i.e. fit all
+        the periods and replace the whole table
+    plots: plf.PlotQueue
+        queue for the deferred rendering of the scatter plots (see lrf.fit_and_scatter_plot()). The default is None
 
     Returns
     -------
-    None
+    store: FitResultsStore
+        store with the fit results
     """
     # get the name of older fit results files
     species, suff = fmt.get_species_suffix(df) 
     _, _, table_filenm = fmt.format_title_filenm(year, month, season, wd, day_night, suff, bads_no_bkg, robustness)
 
-    if os.path.exists('./'+conf.stat+'/res_fit/'+table_filenm): # remove older fit results 
-        os.remove('./'+conf.stat+'/res_fit/'+table_filenm)
+    flush = store is None
+    if flush:
+        store = FitResultsStore()
+    if periods is None:
+        store.clear(table_filenm) # remove older fit results
+    elif table_filenm not in store.tables:
+        store.load(table_filenm) # older fit results are updated in place
     
     if month & season:
             print('ERROR: both month and season selected\n')
             os.sys.exit()
     
     if year:
-        for year in conf.years:
-            if month:  # if month == True performs for loop over months, otherwise performs loop over years
-                # if (year == 2018) & (conf.stat=='CMN'): # skip missing first months in 2018 at CMN
-                #     months = np.arange(5,13,1)
-                # else:
-                #     months = np.arange(1,13,1)
-                months = np.arange(1,13,1)
-                for mth in months:
-                    frame = select_month(df, year, mth)                    
-                    frame = select_daytime(frame, day=day_night)
-                    frame = select_wd(frame, wd=wd)
-                    frame = select_non_bkg(frame, bads_no_bkg)
-                    if len(frame) > 1:
-                        lrf.fit_and_scatter_plot(frame, year=year, month=mth, wd=wd, day_night=day_night, plot=plot, non_bkg = bads_no_bkg, robustness=robustness)
-            elif season:
-                # if (year == 2018) & (conf.stat=='CMN'): # skip missing first months in 2018 at CMN
-                #     seasons =['JJA','SON']
-                # else:
-                #     seasons =['DJF','MAM','JJA','SON']
-                seasons =['DJF','MAM','JJA','SON']
-                for seas in seasons:
-                    
-                    frame = select_season(df, year, seas)
-                    frame = select_daytime(frame, day=day_night)
-                    frame = select_wd(frame, wd=wd)
-                    frame = select_non_bkg(frame, bads_no_bkg)
-                    if len(frame) > 1:
-                        lrf.fit_and_scatter_plot(frame, year=year, month=seas, wd=wd, day_night=day_night, plot=plot, non_bkg = bads_no_bkg, robustness=robustness)
-
-
-            else:
+        if month | season: # iterate over the (year, month) or (year, season) groups with a single groupby
+            episodes = bkg_episodes(df) if bads_no_bkg != None else None # bkg episodes of the whole frame
+            if periods is not None: # select only the rows of the periods to update
+                refit = changed_periods(periods, month, season)
+                keys = period_keys(df)
+                if month:
+                    row_keys, refit_keys = keys['year']*100 + keys['month'], [y*100 + m for y, m in refit]
+                else:
+                    row_keys, refit_keys = keys['season_year']*10 + keys['season'], [y*10 + SEASONS.index(s) for y, s in refit]
+                df = df[np.isin(row_keys.to_numpy(), refit_keys)]
+            fitted = set()
+            for year, period, frame in iter_periods(df, month=month, season=season):
+                frame = select_daytime(frame, day=day_night)
+                frame = select_wd(frame, wd=wd)
+                frame = select_non_bkg(frame, bads_no_bkg, episodes=episodes)
+                if len(frame) > 1:
+                    lrf.fit_and_scatter_plot(frame, year=year, month=period, wd=wd, day_night=day_night, plot=plot, non_bkg = bads_no_bkg, robustness=robustness, batch_robustness=batch_robustness, seed=seed, store=store, plots=plots)
+                    fitted.add((year, period))
+            if periods is not None: # remove the updated periods that have not enough data anymore
+                for year, period in refit - fitted:
+                    store.discard(table_filenm, year, fmt.get_month_str(period))
+        else:
+            years = conf.years if periods is None else [year for year in conf.years if year in changed_periods(periods, month, season)]
+            for year in years:
                 frame = select_year(df, year)
-                lrf.fit_and_scatter_plot(frame, year=year, month=month, wd=wd, day_night=day_night, plot=plot, non_bkg = bads_no_bkg, robustness=robustness)
+                lrf.fit_and_scatter_plot(frame, year=year, month=month, wd=wd, day_night=day_night, plot=plot, non_bkg = bads_no_bkg, robustness=robustness, batch_robustness=batch_robustness, seed=seed, store=store, plots=plots)
+    if flush:
+        store.flush([table_filenm])
+    return store
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 09:31:44 2026
+
+@author: cosimo
+"""
+######################################################################################
+######         Out-of-core (streamed) selections and fits of a station          ######
+######################################################################################
+# The CH4, CO and MET files (L2 then NRT) are read in time-ordered chunks of chunk_rows rows. The three streams are
+# merged up to a watermark (the earliest of the last timestamps read from each stream, since all the rows before it
+# are known for every species): each merged block is flag filtered and joined with the baselines and bkg flags as in
+# dsf.merge_station_frames(). Merged rows are kept in a buffer and each month is fitted as soon as it is complete,
+# together with the season and the year that it closes. Rows are dropped from the buffer as soon as no pending period
+# needs them, so that memory is bounded by the longest period of the selections (a month, a season or a year) plus the
+# chunks, independently of the number of years.
+# With (non-)bkg selections a month is emitted only when the bkg/non-bkg episode that runs across its end is over, so
+# that the episodes (see sel.bkg_episodes()) are the same of the in-memory pipeline.
+# NB: the streamed files must be sorted in time and the pre-ICOS 2018 CMN data (fmt.append_2018()) are not included
+
+import os
+import numpy as np
+import pandas as pd
+import formatting_functions as fmt
+import dataset_functions as dsf
+import selection_functions as sel
+import lin_reg_functions as lrf
+import parallel_functions as pf
+import time_index_functions as tif
+import config as conf
+from results_functions import FitResultsStore
+
+STREAM_CHUNK_ROWS = 200000 # rows read at once from each ICOS file
+FIT_COLUMNS = ['co', 'ch4', 'Stdev_co', 'Stdev_ch4', 'DateTime', 'WD'] # merged columns kept for the fits (+ 'bkg')
+
+def get_stream_files():
+    """ lists of the CH4, CO and MET files of the station defined in the config file (L2 and NRT files, in time order) """
+    nrt_ch4, nrt_co, nrt_met = dsf.get_nrt_files()
+    return [[conf.L2_ICOS_path + conf.L2_name_prefix     + '.CH4', nrt_ch4],
+            [conf.L2_ICOS_path + conf.L2_name_prefix     + '.CO',  nrt_co],
+            [conf.L2_ICOS_path + conf.L2_met_name_prefix + '.MTO', nrt_met]]
+
+def iter_file_chunks(file_nms, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    read consecutive ICOS L2 files in chunks of chunk_rows rows (same columns and dtypes of fmt.read_L2_ICOS_fast(),
+    with the DateTime column of dsf.read_station_frames()). The rows must be sorted in time across the files
+
+    Yields
+    ------
+    chunk: DataFrame
+    """
+    last = None
+    for file_nm in file_nms:
+        head_nlines, columns = fmt.read_L2_header(file_nm)
+        usecols = [i for i in range(len(columns)) if columns[i] in fmt.ICOS_L2_SCHEMA]
+        for chunk in pd.read_csv(file_nm, sep=';', skiprows=head_nlines, header=None, usecols=usecols, chunksize=chunk_rows, engine='c'):
+            chunk.columns = [columns[i] for i in usecols]
+            chunk = chunk.astype({col: fmt.ICOS_L2_SCHEMA[col] for col in chunk.columns})
+            fmt.insert_datetime_col(chunk, 3, 'Year', 'Month', 'Day', 'Hour', 'Minute')
+            times = chunk['DateTime'].to_numpy()
+            if len(times) == 0:
+                continue
+            if np.any(times[1:] < times[:-1]) or ((last is not None) and (times[0] < last)):
+                print('ERROR: '+file_nm+' is not sorted in time, it cannot be streamed\n')
+                os.sys.exit()
+            last = times[-1]
+            yield chunk
+
+def iter_merged_chunks(chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    stream the CH4, CO and MET files of the station and merge them up to a watermark
+
+    Yields
+    ------
+    merged, watermark:
+        merged frame (see dsf.merge_station_frames()) of all the rows with DateTime < watermark not yielded yet (None
+        if there are no such rows) and the watermark (np.datetime64, None after the end of all the streams)
+    """
+    baseline_frame = dsf.load_baseline_frame() # read once and joined to each merged block
+    streams = [iter_file_chunks(file_nms, chunk_rows) for file_nms in get_stream_files()]
+    pending = [None]*3 # rows read but not merged yet
+    last = [None]*3    # last timestamp read from each stream
+    done = [False]*3
+    while not all(done):
+        active = [i for i in range(3) if not done[i]]
+        not_started = [i for i in active if last[i] is None]
+        i = not_started[0] if not_started else min(active, key=lambda j: last[j]) # advance the stream that is behind
+        chunk = next(streams[i], None)
+        if chunk is None:
+            done[i] = True
+        else:
+            pending[i] = chunk if pending[i] is None else pd.concat([pending[i], chunk], ignore_index=True)
+            last[i] = chunk['DateTime'].to_numpy()[-1]
+        if any((last[j] is None) and (not done[j]) for j in range(3)):
+            continue # wait for the first chunk of every stream
+        watermark = None if all(done) else min(last[j] for j in range(3) if not done[j])
+        ready = []
+        for j in range(3):
+            if pending[j] is None:
+                ready.append(None)
+                continue
+            n = len(pending[j]) if watermark is None else int(np.searchsorted(pending[j]['DateTime'].to_numpy(), watermark, side='left'))
+            ready.append(pending[j].iloc[:n])
+            pending[j] = pending[j].iloc[n:].reset_index(drop=True)
+        if any((frame is None) or (len(frame) == 0) for frame in ready):
+            yield None, watermark
+        else:
+            yield dsf.merge_station_frames(*ready, baseline_frame=baseline_frame), watermark
+
+def season_start(month):
+    """ first month (np.datetime64[M]) of the season of a month, as in sel.period_keys() (Dec-Jan-Feb is DJF) """
+    return month - (int(month.astype(int)) % 12 - 2) % 3
+
+class PeriodStream:
+    """
+    Buffer of the merged rows of a streamed station. Complete months, and the seasons and years that they close, are
+    fitted as soon as they are emitted and the rows that are no longer needed are dropped
+
+    Parameters
+    ----------
+    configs: list of dict
+        selection configurations (see pf.get_config()). The plot option is ignored (no plots)
+    store: FitResultsStore
+        store where to add the fit results. The default is None, i.e. a new store
+    """
+    def __init__(self, configs, store=None):
+        self.configs = [dict(pf.get_config(config), plot=False) for config in configs]
+        for config in self.configs:
+            if config['month'] & config['season']:
+                print('ERROR: both month and season selected\n')
+                os.sys.exit()
+        self.store = store if store is not None else FitResultsStore()
+        self.need_season   = any(config['season'] for config in self.configs)
+        self.need_year     = any(not (config['month'] | config['season']) for config in self.configs)
+        self.need_episodes = any(config['bads_no_bkg'] != None for config in self.configs)
+        self.buffer = None
+        self.n_rows = 0           # rows added so far (labels of the buffer rows)
+        self.month = None         # next month to emit (np.datetime64[M])
+        self.table_filenms = None
+
+    def add(self, merged):
+        """ append a merged block (rows later than the buffered ones) to the buffer """
+        columns = FIT_COLUMNS + (['bkg'] if 'bkg' in merged.columns else [])
+        merged = merged[columns].set_axis(pd.RangeIndex(self.n_rows, self.n_rows + len(merged)))
+        self.n_rows = self.n_rows + len(merged)
+        if self.buffer is None:
+            self.buffer = merged
+            self.month = merged['DateTime'].to_numpy()[0].astype('datetime64[M]')
+            species, suff = fmt.get_species_suffix(merged)
+            self.table_filenms = [fmt.format_title_filenm(True, config['month'], config['season'], config['wd'], config['day_night'],
+                                                          suff, config['bads_no_bkg'], config['robustness'])[2] for config in self.configs]
+            for table_filenm in self.table_filenms:
+                self.store.clear(table_filenm) # remove older fit results
+        else:
+            self.buffer = pd.concat([self.buffer, merged])
+
+    def _episode_closed(self, episodes, end, watermark):
+        """ True if the bkg episode of the last row before end cannot continue after watermark """
+        table, row_episode = episodes
+        i = int(np.searchsorted(self.buffer['DateTime'].to_numpy(), np.datetime64(end, 'ns'))) - 1
+        if i < 0:
+            return True
+        episode = row_episode.iloc[i]
+        return (episode < len(table) - 1) or (watermark - table['end'].iloc[episode] > np.timedelta64(1, 'h'))
+
+    def emit(self, watermark=None):
+        """
+        fit the months completed before watermark (all the remaining months if watermark is None, i.e. at the end of
+        the streams)
+
+        Returns
+        -------
+        n_months: int
+            number of emitted months
+        """
+        n_months = 0
+        while self.buffer is not None:
+            end = self.month + 1
+            if watermark is None: # end of the data
+                times = self.buffer['DateTime'].to_numpy()
+                if (len(times) == 0) or (self.month > times[-1].astype('datetime64[M]')):
+                    break
+            elif np.datetime64(end, 'ns') > watermark:
+                break
+            episodes = sel.bkg_episodes(self.buffer) if self.need_episodes else None
+            if (watermark is not None) and self.need_episodes and not self._episode_closed(episodes, end, watermark):
+                break
+            self._fit_month(self.month, episodes)
+            self.month = end
+            n_months = n_months + 1
+            self._trim(episodes)
+        if (watermark is None) and (self.buffer is not None): # periods left open at the end of the data
+            episodes = sel.bkg_episodes(self.buffer) if self.need_episodes else None
+            last_month = self.month - 1
+            if self.need_season and (season_start(last_month) + 3 != self.month):
+                self._fit_season(season_start(last_month), self.month, episodes)
+            if self.need_year and (int(last_month.astype(int)) % 12 != 11):
+                self._fit_year(last_month.astype('datetime64[Y]'), episodes)
+        if n_months > 0:
+            self.flush()
+        return n_months
+
+    def _fit_month(self, month, episodes):
+        """ fit a month and the season and year that it closes """
+        year, month_number = int(month.astype('datetime64[Y]').astype(int)) + 1970, int(month.astype(int)) % 12 + 1
+        if year in conf.years:
+            frame = tif.time_slice(self.buffer, month, month + 1)
+            for config in self.configs:
+                if config['month']:
+                    self._fit(frame, year, month_number, config, episodes)
+        if self.need_season and (season_start(month) + 3 == month + 1):
+            self._fit_season(season_start(month), month + 1, episodes)
+        if self.need_year and (month_number == 12):
+            self._fit_year(month.astype('datetime64[Y]'), episodes)
+
+    def _fit_season(self, start, end, episodes):
+        year = int(start.astype('datetime64[Y]').astype(int)) + 1970
+        if year in conf.years:
+            frame = tif.time_slice(self.buffer, start, end)
+            for config in self.configs:
+                if config['season']:
+                    self._fit(frame, year, sel.SEASONS[(int(start.astype(int)) % 12 + 1) % 12 // 3], config, episodes)
+
+    def _fit_year(self, start, episodes):
+        year = int(start.astype(int)) + 1970
+        if year in conf.years:
+            frame = tif.time_slice(self.buffer, start, start + 1)
+            for config in self.configs:
+                if not (config['month'] | config['season']):
+                    self._fit(frame, year, False, config, episodes)
+
+    def _fit(self, frame, year, period, config, episodes):
+        """ selections and fit of one period, as in sel.select_and_fit() """
+        if config['month'] | config['season']:
+            frame = sel.select_daytime(frame, day=config['day_night'])
+            frame = sel.select_wd(frame, wd=config['wd'])
+            frame = sel.select_non_bkg(frame, config['bads_no_bkg'], episodes=episodes)
+            if len(frame) <= 1:
+                return
+        lrf.fit_and_scatter_plot(frame, year=year, month=period, wd=config['wd'], day_night=config['day_night'], plot=False,
+                                 non_bkg=config['bads_no_bkg'], robustness=config['robustness'],
+                                 batch_robustness=config['batch_robustness'], seed=config['seed'], store=self.store)
+
+    def _trim(self, episodes):
+        """ drop the buffered rows that are not needed by the pending month, season and year (and their bkg episodes) """
+        keep_from = self.month
+        if self.need_season:
+            keep_from = min(keep_from, season_start(self.month))
+        if self.need_year:
+            keep_from = min(keep_from, self.month.astype('datetime64[Y]').astype('datetime64[M]'))
+        keep_from = np.datetime64(keep_from, 'ns')
+        if self.need_episodes: # keep the whole episode that runs across keep_from
+            i = int(np.searchsorted(self.buffer['DateTime'].to_numpy(), keep_from)) - 1
+            if i >= 0:
+                table, row_episode = episodes
+                keep_from = min(keep_from, table['start'].iloc[row_episode.iloc[i]])
+        self.buffer = tif.time_slice(self.buffer, keep_from)
+
+    def flush(self):
+        """ write the fit results tables. Seasonal tables are written in the order of sel.select_and_fit() """
+        for config, table_filenm in zip(self.configs, self.table_filenms):
+            if config['season']:
+                records = self.store.tables.get(table_filenm, {})
+                self.store.tables[table_filenm] = dict(sorted(records.items(), key=lambda item: (item[0][0], sel.SEASONS.index(item[0][1]))))
+        self.store.flush(self.table_filenms)
+
+def stream_select_and_fit(configs, chunk_rows=STREAM_CHUNK_ROWS, store=None):
+    """
+    Out-of-core version of sel.select_and_fit() over several selection configurations for the station defined in the
+    config file: the ICOS files are streamed in chunks and each month is fitted as soon as it is complete. The fit
+    results tables are the same of the in-memory pipeline and are written after each emitted month
+
+    Parameters
+    ----------
+    configs: list of dict
+        selection configurations (see pf.get_config())
+    chunk_rows: int
+        rows read at once from each file. The default is STREAM_CHUNK_ROWS
+    store: FitResultsStore
+        store where to add the fit results. The default is None, i.e. a new store
+
+    Returns
+    -------
+    store: FitResultsStore
+        store with the fit results tables (already flushed to ./<stat>/res_fit/)
+    """
+    if (conf.stat=='CMN') & (conf.years[0] == 2018):
+        print('WARNING: the CMN data from January to May 2018 (not ICOS data) are not used by the streamed pipeline')
+    periods = PeriodStream(configs, store=store)
+    for merged, watermark in iter_merged_chunks(chunk_rows):
+        if (merged is not None) and (len(merged) > 0):
+            periods.add(merged)
+        periods.emit(watermark)
+    periods.emit()
+    return periods.store
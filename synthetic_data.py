@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 15 10:40:02 2026
+
+@author: cosimo
+"""
+######################################################################################
+######     Synthetic ICOS-like data for benchmarking the regression pipeline    ######
+######################################################################################
+
+import os
+import numpy as np
+import pandas as pd
+import config as conf
+import formatting_functions as fmt
+
+GAS_COLUMNS = ['#Site', 'SamplingHeight', 'Year', 'Month', 'Day', 'Hour', 'Minute', 'DecimalDate', '{spec}', 'Stdev', 'NbPoints',
+               'Flag', 'InstrumentId', 'QualityId']
+MET_COLUMNS = ['#Site', 'SamplingHeight', 'Year', 'Month', 'Day', 'Hour', 'Minute', 'DecimalDate', 'WD', 'WD-Stdev', 'WD-NbPoints',
+               'WD-Flag', 'WS', 'WS-Stdev', 'WS-NbPoints', 'WS-Flag']
+N_HEADER_LINES = 40 # header lines of the synthetic L2 files (the last one holds the column names)
+
+def synthetic_series(years, freq='1h', seed=0):
+    """
+    synthetic CO, CH4, WD and BaDS series for the given years
+
+    Parameters
+    ----------
+    years: list of int
+        years of data
+    freq: str
+        time resolution ('1h' for hourly data, '1min' for minute data)
+    seed: int
+        seed of the random generator
+
+    Returns
+    -------
+    df: DataFrame
+        frame with 'DateTime', 'co', 'ch4', 'Stdev_co', 'Stdev_ch4', 'WD', 'co_baseline', 'ch4_baseline' and 'bkg' columns
+    """
+    rng = np.random.default_rng(seed)
+    date_time = pd.date_range(str(years[0])+'-01-01', str(years[-1])+'-12-31 23:59', freq=freq)
+    n = len(date_time)
+    doy = date_time.dayofyear.to_numpy()
+    hour = date_time.hour.to_numpy()
+    co_baseline  = 110 + 25*np.cos(2*np.pi*(doy-30)/365)
+    ch4_baseline = 1920 + 10*np.cos(2*np.pi*(doy-15)/365) + 8*(date_time.year.to_numpy()-years[0])
+    episode = rng.gamma(1.5, 25, n) * (1 + np.sin(2*np.pi*(hour-8)/24)) # daily cycle of the polluted air masses
+    co  = co_baseline + episode + rng.normal(0, 3, n)
+    ch4 = ch4_baseline + (0.6 + 0.1*np.cos(2*np.pi*doy/365)) * episode + rng.normal(0, 4, n)
+    wd  = np.mod(rng.normal(220, 90, n), 360)
+    bkg = episode < np.percentile(episode, 40)
+    return pd.DataFrame({'DateTime': date_time, 'co': co, 'ch4': ch4,
+                         'Stdev_co': rng.gamma(2, 0.8, n), 'Stdev_ch4': rng.gamma(2, 0.5, n), 'WD': wd,
+                         'co_baseline': co_baseline, 'ch4_baseline': ch4_baseline, 'bkg': bkg})
+
+def write_L2_file(filenm, frame, columns):
+    """ write a frame to a file with the ICOS L2 header layout (the header lines number is in the 5th line) """
+    os.makedirs(os.path.dirname(filenm), exist_ok=True)
+    file = open(filenm, 'w')
+    for i in range(1, N_HEADER_LINES):
+        if i == 5:
+            file.write('# HEADER LINES: ' + str(N_HEADER_LINES) + '\n')
+        else:
+            file.write('# synthetic ICOS-like data for benchmarking\n')
+    file.write(';'.join(columns) + '\n')
+    frame[columns].to_csv(file, sep=';', header=False, index=False, float_format='%.3f')
+    file.close()
+
+def get_L2_frames(df, stat, rng):
+    """ ICOS L2 formatted CH4, CO and MTO frames from a synthetic_series() frame """
+    n = len(df)
+    base = pd.DataFrame({'#Site': stat, 'SamplingHeight': 8.0,
+                         'Year': df['DateTime'].dt.year, 'Month': df['DateTime'].dt.month, 'Day': df['DateTime'].dt.day,
+                         'Hour': df['DateTime'].dt.hour, 'Minute': df['DateTime'].dt.minute,
+                         'DecimalDate': df['DateTime'].dt.year + (df['DateTime'].dt.dayofyear-1)/366})
+    frames = {}
+    for spec in ['ch4', 'co']:
+        frame = base.copy()
+        frame[spec] = df[spec].to_numpy()
+        frame['Stdev'] = df['Stdev_'+spec].to_numpy()
+        frame['NbPoints'] = 60
+        frame['Flag'] = rng.choice(['O', 'N', 'K'], n, p=[0.96, 0.02, 0.02])
+        frame['InstrumentId'] = int(conf.gas_inst.split('-')[0])
+        frame['QualityId'] = 0
+        frames[spec.upper()] = frame
+    frame = base.copy()
+    frame['WD'] = df['WD'].to_numpy()
+    frame['WD-Stdev'] = 10.
+    frame['WD-NbPoints'] = 60
+    frame['WD-Flag'] = rng.choice(['O', 'N'], n, p=[0.98, 0.02])
+    frame['WS'] = rng.gamma(2, 2, n)
+    frame['WS-Stdev'] = 1.
+    frame['WS-NbPoints'] = 60
+    frame['WS-Flag'] = 'O'
+    frames['MTO'] = frame
+    return frames
+
+def write_synthetic_station(root, years, freq='1h', seed=0):
+    """
+    write a complete synthetic dataset for the station defined in the config file under the root directory, with the
+    same layout expected by the pipeline: L2 and NRT files (the last 6 months are in the NRT files), BaDS baseline and
+    bkg files, 2018 CMN files (if needed) and CO/CH4 yearly emission inventories for the region 'SYN'. The output
+    directories of the pipeline are created as well
+
+    Parameters
+    ----------
+    root: str
+        root directory (the pipeline must be run with root as working directory)
+    years: list of int
+        years of data
+    freq: str
+        time resolution of the L2 files ('1h' or '1min')
+    seed: int
+        seed of the random generator
+
+    Returns
+    -------
+    df: DataFrame
+        the synthetic_series() frame used to write the files
+    """
+    rng = np.random.default_rng(seed)
+    df = synthetic_series(years, freq=freq, seed=seed)
+    frames = get_L2_frames(df, conf.stat, rng)
+    nrt = (df['DateTime'] >= pd.Timestamp(str(years[-1])+'-07-01')).to_numpy()
+    l2_path = root + '/' + conf.L2_ICOS_path
+    for spec in ['CH4', 'CO', 'MTO']:
+        if spec == 'MTO':
+            prefix, nrt_prefix, columns = conf.L2_met_name_prefix, conf.L2_nrt_met_name_prefix + conf.met_inst, MET_COLUMNS
+        else:
+            prefix, nrt_prefix, columns = conf.L2_name_prefix, conf.L2_nrt_name_prefix + conf.gas_inst, [col.format(spec=spec.lower()) for col in GAS_COLUMNS]
+        write_L2_file(l2_path + prefix     + '.' + spec, frames[spec][~nrt], columns)
+        write_L2_file(l2_path + nrt_prefix + '.' + spec, frames[spec][nrt],  columns)
+
+    # BaDS baseline and bkg files (hourly)
+    hourly = df.set_index('DateTime').resample('1h').first().reset_index()
+    date_str = hourly['DateTime'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    os.makedirs(root + '/BaDS_baseline', exist_ok=True)
+    pd.DataFrame({'date': date_str, 'ch4_cmn_mm': hourly['ch4_baseline'], 'co_cmn_mm': hourly['co_baseline']}).to_csv(
+        root + '/' + fmt_path('BASELINE_FILE'), index=False)
+    bg2 = np.where(hourly['bkg'], 1, 0)
+    pd.DataFrame({'date': date_str, 'co2_bg2': bg2, 'co_bg2': bg2, 'ch4_bg2': bg2}).to_csv(
+        root + '/' + fmt.get_BADS_filenm()[2:], index=False)
+
+    if (conf.stat=='CMN') & (years[0]==2018): # data added by fmt.append_2018()
+        os.makedirs(root + '/L2_ICOS_data/Dati_CMN_201801-05/meteo', exist_ok=True)
+        early = hourly[hourly['DateTime'] < pd.Timestamp('2018-05-11')]
+        pd.DataFrame({'DATE': early['DateTime'].dt.strftime('%Y-%m-%d'), 'TIME': early['DateTime'].dt.strftime('%H:%M:%S'),
+                      'CO': early['co']/1000, 'CH4_cal': early['ch4']}).to_csv(root + '/' + fmt_path('CMN_2018_FILE'), sep=' ', index=False)
+        pd.DataFrame({'YYYY': early['DateTime'].dt.year, 'MM': early['DateTime'].dt.month, 'DD': early['DateTime'].dt.day,
+                      'HH': early['DateTime'].dt.hour, 'MIN': 0, 'wd(deg)': early['WD']}).to_csv(root + '/' + fmt_path('CMN_2018_MET_FILE'), sep=' ', index=False)
+
+    # yearly and monthly emission inventories for the synthetic region 'SYN'
+    os.makedirs(root + '/res_emission_selection', exist_ok=True)
+    for spec, emi in [('CO', 4e4), ('CH4', 2e5)]:
+        pd.DataFrame({'year': years, 'emi[t]': emi, 'emi_err[t]': 0.2*emi}).to_csv(
+            root + '/res_emission_selection/predicted_SYN_'+spec+'_yearly_emi.txt', sep=' ', index=False)
+        months = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
+        pd.DataFrame({'year': np.repeat(years, 12), 'month': months*len(years), 'emi[t]': emi/12}).to_csv(
+            root + '/res_emission_selection/predicted_SYN_'+spec+'_monthly_emi.txt', sep=' ', index=False)
+
+    for dir_nm in ['res_fit', 'plot_estimated_emissions'] + [str(year) for year in years]:
+        os.makedirs(root + '/' + conf.stat + '/' + dir_nm, exist_ok=True)
+    return df
+
+def fmt_path(name):
+    """ relative path of one of the input files defined in formatting_functions """
+    return getattr(fmt, name)[2:] # remove leading './'
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:20:05 2026
+
+@author: cosimo
+"""
+######################################################################################
+######         Sorted DateTime index: range slices and ordered merges           ######
+######################################################################################
+# The merged frame is kept sorted on DateTime (sort_by_time()). On a sorted frame any time range (a year, a month, a
+# season, an arbitrary [start, end) interval) is a contiguous block of rows found with two binary searches
+# (time_slice()) and returned as an iloc slice, without building full length boolean masks. Sorting is checked on the
+# data each time (is_time_sorted(), one linear pass) rather than tracked with a flag in df.attrs, which pandas carries
+# over to reordered frames (sample(), concat() etc.).
+# merge_on_time() joins frames on DateTime by binary search on the sorted keys instead of building a hash table;
+# it falls back to pd.merge() when the keys are not unique or have different dtypes.
+# NB: frames that are reordered (e.g. by sort_values() on another column) fall back to the boolean masks and pd.merge()
+
+import numpy as np
+import pandas as pd
+
+def is_time_sorted(df):
+    """ True if the DateTime column of df is sorted (non decreasing, without NaT) """
+    return df['DateTime'].is_monotonic_increasing
+
+def sort_by_time(df):
+    """
+    sort df on DateTime (stable sort, so rows with the same DateTime keep their order). The frame is returned as it is
+    if it is already sorted
+    """
+    if not is_time_sorted(df):
+        df = df.sort_values('DateTime', kind='stable', ignore_index=True)
+    return df
+
+def time_bounds(df, start=None, end=None):
+    """ positions [i0, i1) of the rows of a sorted frame with start <= DateTime < end (None for no bound) """
+    times = df['DateTime'].to_numpy()
+    i0 = 0 if start is None else int(np.searchsorted(times, np.datetime64(pd.Timestamp(start), 'ns'), side='left'))
+    i1 = len(times) if end is None else int(np.searchsorted(times, np.datetime64(pd.Timestamp(end), 'ns'), side='left'))
+    return i0, max(i0, i1)
+
+def time_slice(df, start=None, end=None):
+    """
+    rows of df with start <= DateTime < end. Binary search on sorted frames, boolean mask otherwise
+
+    Parameters
+    ----------
+    df: DataFrame
+        frame with DateTime column
+    start, end: str, datetime or Timestamp
+        time interval [start, end). The default is None (no bound)
+
+    Returns
+    -------
+    out_df: DataFrame
+    """
+    if is_time_sorted(df):
+        i0, i1 = time_bounds(df, start, end)
+        return df.iloc[i0:i1]
+    mask = np.ones(len(df), dtype=bool)
+    if start is not None:
+        mask &= (df['DateTime'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (df['DateTime'] < pd.Timestamp(end)).to_numpy()
+    return df[mask]
+
+def period_runs(keys):
+    """ (start, stop) positions of the runs of equal values of a non-decreasing key array """
+    if len(keys) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1])
+    stops = np.concatenate([starts[1:], [len(keys)]])
+    return starts, stops
+
+def _unique_sorted(values):
+    """ True if values are strictly increasing """
+    return bool(np.all(values[1:] > values[:-1]))
+
+def merge_on_time(left, right, suffixes=('_x', '_y')):
+    """
+    inner join of left and right on DateTime, with the same result of pd.merge(left, right, on='DateTime',
+    suffixes=suffixes) (rows in the order of left, overlapping columns renamed with suffixes, new RangeIndex).
+    When the left keys are sorted and both keys are unique the rows of right are matched by binary search; right is
+    sorted first if needed. Otherwise pd.merge() is used
+
+    Returns
+    -------
+    out_df: DataFrame
+        merged frame, sorted on DateTime if left is
+    """
+    left_times, right_times = left['DateTime'].to_numpy(), right['DateTime'].to_numpy()
+    if (left_times.dtype != right_times.dtype) or (not _unique_sorted(left_times)):
+        return pd.merge(left, right, on='DateTime', suffixes=suffixes)
+    if not _unique_sorted(right_times):
+        order = np.argsort(right_times, kind='stable')
+        if not _unique_sorted(right_times[order]):
+            return pd.merge(left, right, on='DateTime', suffixes=suffixes)
+        right, right_times = right.iloc[order], right_times[order]
+
+    pos = np.searchsorted(right_times, left_times)
+    pos_clip = np.minimum(pos, len(right_times) - 1)
+    matched = (pos < len(right_times)) & (right_times[pos_clip] == left_times) if len(right_times) > 0 else np.zeros(len(left_times), dtype=bool)
+    left_rows = np.flatnonzero(matched)
+    right_rows = pos[matched]
+
+    overlap = set(left.columns).intersection(right.columns) - {'DateTime'}
+    out_left = left.iloc[left_rows].reset_index(drop=True)
+    out_left.columns = [col + suffixes[0] if col in overlap else col for col in left.columns]
+    right_cols = [col for col in right.columns if col != 'DateTime']
+    out_right = right[right_cols].iloc[right_rows].reset_index(drop=True)
+    out_right.columns = [col + suffixes[1] if col in overlap else col for col in right_cols]
+    return pd.concat([out_left, out_right], axis=1)